@@ -1,13 +1,11 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Request, Response
+from fastapi.responses import StreamingResponse
 from datetime import datetime, timedelta
 import time
 import asyncio
 import random
-import threading
 from app.utils import (
-    log_manager,
     ResponseCacheManager,
-    ActiveRequestsManager,
     clean_expired_stats
 )
 import app.config.settings as settings
@@ -15,17 +13,21 @@ import app.vertex.config as app_config
 from app.services import GeminiClient
 from app.utils.auth import verify_web_password
 from app.utils.maintenance import api_call_stats_clean
-from app.utils.logging import log, vertex_log_manager
+from app.utils.logging import log, log_manager, vertex_log_manager
 from app.config.persistence import get_persistence
+from app.config.snapshot import publish_settings
 from app.utils.stats import api_stats_manager
+from app.utils.http_client import get_pool_stats
+from app.utils.stream_hub import stream_hub
+from app.utils.dashboard_snapshot import DashboardSnapshot
+from app.utils.key_validation import key_validator
+from app.utils.lazy_import import lazy_import
 from typing import List
 import json
 
-# Import necessary components for Google Credentials JSON update
-from app.vertex.credentials_manager import CredentialManager, parse_multiple_json_credentials
-
-# 引入重新初始化vertex的函数
-from app.vertex.vertex_ai_init import init_vertex_ai as re_init_vertex_ai_function, reset_global_fallback_client
+# Vertex 凭证管理和初始化依赖 google-auth、google-genai，启用或更新 Vertex 配置时才导入
+vertex_credentials = lazy_import("app.vertex.credentials_manager")
+vertex_ai_init = lazy_import("app.vertex.vertex_ai_init")
 
 # 创建路由器
 dashboard_router = APIRouter(prefix="/api", tags=["dashboard"])
@@ -33,30 +35,23 @@ dashboard_router = APIRouter(prefix="/api", tags=["dashboard"])
 # 全局变量引用，将在init_dashboard_router中设置
 key_manager = None
 response_cache_manager = None
-active_requests_manager = None
+request_coalescer = None
 credential_manager = None  # 添加全局credential_manager变量
 
-# 用于存储API密钥检测的进度信息
-api_key_test_progress = {
-    "is_running": False,
-    "completed": 0,
-    "total": 0,
-    "valid": 0,
-    "invalid": 0,
-    "is_completed": False
-}
+# 用于存储API密钥检测的进度信息（由密钥校验引擎原地更新）
+api_key_test_progress = key_validator.progress
 
 def init_dashboard_router(
     key_mgr,
     cache_mgr,
-    active_req_mgr,
+    coalescer,
     cred_mgr=None  # 添加credential_manager参数
 ):
     """初始化仪表盘路由器"""
-    global key_manager, response_cache_manager, active_requests_manager, credential_manager
+    global key_manager, response_cache_manager, request_coalescer, credential_manager
     key_manager = key_mgr
     response_cache_manager = cache_mgr
-    active_requests_manager = active_req_mgr
+    request_coalescer = coalescer
     credential_manager = cred_mgr  # 保存credential_manager
     return dashboard_router
 
@@ -66,19 +61,19 @@ async def run_blocking_init_vertex():
         if credential_manager is None:
             # 如果credential_manager为None，记录警告并创建一个新的实例
             log('warning', "Credential Manager不存在，将创建一个新的实例用于初始化")
-            temp_credential_manager = CredentialManager()
+            temp_credential_manager = vertex_credentials.CredentialManager()
             credentials_count = temp_credential_manager.get_total_credentials()
             log('info', f"临时Credential Manager已创建，包含{credentials_count}个凭证")
             
             # 传递临时创建的credential_manager实例
-            success = await re_init_vertex_ai_function(credential_manager=temp_credential_manager)
+            success = await vertex_ai_init.init_vertex_ai(credential_manager=temp_credential_manager)
         else:
             # 记录当前有多少凭证可用
             credentials_count = credential_manager.get_total_credentials()
             log('info', f"使用现有Credential Manager进行初始化，当前有{credentials_count}个凭证")
             
             # 传递当前的credential_manager实例
-            success = await re_init_vertex_ai_function(credential_manager=credential_manager)
+            success = await vertex_ai_init.init_vertex_ai(credential_manager=credential_manager)
         
         if success:
             log('info', "异步重新执行 init_vertex_ai 成功，以响应 Google Credentials JSON 的更新。")
@@ -87,13 +82,10 @@ async def run_blocking_init_vertex():
     except Exception as e:
         log('error', f"执行 run_blocking_init_vertex 时出错: {e}")
 
-@dashboard_router.get("/dashboard-data")
-async def get_dashboard_data():
-    """获取仪表盘数据的API端点，用于动态刷新"""
+async def build_dashboard_data():
+    """构建仪表盘数据，由 dashboard_snapshot 在后台定期调用"""
     # 先清理过期数据，确保统计数据是最新的
     await api_stats_manager.maybe_cleanup()
-    await response_cache_manager.clean_expired()  # 使用管理器清理缓存
-    active_requests_manager.clean_completed()  # 使用管理器清理活跃请求
     
     # 获取当前统计数据
     now = datetime.now()
@@ -107,21 +99,20 @@ async def get_dashboard_data():
     time_series_data, tokens_time_series = api_stats_manager.get_time_series_data(30, now)
     
     # 获取API密钥使用统计
-    api_key_stats = api_stats_manager.get_api_key_stats(key_manager.api_keys)
-    
-    # 根据ENABLE_VERTEX设置决定返回哪种日志
-    if settings.ENABLE_VERTEX:
-        recent_logs = vertex_log_manager.get_recent_logs(500)  # 获取最近500条Vertex日志
-    else:
-        recent_logs = log_manager.get_recent_logs(500)  # 获取最近500条普通日志
+    api_key_stats = api_stats_manager.get_api_key_stats(key_manager.api_keys, key_manager.get_usage)
+
+    # 合并密钥冷却状态
+    key_cooldowns = key_manager.get_cooldowns()
+    cooldown_map = {item['api_key']: item for item in key_cooldowns}
+    for stat in api_key_stats:
+        cooldown = cooldown_map.get(stat['api_key'])
+        stat['cooldown_remaining'] = cooldown['remaining'] if cooldown else 0
     
     # 获取缓存统计
     total_cache = response_cache_manager.cur_cache_num
     
-    # 获取活跃请求统计
-    active_count = len(active_requests_manager.active_requests)
-    active_done = sum(1 for task in active_requests_manager.active_requests.values() if task.done())
-    active_pending = active_count - active_done
+    # 获取请求合并统计
+    coalescer_stats = request_coalescer.get_stats()
 
     # 获取凭证数量
     credentials_count = 0
@@ -131,6 +122,8 @@ async def get_dashboard_data():
     # 返回JSON格式的数据
     return {
         "key_count": len(key_manager.api_keys),
+        "cooling_key_count": len(key_cooldowns),
+        "key_cooldowns": key_cooldowns,
         "model_count": len(GeminiClient.AVAILABLE_MODELS),
         "retry_count": settings.MAX_RETRY_NUM,
         "credentials_count": credentials_count,  # 添加凭证数量
@@ -140,7 +133,6 @@ async def get_dashboard_data():
         "calls_time_series": time_series_data,      # 添加API调用时间序列
         "tokens_time_series": tokens_time_series,   # 添加Token使用时间序列
         "current_time": datetime.now().strftime('%H:%M:%S'),
-        "logs": recent_logs,
         "api_key_stats": api_key_stats,
         # 添加配置信息
         "max_requests_per_minute": settings.MAX_REQUESTS_PER_MINUTE,
@@ -162,10 +154,14 @@ async def get_dashboard_data():
         "cache_entries": total_cache,
         "cache_expiry_time": settings.CACHE_EXPIRY_TIME,
         "max_cache_entries": settings.MAX_CACHE_ENTRIES,
-        # 添加活跃请求池信息
-        "active_count": active_count,
-        "active_done": active_done,
-        "active_pending": active_pending,
+        "cache_bytes": response_cache_manager.cur_cache_bytes,
+        "cache_evicted_bytes": response_cache_manager.evicted_bytes,
+        "max_cache_bytes": settings.MAX_CACHE_BYTES,
+        # 添加请求合并信息
+        "active_count": coalescer_stats["flights"],
+        "coalescer": coalescer_stats,
+        "stream_hub": stream_hub.get_stats(),
+        "attempt_stats": api_stats_manager.get_attempt_stats(),
         # 添加并发请求配置
         "concurrent_requests": settings.CONCURRENT_REQUESTS,
         "increase_concurrent_on_failure": settings.INCREASE_CONCURRENT_ON_FAILURE,
@@ -181,8 +177,44 @@ async def get_dashboard_data():
         # 添加空响应重试次数限制
         "max_empty_responses": settings.MAX_EMPTY_RESPONSES,
         "gemini_base_url": settings.GEMINI_BASE_URL,
+        # 上游连接池状态
+        "http_pool": get_pool_stats(),
     }
 
+dashboard_snapshot = DashboardSnapshot(build_dashboard_data)
+
+@dashboard_router.get("/dashboard-data")
+async def get_dashboard_data(request: Request):
+    """获取仪表盘数据的API端点，用于动态刷新；数据未变化时返回 304"""
+    snapshot = await dashboard_snapshot.current()
+    headers = {"ETag": snapshot.etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == snapshot.etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=snapshot.body, media_type="application/json", headers=headers)
+
+@dashboard_router.get("/dashboard-stream")
+async def dashboard_stream():
+    """以 SSE 推送仪表盘数据：连接后先发送完整快照，之后只推送变化的部分"""
+    return StreamingResponse(dashboard_snapshot.stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@dashboard_router.get("/logs")
+async def get_logs(after: int = 0, level: str = None, key: str = None, model: str = None, limit: int = 500):
+    """
+    增量获取日志：返回序号大于 after 且匹配级别/密钥/模型的日志。
+
+    客户端保存返回的 last_seq，下次以 after=last_seq 请求，只获取新日志；
+    超过 limit 条时返回最旧的 limit 条并置 has_more，客户端继续以 after=last_seq 请求剩余日志；
+    after 大于服务端当前序号（服务已重启）时从头返回。
+    """
+    # 根据ENABLE_VERTEX设置决定返回哪种日志
+    store = vertex_log_manager if settings.ENABLE_VERTEX else log_manager
+    if after > store.last_seq:
+        after = 0
+    limit = max(1, min(limit, 1000))
+    logs, last_seq, has_more = store.query(after, limit, level=level.upper() if level else None, key=key, model=model)
+    return {"logs": logs, "last_seq": last_seq, "has_more": has_more}
+
 @dashboard_router.post("/reset-stats")
 async def reset_stats(password_data: dict):
     """
@@ -210,6 +242,9 @@ async def reset_stats(password_data: dict):
         
         # 调用重置函数
         await api_stats_manager.reset()
+        if key_manager:
+            key_manager.reset_usage()
+        dashboard_snapshot.invalidate()
         
         return {"status": "success", "message": "API调用统计数据已重置"}
     except HTTPException:
@@ -290,6 +325,9 @@ async def update_config(config_data: dict):
                 raise HTTPException(status_code=422, detail="参数类型错误：应为布尔值")
             settings.ENABLE_VERTEX_EXPRESS = config_value
             log('info', f"Vertex Express已更新为：{config_value}")
+            if config_value:
+                # 启动时未启用Vertex则尚未初始化，此时在后台初始化
+                asyncio.create_task(run_blocking_init_vertex())
             
         elif config_key == "vertex_express_api_key":
             if not isinstance(config_value, str):
@@ -356,8 +394,6 @@ async def update_config(config_data: dict):
             
             # 在切换search_mode时，重新获取一次可用模型列表
             try:
-                # 重置密钥栈以确保随机性
-                key_manager._reset_key_stack()
                 # 获取一个随机API密钥
                 for key in key_manager.api_keys:
                     log('info', f"使用API密钥 {key[:8]}... 刷新可用模型列表")
@@ -407,6 +443,9 @@ async def update_config(config_data: dict):
                 raise HTTPException(status_code=422, detail="参数类型错误：应为布尔值")
             settings.ENABLE_VERTEX = config_value
             log('info', f"Vertex AI 已更新为：{config_value}")
+            if config_value:
+                # 启动时未启用Vertex则尚未初始化，此时在后台初始化
+                asyncio.create_task(run_blocking_init_vertex())
 
         elif config_key == "google_credentials_json":
             if not isinstance(config_value, str): # Allow empty string to clear
@@ -424,7 +463,7 @@ async def update_config(config_data: dict):
                 try:
                     # Attempt to parse as single or multiple JSONs
                     # parse_multiple_json_credentials logs errors if parsing fails but returns list.
-                    temp_parsed = parse_multiple_json_credentials(config_value)
+                    temp_parsed = vertex_credentials.parse_multiple_json_credentials(config_value)
                     # If parse_multiple_json_credentials returns an empty list for a non-empty string,
                     # it means it didn't find any valid top-level JSON objects as per its logic.
                     # We can do an additional check for a single valid JSON object.
@@ -450,7 +489,7 @@ async def update_config(config_data: dict):
             log('info', "Google Credentials JSON 设置已更新 (内容未记录)。")
 
             # Reset global fallback client first
-            reset_global_fallback_client()
+            vertex_ai_init.reset_global_fallback_client()
 
             # Clear previously loaded JSON string credentials from manager
             if credential_manager is not None:
@@ -458,7 +497,7 @@ async def update_config(config_data: dict):
                 log('info', f"从 CredentialManager 中清除了 {cleared_count} 个先前由 JSON 字符串加载的凭据。")
 
                 if config_value: # If new JSON string is provided
-                    parsed_json_objects = parse_multiple_json_credentials(config_value)
+                    parsed_json_objects = vertex_credentials.parse_multiple_json_credentials(config_value)
                     if parsed_json_objects:
                         loaded_count = credential_manager.load_credentials_from_json_list(parsed_json_objects)
                         if loaded_count > 0:
@@ -553,7 +592,7 @@ async def update_config(config_data: dict):
                     added_key_count += 1
             
             # 重置密钥栈
-            key_manager._reset_key_stack()
+            key_manager.refresh_keys()
             
             # 如果可用模型为空，尝试获取模型列表
             if not GeminiClient.AVAILABLE_MODELS:
@@ -594,11 +633,15 @@ async def update_config(config_data: dict):
             raise HTTPException(status_code=400, detail=f"不支持的配置项：{config_key}")
         persistence = get_persistence()
         persistence.save_settings()
+        dashboard_snapshot.invalidate()
         return {"status": "success", "message": f"配置项 {config_key} 已更新"}
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"更新失败：{str(e)}")
+    finally:
+        # 发布新的配置快照，之后进入的请求使用修改后的配置（可用模型列表可能随密钥一起更新）
+        publish_settings(GeminiClient.AVAILABLE_MODELS)
 
 @dashboard_router.post("/test-api-keys")
 async def test_api_keys(password_data: dict):
@@ -626,18 +669,14 @@ async def test_api_keys(password_data: dict):
             raise HTTPException(status_code=401, detail="密码错误")
         
         # 检查是否已经有测试在运行
-        if api_key_test_progress["is_running"]:
+        if key_validator.is_running:
             raise HTTPException(status_code=409, detail="已有API密钥检测正在进行中")
         
         # 获取有效密钥列表
         valid_keys = key_manager.api_keys.copy()
         
-        # 启动异步测试
-        threading.Thread(
-            target=start_api_key_test_in_thread, 
-            args=(valid_keys,), 
-            daemon=True
-        ).start()
+        # 启动后台检测
+        asyncio.create_task(run_api_key_test(valid_keys))
         
         return {"status": "success", "message": "API密钥检测已启动，将同时检测有效密钥和无效密钥"}
     except HTTPException:
@@ -655,100 +694,53 @@ async def get_test_api_keys_progress():
     """
     return api_key_test_progress
 
-def check_api_key_in_thread(key):
-    """在线程中检查单个API密钥的有效性"""
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        is_valid = loop.run_until_complete(test_api_key(key))
-        if is_valid:
-            log('info', f"API密钥 {key[:8]}... 有效")
-            return key, True
-        else:
-            log('warning', f"API密钥 {key[:8]}... 无效")
-            return key, False
-    finally:
-        loop.close()
-
-async def test_api_key(key):
-    """测试单个API密钥是否有效"""
-    try:
-        # 尝试列出可用模型来检查API密钥是否有效
-        all_models = await GeminiClient.list_available_models(key)
-        return len(all_models) > 0
-    except Exception as e:
-        log('error', f"测试API密钥 {key[:8]}... 时出错: {str(e)}")
-        return False
-
-def start_api_key_test_in_thread(keys):
-    """在线程中启动API密钥检测过程"""
-    # 重置进度信息
-    api_key_test_progress.update({
-        "is_running": True,
-        "completed": 0,
-        "total": 0,  # 稍后会更新
-        "valid": 0,
-        "invalid": 0,
-        "is_completed": False
-    })
+@dashboard_router.post("/test-api-keys/cancel")
+async def cancel_test_api_keys(password_data: dict):
+    """
+    取消正在进行的API密钥检测，已完成检测的密钥结果保留
     
-    try:
-        # 获取所有需要检测的密钥（包括当前GEMINI_API_KEYS和INVALID_API_KEYS）
-        current_keys = keys
+    Args:
+        password_data (dict): 包含密码的字典
         
+    Returns:
+        dict: 操作结果
+    """
+    if not isinstance(password_data, dict):
+        raise HTTPException(status_code=422, detail="请求体格式错误：应为JSON对象")
+    password = password_data.get("password")
+    if not isinstance(password, str) or not verify_web_password(password):
+        raise HTTPException(status_code=401, detail="密码错误")
+    if not key_validator.cancel():
+        return {"status": "success", "message": "当前没有正在进行的API密钥检测"}
+    return {"status": "success", "message": "已取消API密钥检测"}
+
+async def run_api_key_test(keys):
+    """检测当前有效密钥和无效密钥，结果逐个应用到密钥管理器，结束后保存设置"""
+    try:
         # 获取当前无效密钥
         invalid_api_keys = settings.INVALID_API_KEYS.split(',') if settings.INVALID_API_KEYS else []
         invalid_api_keys = [key.strip() for key in invalid_api_keys if key.strip()]
         
         # 合并所有需要测试的密钥，去重
-        all_keys_to_test = list(set(current_keys + invalid_api_keys))
-        
-        # 更新总数
-        api_key_test_progress["total"] = len(all_keys_to_test)
-        
-        # 创建有效和无效密钥列表
-        valid_keys = []
-        invalid_keys = []
-        
-        # 检查每个密钥
-        for key in all_keys_to_test:
-            # 检查密钥
-            _, is_valid = check_api_key_in_thread(key)
-            
-            # 更新进度
-            api_key_test_progress["completed"] += 1
-            
-            # 将密钥添加到相应列表
-            if is_valid:
-                valid_keys.append(key)
-                api_key_test_progress["valid"] += 1
-            else:
-                invalid_keys.append(key)
-                api_key_test_progress["invalid"] += 1
+        all_keys_to_test = list(dict.fromkeys(keys + invalid_api_keys))
         
-        # 更新全局密钥列表
-        key_manager.api_keys = valid_keys
+        valid_keys, invalid_keys = await key_validator.run(all_keys_to_test, on_result=key_manager.apply_validation)
         
-        # 更新设置中的有效和无效密钥
-        settings.GEMINI_API_KEYS = ','.join(valid_keys)
-        settings.INVALID_API_KEYS = ','.join(invalid_keys)
+        # 更新设置中的有效和无效密钥（无法判断或被取消时未检测的密钥保持原状态）
+        remaining_invalid = set(invalid_api_keys) - set(valid_keys)
+        settings.GEMINI_API_KEYS = ','.join(key_manager.api_keys)
+        settings.INVALID_API_KEYS = ','.join(sorted(remaining_invalid.union(invalid_keys)))
         
         # 保存设置
         persistence = get_persistence()
         persistence.save_settings()
+        dashboard_snapshot.invalidate()
         
-        # 重置密钥栈
-        key_manager._reset_key_stack()
-        
-        log('info', f"API密钥检测完成。有效密钥: {len(valid_keys)}，无效密钥: {len(invalid_keys)}")
+        status = "已取消" if key_validator.progress["cancelled"] else "完成"
+        log('info', f"API密钥检测{status}。有效密钥: {len(valid_keys)}，无效密钥: {len(invalid_keys)}，"
+                    f"无法判断: {key_validator.progress['unknown']}")
     except Exception as e:
         log('error', f"API密钥检测过程中发生错误: {str(e)}")
-    finally:
-        # 标记检测完成
-        api_key_test_progress.update({
-            "is_running": False,
-            "is_completed": True
-        })
 
 @dashboard_router.post("/clear-invalid-api-keys")
 async def clear_invalid_api_keys(password_data: dict):
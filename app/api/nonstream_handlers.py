@@ -6,10 +6,11 @@ from app.services import GeminiClient
 from app.utils import update_api_call_stats
 from app.utils.error_handling import handle_gemini_error
 from app.utils.logging import log
+from app.utils.hedging import HedgedAttempts
+from app.utils import metrics
 import app.config.settings as settings
 from typing import Literal
 from app.utils.response import gemini_from_text, openAI_from_Gemini, openAI_from_text
-from app.utils.stats import get_api_key_usage
 
 
 # 非流式请求处理函数
@@ -19,28 +20,24 @@ async def process_nonstream_request(
     system_instruction,
     current_api_key: str,
     response_cache_manager,
-    safety_settings,
-    safety_settings_g2,
+    cfg,
     cache_key: str,
     key_manager
 ):
     """处理非流式API请求"""
-    gemini_client = GeminiClient(current_api_key)
+    gemini_client = GeminiClient(current_api_key, cfg=cfg)
     # 创建调用 Gemini API 的主任务
     gemini_task = asyncio.create_task(
         gemini_client.complete_chat(
             chat_request,
             contents,
-            safety_settings_g2 if 'gemini-2.5' in chat_request.model else safety_settings,
+            cfg.safety_settings(chat_request.model),
             system_instruction
         )
     )
-    # 使用 shield 保护任务不被外部轻易取消
-    shielded_gemini_task = asyncio.shield(gemini_task)
-
     try:
-        # 等待受保护的 API 调用任务完成
-        response_content = await shielded_gemini_task
+        # 等待 API 调用任务完成；其他并发请求先成功时本任务会被取消，同时取消上游请求
+        response_content = await gemini_task
         response_content.set_model(chat_request.model)
         
         # 检查响应内容是否为空
@@ -69,21 +66,20 @@ async def process_nonstream_request_with_keepalive(
     system_instruction,
     current_api_key: str,
     response_cache_manager,
-    safety_settings,
-    safety_settings_g2,
+    cfg,
     cache_key: str,
     keepalive_interval: float = 30.0,  # 保活间隔，默认30秒
     key_manager=None
 ):
     """处理非流式API请求，带TCP保活功能"""
-    gemini_client = GeminiClient(current_api_key)
+    gemini_client = GeminiClient(current_api_key, cfg=cfg)
     
     # 创建调用 Gemini API 的主任务
     gemini_task = asyncio.create_task(
         gemini_client.complete_chat(
             chat_request,
             contents,
-            safety_settings_g2 if 'gemini-2.5' in chat_request.model else safety_settings,
+            cfg.safety_settings(chat_request.model),
             system_instruction
         )
     )
@@ -97,9 +93,6 @@ async def process_nonstream_request_with_keepalive(
         # 等待Gemini任务完成
         response_content = await gemini_task
         
-        # 取消保活任务
-        keepalive_task.cancel()
-        
         response_content.set_model(chat_request.model)
         
         # 检查响应内容是否为空
@@ -116,11 +109,12 @@ async def process_nonstream_request_with_keepalive(
         return "success"
 
     except Exception as e:
-        # 取消保活任务
-        keepalive_task.cancel()
         # 处理 API 调用过程中可能发生的任何异常
         await handle_gemini_error(e, current_api_key, key_manager)
         return "error"
+    finally:
+        # 取消保活任务（包括被其他并发请求抢先成功而取消的情况）
+        keepalive_task.cancel()
 
 
 # 简化的保活功能 - 在等待期间发送换行符
@@ -130,21 +124,20 @@ async def process_nonstream_request_with_simple_keepalive(
     system_instruction,
     current_api_key: str,
     response_cache_manager,
-    safety_settings,
-    safety_settings_g2,
+    cfg,
     cache_key: str,
     keepalive_interval: float = 30.0,  # 保活间隔，默认30秒
     key_manager=None
 ):
     """处理非流式API请求，带简化TCP保活功能"""
-    gemini_client = GeminiClient(current_api_key)
+    gemini_client = GeminiClient(current_api_key, cfg=cfg)
     
     # 创建调用 Gemini API 的主任务
     gemini_task = asyncio.create_task(
         gemini_client.complete_chat(
             chat_request,
             contents,
-            safety_settings_g2 if 'gemini-2.5' in chat_request.model else safety_settings,
+            cfg.safety_settings(chat_request.model),
             system_instruction
         )
     )
@@ -158,9 +151,6 @@ async def process_nonstream_request_with_simple_keepalive(
         # 等待Gemini任务完成
         response_content = await gemini_task
         
-        # 取消保活任务
-        keepalive_task.cancel()
-        
         response_content.set_model(chat_request.model)
         
         # 检查响应内容是否为空
@@ -177,11 +167,12 @@ async def process_nonstream_request_with_simple_keepalive(
         return "success"
 
     except Exception as e:
-        # 取消保活任务
-        keepalive_task.cancel()
         # 处理 API 调用过程中可能发生的任何异常
         await handle_gemini_error(e, current_api_key, key_manager)
         return "error"
+    finally:
+        # 取消保活任务（包括被其他并发请求抢先成功而取消的情况）
+        keepalive_task.cancel()
 
 
 async def send_keepalive_messages(interval: float):
@@ -204,8 +195,7 @@ async def process_request(
     chat_request,
     key_manager,
     response_cache_manager,
-    safety_settings,
-    safety_settings_g2,
+    cfg,
     cache_key: str
 ):
     """处理非流式请求"""
@@ -218,11 +208,11 @@ async def process_request(
     else:
         is_gemini = False
         # 转换消息格式
-        contents, system_instruction = GeminiClient.convert_messages(GeminiClient, chat_request.messages,model=chat_request.model)
+        contents, system_instruction = GeminiClient(api_key="", cfg=cfg).convert_messages(chat_request.messages,model=chat_request.model)
 
     # 设置初始并发数
-    current_concurrent = settings.CONCURRENT_REQUESTS
-    max_retry_num = settings.MAX_RETRY_NUM
+    current_concurrent = cfg.CONCURRENT_REQUESTS
+    max_retry_num = cfg.MAX_RETRY_NUM
     
     # 当前请求次数
     current_try_num = 0
@@ -231,112 +221,62 @@ async def process_request(
     empty_response_count = 0
     
     # 尝试使用不同API密钥，直到达到最大重试次数或空响应限制
-    while (current_try_num < max_retry_num) and (empty_response_count < settings.MAX_EMPTY_RESPONSES):
+    while (current_try_num < max_retry_num) and (empty_response_count < cfg.MAX_EMPTY_RESPONSES):
         # 获取当前批次的密钥数量
         batch_num = min(max_retry_num - current_try_num, current_concurrent)
         
-        # 获取当前批次的密钥
-        valid_keys = []
-        checked_keys = set()  # 用于记录已检查过的密钥
-        all_keys_checked = False  # 标记是否已检查所有密钥
-        
-        # 尝试获取足够数量的有效密钥
-        while len(valid_keys) < batch_num:
-            api_key = await key_manager.get_available_key()
-            if not api_key:
-                break
-                
-            # 如果这个密钥已经检查过，说明已经检查了所有密钥
-            if api_key in checked_keys:
-                all_keys_checked = True
-                break
-            
-            checked_keys.add(api_key)
-            # 获取API密钥的调用次数
-            usage = await get_api_key_usage(settings.api_call_stats, api_key)
-            # 如果调用次数小于限制，则添加到有效密钥列表
-            if usage < settings.API_KEY_DAILY_LIMIT:
-                valid_keys.append(api_key)
-            else:
-                log('warning', f"API密钥 {api_key[:8]}... 已达到每日调用限制 ({usage}/{settings.API_KEY_DAILY_LIMIT})",
-                    extra={'key': api_key[:8], 'request_type': 'non-stream', 'model': chat_request.model})
-        
-        # 如果已经检查了所有密钥且没有找到有效密钥，则重置密钥栈
-        if all_keys_checked and not valid_keys:
-            log('warning', "所有API密钥已达到每日调用限制，重置密钥栈",
-                extra={'request_type': 'non-stream', 'model': chat_request.model})
-            key_manager._reset_key_stack()
-            # 重置后重新获取一个密钥
-            api_key = await key_manager.get_available_key()
-            if api_key:
-                valid_keys = [api_key]
+        # 创建并发任务 - 根据配置决定是否使用保活功能
+        if cfg.NONSTREAM_KEEPALIVE_ENABLED:
+            def launch(api_key):
+                return process_nonstream_request_with_simple_keepalive(
+                    chat_request,
+                    contents,
+                    system_instruction,
+                    api_key,
+                    response_cache_manager,
+                    cfg,
+                    cache_key,
+                    cfg.NONSTREAM_KEEPALIVE_INTERVAL
+                )
+        else:
+            def launch(api_key):
+                return process_nonstream_request(
+                    chat_request,
+                    contents,
+                    system_instruction,
+                    api_key,
+                    response_cache_manager,
+                    cfg,
+                    cache_key,
+                    key_manager
+                )
+        # 密钥在尝试真正发出时才取出，对冲模式下未发出的尝试不占用密钥和重试次数
+        attempts = HedgedAttempts(key_manager.checkout_keys, batch_num, launch, chat_request.model, cfg)
         
         # 如果没有获取到任何有效密钥，跳出循环
-        if not valid_keys:
+        if not await attempts.start():
             break
-            
-        # 更新当前尝试次数
-        current_try_num += len(valid_keys)
         
-        # 创建并发任务
-        tasks = []
-        tasks_map = {}
-        for api_key in valid_keys:
-            # 记录当前尝试的密钥信息
-            log('info', f"非流式请求开始，使用密钥: {api_key[:8]}...", 
-                extra={'key': api_key[:8], 'request_type': 'non-stream', 'model': chat_request.model})
-            
-            # 创建任务 - 根据配置决定是否使用保活功能
-            if settings.NONSTREAM_KEEPALIVE_ENABLED:
-                task = asyncio.create_task(
-                    process_nonstream_request_with_simple_keepalive(
-                        chat_request,
-                        contents,
-                        system_instruction,
-                        api_key,
-                        response_cache_manager,
-                        safety_settings,
-                        safety_settings_g2,
-                        cache_key,
-                        settings.NONSTREAM_KEEPALIVE_INTERVAL
-                    )
-                )
-            else:
-                task = asyncio.create_task(
-                    process_nonstream_request(
-                        chat_request,
-                        contents,
-                        system_instruction,
-                        api_key,
-                        response_cache_manager,
-                        safety_settings,
-                        safety_settings_g2,
-                        cache_key,
-                        key_manager
-                    )
-                )
-            tasks.append((api_key, task))
-            tasks_map[task] = api_key
-        
-        # 等待所有任务完成或找到成功响应
+        # 等待任务完成或找到成功响应
         success = False
-        while tasks and not success:
-            # 短时间等待任务完成
-            done, pending = await asyncio.wait(
-                [task for _, task in tasks],
-                return_when=asyncio.FIRST_COMPLETED
-            )
+        while attempts and not success:
             # 检查已完成的任务是否成功
-            for task in done:
-                api_key = tasks_map[task]
+            for api_key, task in await attempts.wait():
                 try:
                     status = task.result()                    
                     # 如果有成功响应内容
                     if status == "success" :  
+                        # 先取出缓存的响应，确认取到后再取消其余尝试
+                        cached_response, cache_hit = await  response_cache_manager.get_and_remove(cache_key)
+                        if cached_response is None:
+                            log('warning', f"成功响应已被其他相同请求取走，继续等待其余尝试",
+                                extra={'key': api_key[:8],'request_type': 'non-stream', 'model': chat_request.model})
+                            continue
                         success = True
+                        attempts.settle(task)
                         log('info', f"非流式请求成功", 
                             extra={'key': api_key[:8],'request_type': 'non-stream', 'model': chat_request.model})
-                        cached_response, cache_hit = await  response_cache_manager.get_and_remove(cache_key)
+                        key_manager.report_success(api_key)
                         if is_gemini :
                             return cached_response.data
                         else:
@@ -344,25 +284,26 @@ async def process_request(
                     elif status == "empty":
                         # 增加空响应计数
                         empty_response_count += 1
-                        log('warning', f"空响应计数: {empty_response_count}/{settings.MAX_EMPTY_RESPONSES}",
+                        metrics.empty_responses_total.labels(chat_request.model, "non-stream").inc()
+                        log('warning', f"空响应计数: {empty_response_count}/{cfg.MAX_EMPTY_RESPONSES}",
                             extra={'key': api_key[:8], 'request_type': 'non-stream', 'model': chat_request.model})
                 
                 except Exception as e:
                     await handle_gemini_error(e, api_key, key_manager)
+        
+        # 更新当前尝试次数，只计入实际发出的尝试
+        current_try_num += attempts.launched
                 
-                # 更新任务列表，移除已完成的任务
-                tasks = [(k, t) for k, t in tasks if not t.done()]
-                
-        # 如果当前批次没有成功响应，并且还有密钥可用，则继续尝试
-        if not success and valid_keys:
+        # 如果当前批次没有成功响应，则继续尝试
+        if not success:
             # 增加并发数，但不超过最大并发数
-            current_concurrent = min(current_concurrent + settings.INCREASE_CONCURRENT_ON_FAILURE, settings.MAX_CONCURRENT_REQUESTS)
+            current_concurrent = min(current_concurrent + cfg.INCREASE_CONCURRENT_ON_FAILURE, cfg.MAX_CONCURRENT_REQUESTS)
             log('info', f"所有并发请求失败或返回空响应，增加并发数至: {current_concurrent}", 
                 extra={'request_type': 'non-stream', 'model': chat_request.model})
         
         # 如果空响应次数达到限制，跳出循环，并返回酒馆正常响应(包含错误信息)
-        if empty_response_count >= settings.MAX_EMPTY_RESPONSES:
-            log('warning', f"空响应次数达到限制 ({empty_response_count}/{settings.MAX_EMPTY_RESPONSES})，停止轮询",
+        if empty_response_count >= cfg.MAX_EMPTY_RESPONSES:
+            log('warning', f"空响应次数达到限制 ({empty_response_count}/{cfg.MAX_EMPTY_RESPONSES})，停止轮询",
                 extra={'request_type': 'non-stream', 'model': chat_request.model})
             
             if is_gemini :
@@ -386,8 +327,7 @@ async def process_nonstream_with_keepalive_stream(
     chat_request,
     key_manager,
     response_cache_manager,
-    safety_settings,
-    safety_settings_g2,
+    cfg,
     cache_key: str,
     is_gemini: bool
 ):
@@ -403,11 +343,11 @@ async def process_nonstream_with_keepalive_stream(
             if format_type and (format_type == "gemini"):
                 contents, system_instruction = None, None
             else:
-                contents, system_instruction = GeminiClient.convert_messages(GeminiClient, chat_request.messages, model=chat_request.model)
+                contents, system_instruction = GeminiClient(api_key="", cfg=cfg).convert_messages(chat_request.messages, model=chat_request.model)
 
             # 设置初始并发数
-            current_concurrent = settings.CONCURRENT_REQUESTS
-            max_retry_num = settings.MAX_RETRY_NUM
+            current_concurrent = cfg.CONCURRENT_REQUESTS
+            max_retry_num = cfg.MAX_RETRY_NUM
             
             # 当前请求次数
             current_try_num = 0
@@ -416,88 +356,35 @@ async def process_nonstream_with_keepalive_stream(
             empty_response_count = 0
             
             # 尝试使用不同API密钥，直到达到最大重试次数或空响应限制
-            while (current_try_num < max_retry_num) and (empty_response_count < settings.MAX_EMPTY_RESPONSES):
+            while (current_try_num < max_retry_num) and (empty_response_count < cfg.MAX_EMPTY_RESPONSES):
                 # 获取当前批次的密钥数量
                 batch_num = min(max_retry_num - current_try_num, current_concurrent)
                 
-                # 获取当前批次的密钥
-                valid_keys = []
-                checked_keys = set()  # 用于记录已检查过的密钥
-                all_keys_checked = False  # 标记是否已检查所有密钥
-                
-                # 尝试获取足够数量的有效密钥
-                while len(valid_keys) < batch_num:
-                    api_key = await key_manager.get_available_key()
-                    if not api_key:
-                        break
-                        
-                    # 如果这个密钥已经检查过，说明已经检查了所有密钥
-                    if api_key in checked_keys:
-                        all_keys_checked = True
-                        break
-                    
-                    checked_keys.add(api_key)
-                    # 获取API密钥的调用次数
-                    usage = await get_api_key_usage(settings.api_call_stats, api_key)
-                    # 如果调用次数小于限制，则添加到有效密钥列表
-                    if usage < settings.API_KEY_DAILY_LIMIT:
-                        valid_keys.append(api_key)
-                    else:
-                        log('warning', f"API密钥 {api_key[:8]}... 已达到每日调用限制 ({usage}/{settings.API_KEY_DAILY_LIMIT})",
-                            extra={'key': api_key[:8], 'request_type': 'non-stream', 'model': chat_request.model})
-                
-                # 如果已经检查了所有密钥且没有找到有效密钥，则重置密钥栈
-                if all_keys_checked and not valid_keys:
-                    log('warning', "所有API密钥已达到每日调用限制，重置密钥栈",
-                        extra={'request_type': 'non-stream', 'model': chat_request.model})
-                    key_manager._reset_key_stack()
-                    # 重置后重新获取一个密钥
-                    api_key = await key_manager.get_available_key()
-                    if api_key:
-                        valid_keys = [api_key]
+                # 创建并发任务
+                def launch(api_key):
+                    return process_nonstream_request(
+                        chat_request,
+                        contents,
+                        system_instruction,
+                        api_key,
+                        response_cache_manager,
+                        cfg,
+                        cache_key,
+                        key_manager
+                    )
+                # 密钥在尝试真正发出时才取出，对冲模式下未发出的尝试不占用密钥和重试次数
+                attempts = HedgedAttempts(key_manager.checkout_keys, batch_num, launch, chat_request.model, cfg)
                 
                 # 如果没有获取到任何有效密钥，跳出循环
-                if not valid_keys:
+                if not await attempts.start():
                     break
-                    
-                # 更新当前尝试次数
-                current_try_num += len(valid_keys)
                 
-                # 创建并发任务
-                tasks = []
-                tasks_map = {}
-                for api_key in valid_keys:
-                    # 记录当前尝试的密钥信息
-                    log('info', f"非流式请求开始，使用密钥: {api_key[:8]}...", 
-                        extra={'key': api_key[:8], 'request_type': 'non-stream', 'model': chat_request.model})
-                    
-                    # 创建任务
-                    task = asyncio.create_task(
-                        process_nonstream_request(
-                            chat_request,
-                            contents,
-                            system_instruction,
-                            api_key,
-                            response_cache_manager,
-                            safety_settings,
-                            safety_settings_g2,
-                            cache_key,
-                            key_manager
-                        )
-                    )
-                    tasks.append((api_key, task))
-                    tasks_map[task] = api_key
-                
-                # 等待所有任务完成或找到成功响应
+                # 等待任务完成或找到成功响应
                 success = False
                 keepalive_counter = 0
-                while tasks and not success:
+                while attempts and not success:
                     # 短时间等待任务完成
-                    done, pending = await asyncio.wait(
-                        [task for _, task in tasks],
-                        timeout=settings.NONSTREAM_KEEPALIVE_INTERVAL,
-                        return_when=asyncio.FIRST_COMPLETED
-                    )
+                    done = await attempts.wait(timeout=cfg.NONSTREAM_KEEPALIVE_INTERVAL)
                     
                     # 如果没有任务完成，发送保活消息
                     if not done:
@@ -508,16 +395,22 @@ async def process_nonstream_with_keepalive_stream(
                         continue
                     
                     # 检查已完成的任务是否成功
-                    for task in done:
-                        api_key = tasks_map[task]
+                    for api_key, task in done:
                         try:
                             status = task.result()                    
                             # 如果有成功响应内容
                             if status == "success" :  
+                                # 先取出缓存的响应，确认取到后再取消其余尝试
+                                cached_response, cache_hit = await response_cache_manager.get_and_remove(cache_key)
+                                if cached_response is None:
+                                    log('warning', f"成功响应已被其他相同请求取走，继续等待其余尝试",
+                                        extra={'key': api_key[:8],'request_type': 'non-stream', 'model': chat_request.model})
+                                    continue
                                 success = True
+                                attempts.settle(task)
                                 log('info', f"非流式请求成功", 
                                     extra={'key': api_key[:8],'request_type': 'non-stream', 'model': chat_request.model})
-                                cached_response, cache_hit = await response_cache_manager.get_and_remove(cache_key)
+                                key_manager.report_success(api_key)
                                 
                                 # 发送最终的非流式响应
                                 if is_gemini:
@@ -531,25 +424,26 @@ async def process_nonstream_with_keepalive_stream(
                             elif status == "empty":
                                 # 增加空响应计数
                                 empty_response_count += 1
-                                log('warning', f"空响应计数: {empty_response_count}/{settings.MAX_EMPTY_RESPONSES}",
+                                metrics.empty_responses_total.labels(chat_request.model, "non-stream").inc()
+                                log('warning', f"空响应计数: {empty_response_count}/{cfg.MAX_EMPTY_RESPONSES}",
                                     extra={'key': api_key[:8], 'request_type': 'non-stream', 'model': chat_request.model})
                         
                         except Exception as e:
                             await handle_gemini_error(e, api_key, key_manager)
+                
+                # 更新当前尝试次数，只计入实际发出的尝试
+                current_try_num += attempts.launched
                         
-                        # 更新任务列表，移除已完成的任务
-                        tasks = [(k, t) for k, t in tasks if not t.done()]
-                        
-                # 如果当前批次没有成功响应，并且还有密钥可用，则继续尝试
-                if not success and valid_keys:
+                # 如果当前批次没有成功响应，则继续尝试
+                if not success:
                     # 增加并发数，但不超过最大并发数
-                    current_concurrent = min(current_concurrent + settings.INCREASE_CONCURRENT_ON_FAILURE, settings.MAX_CONCURRENT_REQUESTS)
+                    current_concurrent = min(current_concurrent + cfg.INCREASE_CONCURRENT_ON_FAILURE, cfg.MAX_CONCURRENT_REQUESTS)
                     log('info', f"所有并发请求失败或返回空响应，增加并发数至: {current_concurrent}", 
                         extra={'request_type': 'non-stream', 'model': chat_request.model})
                 
                 # 如果空响应次数达到限制，跳出循环，并返回酒馆正常响应(包含错误信息)
-                if empty_response_count >= settings.MAX_EMPTY_RESPONSES:
-                    log('warning', f"空响应次数达到限制 ({empty_response_count}/{settings.MAX_EMPTY_RESPONSES})，停止轮询",
+                if empty_response_count >= cfg.MAX_EMPTY_RESPONSES:
+                    log('warning', f"空响应次数达到限制 ({empty_response_count}/{cfg.MAX_EMPTY_RESPONSES})，停止轮询",
                         extra={'request_type': 'non-stream', 'model': chat_request.model})
                     
                     if is_gemini :
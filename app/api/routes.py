@@ -1,7 +1,7 @@
 import json
 from typing import Optional, Union
 from fastapi import APIRouter, Body, HTTPException, Path, Query, Request, Depends, status, Header
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from app.services import GeminiClient
 from app.utils import protect_from_abuse,generate_cache_key,openAI_from_text,log
 from app.utils.response import openAI_from_Gemini
@@ -9,78 +9,77 @@ from app.utils.auth import custom_verify_password
 from .stream_handlers import process_stream_request
 from .nonstream_handlers import process_request, process_nonstream_with_keepalive_stream
 from app.models.schemas import ChatCompletionRequest, ChatCompletionResponse, ModelList, AIRequest, ChatRequestGemini
-import app.config.settings as settings
+from app.config.snapshot import current_settings
 import asyncio
-from app.vertex.routes import chat_api, models_api
+import time
+from app.utils import metrics
+from app.utils.lazy_import import lazy_import
 from app.vertex.models import OpenAIRequest, OpenAIMessage
 
+# Vertex 路由依赖 google-genai、openai 等重量级 SDK，第一次处理 Vertex 请求时才导入
+chat_api = lazy_import("app.vertex.routes.chat_api")
+models_api = lazy_import("app.vertex.routes.models_api")
+model_loader = lazy_import("app.vertex.model_loader")
+
+# Vertex 模型名的前缀和变体后缀，计算指标标签时去掉后再与模型列表比较
+VERTEX_MODEL_PREFIXES = ("[EXPRESS] ", "[PAY]")
+VERTEX_MODEL_SUFFIXES = ("-openai", "-auto", "-search", "-encrypt-full", "-encrypt", "-nothinking", "-max")
+
 # 创建路由器
 router = APIRouter()
 
 # 全局变量引用 - 这些将在main.py中初始化并传递给路由
+# 配置项不再复制到这里，每个请求在入口通过 current_settings() 取一次配置快照
 key_manager = None
 response_cache_manager = None
-active_requests_manager = None
-safety_settings = None
-safety_settings_g2 = None
+request_coalescer = None
 current_api_key = None
-FAKE_STREAMING = None
-FAKE_STREAMING_INTERVAL = None
-PASSWORD = None
-MAX_REQUESTS_PER_MINUTE = None
-MAX_REQUESTS_PER_DAY_PER_IP = None
 
 # 初始化路由器的函数
 def init_router(
     _key_manager,
     _response_cache_manager,
-    _active_requests_manager,
-    _safety_settings,
-    _safety_settings_g2,
-    _current_api_key,
-    _fake_streaming,
-    _fake_streaming_interval,
-    _password,
-    _max_requests_per_minute,
-    _max_requests_per_day_per_ip
+    _request_coalescer,
+    _current_api_key
 ):
-    global key_manager, response_cache_manager, active_requests_manager
-    global safety_settings, safety_settings_g2, current_api_key
-    global FAKE_STREAMING, FAKE_STREAMING_INTERVAL
-    global PASSWORD, MAX_REQUESTS_PER_MINUTE, MAX_REQUESTS_PER_DAY_PER_IP
+    global key_manager, response_cache_manager, request_coalescer, current_api_key
     
     key_manager = _key_manager
     response_cache_manager = _response_cache_manager
-    active_requests_manager = _active_requests_manager
-    safety_settings = _safety_settings
-    safety_settings_g2 = _safety_settings_g2
+    request_coalescer = _request_coalescer
     current_api_key = _current_api_key
-    FAKE_STREAMING = _fake_streaming
-    FAKE_STREAMING_INTERVAL = _fake_streaming_interval
-    PASSWORD = _password
-    MAX_REQUESTS_PER_MINUTE = _max_requests_per_minute
-    MAX_REQUESTS_PER_DAY_PER_IP = _max_requests_per_day_per_ip
 
 async def verify_user_agent(request: Request):
+    cfg = current_settings()
     user_agent = request.headers.get("User-Agent", "")
     log('info', f"[DEBUG] User-Agent验证开始",
-        extra={'user_agent': user_agent, 'whitelist_configured': bool(settings.WHITELIST_USER_AGENT),
-               'whitelist_content': list(settings.WHITELIST_USER_AGENT) if settings.WHITELIST_USER_AGENT else []})
+        extra={'user_agent': user_agent, 'whitelist_configured': bool(cfg.whitelist_user_agent),
+               'whitelist_content': list(cfg.whitelist_user_agent)},
+        category='auth')
     
-    if not settings.WHITELIST_USER_AGENT:
-        log('info', f"[DEBUG] User-Agent白名单未配置，跳过验证")
+    if not cfg.whitelist_user_agent:
+        log('info', f"[DEBUG] User-Agent白名单未配置，跳过验证", category='auth')
         return
     
     log('info', f"[DEBUG] User-Agent白名单已配置，开始验证",
-        extra={'user_agent_lower': user_agent.lower(), 'whitelist': list(settings.WHITELIST_USER_AGENT)})
+        extra={'user_agent_lower': user_agent.lower(), 'whitelist': list(cfg.whitelist_user_agent)},
+        category='auth')
     
-    if user_agent.lower() not in settings.WHITELIST_USER_AGENT:
+    if user_agent.lower() not in cfg.whitelist_user_agent:
         log('error', f"[DEBUG] User-Agent验证失败，返回403错误",
             extra={'user_agent': user_agent, 'user_agent_lower': user_agent.lower(),
-                   'whitelist': list(settings.WHITELIST_USER_AGENT)})
+                   'whitelist': list(cfg.whitelist_user_agent)})
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not allowed client")
     
-    log('info', f"[DEBUG] User-Agent验证通过")
+    log('info', f"[DEBUG] User-Agent验证通过", category='auth')
+
+def request_mode(is_stream: bool, is_gemini: bool, fake_streaming: bool) -> str:
+    """请求模式标签：gemini-native / stream / fake-stream / non-stream"""
+    if is_gemini:
+        return "gemini-native"
+    if not is_stream:
+        return "non-stream"
+    return "fake-stream" if fake_streaming else "stream"
 
 # todo : 添加 gemini 支持(流式返回)
 async def get_cache(cache_key,is_stream: bool,is_gemini=False):
@@ -110,10 +109,7 @@ async def get_cache(cache_key,is_stream: bool,is_gemini=False):
 @router.get("/aistudio/models",response_model=ModelList)
 async def aistudio_list_models(_ = Depends(custom_verify_password),
                                _2 = Depends(verify_user_agent)):
-    if settings.WHITELIST_MODELS:
-        filtered_models = [model for model in GeminiClient.AVAILABLE_MODELS if model in settings.WHITELIST_MODELS]
-    else:
-        filtered_models = [model for model in GeminiClient.AVAILABLE_MODELS if model not in settings.BLOCKED_MODELS]
+    filtered_models = current_settings().filter_models(GeminiClient.AVAILABLE_MODELS)
     return ModelList(data=[{"id": model, "object": "model", "created": 1678888888, "owned_by": "organization-owner"} for model in filtered_models])
 
 @router.get("/vertex/models",response_model=ModelList)
@@ -129,7 +125,7 @@ async def vertex_list_models(request: Request,
 async def list_models(request: Request,
                       _ = Depends(custom_verify_password),
                       _2 = Depends(verify_user_agent)):
-    if settings.ENABLE_VERTEX:
+    if current_settings().ENABLE_VERTEX:
         return await vertex_list_models(request, _, _2)
     return await aistudio_list_models(_, _2)
 
@@ -140,6 +136,10 @@ async def aistudio_chat_completions(
     _ = Depends(custom_verify_password),
     _2 = Depends(verify_user_agent),
 ):
+    start = time.perf_counter()
+    # 本次请求全程使用同一份配置快照
+    cfg = current_settings()
+    model = metrics.model_label(request.model, GeminiClient.AVAILABLE_MODELS)
     format_type = getattr(request, 'format_type', None)
     if format_type and (format_type == "gemini"):
         is_gemini = True
@@ -147,16 +147,16 @@ async def aistudio_chat_completions(
         is_gemini = False
     
     # 生成缓存键 - 用于匹配请求内容对应缓存
-    if settings.PRECISE_CACHE:
+    if cfg.PRECISE_CACHE:
         cache_key = generate_cache_key(request, is_gemini = is_gemini)
     else:    
-        cache_key = generate_cache_key(request, last_n_messages = settings.CALCULATE_CACHE_ENTRIES,is_gemini = is_gemini)
+        cache_key = generate_cache_key(request, last_n_messages = cfg.CALCULATE_CACHE_ENTRIES,is_gemini = is_gemini)
     
     # 请求前基本检查
     await protect_from_abuse(
         http_request, 
-        settings.MAX_REQUESTS_PER_MINUTE, 
-        settings.MAX_REQUESTS_PER_DAY_PER_IP)
+        cfg.MAX_REQUESTS_PER_MINUTE, 
+        cfg.MAX_REQUESTS_PER_DAY_PER_IP)
     
     if request.model not in GeminiClient.AVAILABLE_MODELS:
         log('error', "无效的模型", 
@@ -167,106 +167,56 @@ async def aistudio_chat_completions(
     
     # 记录请求缓存键信息
     log('info', f"请求缓存键: {cache_key[:8]}...", 
-        extra={'request_type': 'non-stream', 'model': request.model})
+        extra={'request_type': 'non-stream', 'model': request.model}, category='cache_key')
     
     # 检查缓存是否存在，如果存在，返回缓存
+    mode = request_mode(request.stream, is_gemini, cfg.FAKE_STREAMING)
     cached_response = await get_cache(cache_key, is_stream = request.stream,is_gemini=is_gemini)
+    metrics.cache_requests_total.labels("hit" if cached_response else "miss").inc()
     if cached_response :
-        return cached_response
-    
-    if not settings.PUBLIC_MODE:
-        # 构建包含缓存键的活跃请求池键
-        pool_key = f"{cache_key}"
-        
-        # 查找所有使用相同缓存键的活跃任务
-        active_task = active_requests_manager.get(pool_key)
-        if active_task and not active_task.done():
-            log('info', f"发现相同请求的进行中任务", 
-                extra={'request_type': 'stream' if request.stream else "non-stream", 'model': request.model})
-            
-            # 等待已有任务完成
-            try:
-                # 设置超时，避免无限等待
-                await asyncio.wait_for(active_task, timeout=240)
-                
-                # 使用任务结果
-                if active_task.done() and not active_task.cancelled():
-                    
-                    result = active_task.result()
-                    active_requests_manager.remove(pool_key)
-                    if result:
-                        return result
-            
-            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
-                # 任务超时或被取消的情况下，记录日志然后让代码继续执行
-                error_type = "超时" if isinstance(e, asyncio.TimeoutError) else "被取消"
-                log('warning', f"等待已有任务{error_type}: {pool_key}", 
-                    extra={'request_type': 'non-stream', 'model': request.model})
-                
-                # 从活跃请求池移除该任务
-                if active_task.done() or active_task.cancelled():
-                    active_requests_manager.remove(pool_key)
-                    log('info', f"已从活跃请求池移除{error_type}任务: {pool_key}", 
-                        extra={'request_type': 'non-stream'})
+        return metrics.track_response(cached_response, "aistudio", mode, model, start)
     
-        
-    if request.stream:
-        # 流式请求处理任务
-        process_task = asyncio.create_task(
-            process_stream_request(
+    async def run_request():
+        if request.stream:
+            # 流式请求处理
+            return await process_stream_request(
                 chat_request = request, 
                 key_manager=key_manager,
                 response_cache_manager = response_cache_manager,
-                safety_settings = safety_settings,
-                safety_settings_g2 = safety_settings_g2,
+                cfg = cfg,
                 cache_key = cache_key
             )
-        )
-    
-    else:
         # 检查是否启用非流式保活功能
-        if settings.NONSTREAM_KEEPALIVE_ENABLED:
+        if cfg.NONSTREAM_KEEPALIVE_ENABLED:
             # 使用带保活功能的非流式请求处理
-            process_task = asyncio.create_task(
-                process_nonstream_with_keepalive_stream(
-                    chat_request = request,
-                    key_manager = key_manager,
-                    response_cache_manager = response_cache_manager,
-                    safety_settings = safety_settings,
-                    safety_settings_g2 = safety_settings_g2,
-                    cache_key = cache_key,
-                    is_gemini = is_gemini
-                )
-            )
-        else:
-            # 创建非流式请求处理任务
-            process_task = asyncio.create_task(
-                process_request(
-                    chat_request = request,
-                    key_manager = key_manager,
-                    response_cache_manager = response_cache_manager,
-                    safety_settings = safety_settings,
-                    safety_settings_g2 = safety_settings_g2,
-                    cache_key = cache_key
-                )
+            return await process_nonstream_with_keepalive_stream(
+                chat_request = request,
+                key_manager = key_manager,
+                response_cache_manager = response_cache_manager,
+                cfg = cfg,
+                cache_key = cache_key,
+                is_gemini = is_gemini
             )
+        # 非流式请求处理
+        return await process_request(
+            chat_request = request,
+            key_manager = key_manager,
+            response_cache_manager = response_cache_manager,
+            cfg = cfg,
+            cache_key = cache_key
+        )
 
-    if not settings.PUBLIC_MODE:
-        # 将任务添加到活跃请求池
-        active_requests_manager.add(pool_key, process_task)
-    
-    # 等待任务完成
     try:
-        response = await process_task
-        if not settings.PUBLIC_MODE:
-            active_requests_manager.remove(pool_key)
-        
-        return response
+        # 真流式请求由 stream_hub 按完整请求内容共享上游流，不再经过合并器
+        if cfg.PUBLIC_MODE or (request.stream and not cfg.FAKE_STREAMING):
+            response = await run_request()
+        else:
+            # 相同内容、相同返回格式的并发请求合并为一次上游调用
+            flight_key = f"{cache_key}:{'gemini' if is_gemini else 'openai'}:{'stream' if request.stream else 'non-stream'}"
+            response = await request_coalescer.run(flight_key, run_request)
+        return metrics.track_response(response, "aistudio", mode, model, start)
     except Exception as e:
-        if not settings.PUBLIC_MODE:
-            # 如果任务失败，从活跃请求池中移除
-            active_requests_manager.remove(pool_key)
-        
+        metrics.requests_total.labels("aistudio", mode, model, "error").inc()
         # 检查是否已有缓存的结果（可能是由另一个任务创建的）
         cached_response = await get_cache(cache_key, is_stream = request.stream,is_gemini=is_gemini)
         if cached_response :
@@ -275,6 +225,17 @@ async def aistudio_chat_completions(
         # 发送错误信息给客户端
         raise HTTPException(status_code=500, detail=f" hajimi 服务器内部处理时发生错误\n具体原因:{e}")
 
+def vertex_model_label(model: str) -> str:
+    """Vertex 请求的指标模型标签：去掉前缀和变体后缀后不在已加载的模型列表中时记为 other"""
+    base = model
+    for prefix in VERTEX_MODEL_PREFIXES:
+        base = base.removeprefix(prefix)
+    for suffix in VERTEX_MODEL_SUFFIXES:
+        if base.endswith(suffix):
+            base = base[:-len(suffix)]
+            break
+    return model if base in model_loader.cached_model_ids() else "other"
+
 @router.post("/vertex/chat/completions", response_model=ChatCompletionResponse)
 async def vertex_chat_completions(
     request: ChatCompletionRequest, 
@@ -311,7 +272,16 @@ async def vertex_chat_completions(
     )
     
     # 调用vertex/routes/chat_api的实现
-    return await chat_api.chat_completions(http_request, vertex_request, current_api_key)
+    start = time.perf_counter()
+    backend = "express" if request.model.startswith("[EXPRESS]") else "vertex"
+    mode = request_mode(request.stream, False, current_settings().FAKE_STREAMING)
+    model = vertex_model_label(request.model)
+    try:
+        response = await chat_api.chat_completions(http_request, vertex_request, current_api_key)
+    except Exception:
+        metrics.requests_total.labels(backend, mode, model, "error").inc()
+        raise
+    return metrics.track_response(response, backend, mode, model, start)
 
 @router.post("/v1/chat/completions", response_model=ChatCompletionResponse)
 @router.post("/chat/completions", response_model=ChatCompletionResponse)
@@ -322,7 +292,7 @@ async def chat_completions(
     _du = Depends(verify_user_agent),
 ):
     """处理API请求的主函数，根据需要处理流式或非流式请求"""
-    if settings.ENABLE_VERTEX:
+    if current_settings().ENABLE_VERTEX:
         return await vertex_chat_completions(request, http_request, _dp, _du)
     return await aistudio_chat_completions(request, http_request, _dp, _du)
 
@@ -349,3 +319,12 @@ async def gemini_chat_completions(
     geminiRequest = AIRequest(payload=payload,model=model_name,stream=is_stream,format_type='gemini')
     return await aistudio_chat_completions(geminiRequest, request, _dp, _du)
         
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    """Prometheus 文本格式的指标"""
+    if key_manager:
+        metrics.key_cooldowns.labels().set(len(key_manager.get_cooldowns()))
+    if request_coalescer:
+        metrics.coalescer_flights.labels().set(len(request_coalescer.flights))
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
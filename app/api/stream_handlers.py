@@ -5,15 +5,25 @@ from app.models.schemas import ChatCompletionRequest
 from app.services import GeminiClient
 from app.utils import handle_gemini_error, update_api_call_stats,log,openAI_from_text
 from app.utils.response import openAI_from_Gemini,gemini_from_text
-from app.utils.stats import get_api_key_usage
+from app.utils.cache import generate_payload_key
+from app.utils.stream_hub import stream_hub
+from app.utils import metrics
 import app.config.settings as settings
 
+# 真流式上游驱动的结束标记
+STREAM_EMPTY_LIMIT = "empty_limit"
+STREAM_FAILED = "failed"
+
+def stream_error_event(message: str) -> str:
+    """流式响应中途出错时发送的错误事件，不附加 [DONE]，客户端据此判断响应不完整"""
+    payload = {"error": {"message": message, "type": "stream_error"}}
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
 async def stream_response_generator(
     chat_request,
     key_manager,
     response_cache_manager,
-    safety_settings,
-    safety_settings_g2,
+    cfg,
     cache_key: str
 ):
     format_type = getattr(chat_request, 'format_type', None)
@@ -23,10 +33,10 @@ async def stream_response_generator(
     else:
         is_gemini = False
         # 转换消息格式
-        contents, system_instruction = GeminiClient(api_key="").convert_messages(chat_request.messages,model=chat_request.model)
+        contents, system_instruction = GeminiClient(api_key="", cfg=cfg).convert_messages(chat_request.messages,model=chat_request.model)
     # 设置初始并发数
-    current_concurrent = settings.CONCURRENT_REQUESTS
-    max_retry_num = settings.MAX_RETRY_NUM
+    current_concurrent = cfg.CONCURRENT_REQUESTS
+    max_retry_num = cfg.MAX_RETRY_NUM
     
     # 当前请求次数
     current_try_num = 0
@@ -35,45 +45,12 @@ async def stream_response_generator(
     empty_response_count = 0
     
     # (假流式) 尝试使用不同API密钥，直到达到最大重试次数或空响应限制
-    while (settings.FAKE_STREAMING and (current_try_num < max_retry_num) and (empty_response_count < settings.MAX_EMPTY_RESPONSES)):
+    while (cfg.FAKE_STREAMING and (current_try_num < max_retry_num) and (empty_response_count < cfg.MAX_EMPTY_RESPONSES)):
         # 获取当前批次的密钥数量
         batch_num = min(max_retry_num - current_try_num, current_concurrent)
         
         # 获取当前批次的密钥
-        valid_keys = []
-        checked_keys = set()  # 用于记录已检查过的密钥
-        all_keys_checked = False  # 标记是否已检查所有密钥
-        
-        # 尝试获取足够数量的有效密钥
-        while len(valid_keys) < batch_num:
-            api_key = await key_manager.get_available_key()
-            if not api_key:
-                break
-                
-            # 如果这个密钥已经检查过，说明已经检查了所有密钥
-            if api_key in checked_keys:
-                all_keys_checked = True
-                break
-            
-            checked_keys.add(api_key)
-            # 获取API密钥的调用次数
-            usage = await get_api_key_usage(settings.api_call_stats, api_key)
-            # 如果调用次数小于限制，则添加到有效密钥列表
-            if usage < settings.API_KEY_DAILY_LIMIT:
-                valid_keys.append(api_key)
-            else:
-                log('warning', f"API密钥 {api_key[:8]}... 已达到每日调用限制 ({usage}/{settings.API_KEY_DAILY_LIMIT})",
-                    extra={'key': api_key[:8], 'request_type': 'stream', 'model': chat_request.model})
-        
-        # 如果已经检查了所有密钥且没有找到有效密钥，则重置密钥栈
-        if all_keys_checked and not valid_keys:
-            log('warning', "所有API密钥已达到每日调用限制，重置密钥栈",
-                extra={'request_type': 'stream', 'model': chat_request.model})
-            key_manager._reset_key_stack()
-            # 重置后重新获取一个密钥
-            api_key = await key_manager.get_available_key()
-            if api_key:
-                valid_keys = [api_key]
+        valid_keys = await key_manager.checkout_keys(batch_num)
         
         # 如果没有获取到任何有效密钥，跳出循环
         if not valid_keys:
@@ -97,8 +74,7 @@ async def stream_response_generator(
                     contents,
                     response_cache_manager,
                     system_instruction,
-                    safety_settings,
-                    safety_settings_g2,
+                    cfg,
                     cache_key,
                     key_manager
                 )
@@ -113,7 +89,7 @@ async def stream_response_generator(
             # 等待任务完成
             done, pending = await asyncio.wait(
                 [task for _, task in tasks],
-                timeout=settings.FAKE_STREAMING_INTERVAL,
+                timeout=cfg.FAKE_STREAMING_INTERVAL,
                 return_when=asyncio.FIRST_COMPLETED
             )
             
@@ -135,6 +111,8 @@ async def stream_response_generator(
                         if status == "success" :
                             log('info', f"假流式请求成功",
                                 extra={'key': api_key[:8],'request_type': "fake-stream", 'model': chat_request.model})
+                            key_manager.report_success(api_key)
+                            metrics.attempts_per_request.labels("fake-stream").observe(current_try_num)
                             cached_response, cache_hit = await response_cache_manager.get_and_remove(cache_key)
                             if cache_hit and cached_response:
                                 success = True  # 只有在成功获取缓存后才设置 success
@@ -153,7 +131,8 @@ async def stream_response_generator(
                         elif status == "empty":
                             # 增加空响应计数
                             empty_response_count += 1
-                            log('warning', f"空响应计数: {empty_response_count}/{settings.MAX_EMPTY_RESPONSES}",
+                            metrics.empty_responses_total.labels(chat_request.model, "fake-stream").inc()
+                            log('warning', f"空响应计数: {empty_response_count}/{cfg.MAX_EMPTY_RESPONSES}",
                                 extra={'key': api_key[:8], 'request_type': 'stream', 'model': chat_request.model})
                         
                     except Exception as e:
@@ -166,8 +145,8 @@ async def stream_response_generator(
                 return
             
             # 如果空响应次数达到限制，跳出循环
-            if empty_response_count >= settings.MAX_EMPTY_RESPONSES:
-                log('warning', f"空响应次数达到限制 ({empty_response_count}/{settings.MAX_EMPTY_RESPONSES})，停止轮询",
+            if empty_response_count >= cfg.MAX_EMPTY_RESPONSES:
+                log('warning', f"空响应次数达到限制 ({empty_response_count}/{cfg.MAX_EMPTY_RESPONSES})，停止轮询",
                     extra={'request_type': 'fake-stream', 'model': chat_request.model})
                 if is_gemini :
                     yield gemini_from_text(content="空响应次数达到上限\n请修改输入提示词",finish_reason="STOP",stream=True)
@@ -183,47 +162,78 @@ async def stream_response_generator(
         # 如果所有请求都失败，增加并发数并继续尝试
         if not success and valid_keys:
             # 增加并发数，但不超过最大并发数
-            current_concurrent = min(current_concurrent + settings.INCREASE_CONCURRENT_ON_FAILURE, settings.MAX_CONCURRENT_REQUESTS)
+            current_concurrent = min(current_concurrent + cfg.INCREASE_CONCURRENT_ON_FAILURE, cfg.MAX_CONCURRENT_REQUESTS)
             log('info', f"所有假流式请求失败，增加并发数至: {current_concurrent}", 
                 extra={'request_type': 'stream', 'model': chat_request.model})
 
-    # (真流式) 尝试使用不同API密钥，直到达到最大重试次数或空响应限制
-    while (not settings.FAKE_STREAMING and (current_try_num < max_retry_num) and (empty_response_count < settings.MAX_EMPTY_RESPONSES)):
-        # 获取当前批次的密钥
-        valid_keys = []
-        checked_keys = set()  # 用于记录已检查过的密钥
-        all_keys_checked = False  # 标记是否已检查所有密钥
-        
-        # 尝试获取一个有效密钥
-        while len(valid_keys) < 1:
-            api_key = await key_manager.get_available_key()
-            if not api_key:
-                break
+    # (真流式) 请求内容完全相同的并发请求共享同一路上游流；公开模式下不共享
+    if not cfg.FAKE_STREAMING:
+        open_upstream = lambda: true_stream_chunks(
+            chat_request,
+            contents,
+            system_instruction,
+            key_manager,
+            cfg
+        )
+        if cfg.PUBLIC_MODE:
+            upstream = open_upstream()
+        else:
+            # 配置版本也计入键，配置修改后的请求不会收到按旧配置生成的结果
+            upstream = stream_hub.subscribe(f"{generate_payload_key(chat_request)}:{cfg.version}", open_upstream)
+        try:
+            async for chunk in upstream:
+                if chunk is STREAM_EMPTY_LIMIT:
+                    if is_gemini:
+                        yield gemini_from_text(content="空响应次数达到上限\n请修改输入提示词",finish_reason="STOP",stream=True)
+                    else:
+                        yield openAI_from_text(model=chat_request.model,content="空响应次数达到上限\n请修改输入提示词",finish_reason="stop",stream=True)
+                    yield "data: [DONE]\n\n"
+                    return
+                if chunk is STREAM_FAILED:
+                    break
+
+                if is_gemini:
+                    json_payload = json.dumps(chunk.data, ensure_ascii=False)
+                    data = f"data: {json_payload}\n\n"
+                else:
+                    data = openAI_from_Gemini(chunk,stream=True)
                 
-            # 如果这个密钥已经检查过，说明已经检查了所有密钥
-            if api_key in checked_keys:
-                all_keys_checked = True
-                break
-            
-            checked_keys.add(api_key)
-            # 获取API密钥的调用次数
-            usage = await get_api_key_usage(settings.api_call_stats, api_key)
-            # 如果调用次数小于限制，则添加到有效密钥列表
-            if usage < settings.API_KEY_DAILY_LIMIT:
-                valid_keys.append(api_key)
+                # log('info', f"流式响应发送数据: {data}")
+                yield data
             else:
-                log('warning', f"API密钥 {api_key[:8]}... 已达到每日调用限制 ({usage}/{settings.API_KEY_DAILY_LIMIT})",
-                    extra={'key': api_key[:8], 'request_type': 'stream', 'model': chat_request.model})
-        
-        # 如果已经检查了所有密钥且没有找到有效密钥，则重置密钥栈
-        if all_keys_checked and not valid_keys:
-            log('warning', "所有API密钥已达到每日调用限制，重置密钥栈",
+                return
+        except Exception as e:
+            # 部分内容可能已经发出，以错误事件结束本次响应，不再追加"所有密钥均失败"的提示
+            log('error', f"共享上游流中断: {e}",
                 extra={'request_type': 'stream', 'model': chat_request.model})
-            key_manager._reset_key_stack()
-            # 重置后重新获取一个密钥
-            api_key = await key_manager.get_available_key()
-            if api_key:
-                valid_keys = [api_key]
+            yield stream_error_event(f"流式响应中断: {e}")
+            return
+    
+    # 所有API密钥都尝试失败的处理
+    log('error', "所有 API 密钥均请求失败，请稍后重试",
+        extra={'key': 'ALL', 'request_type': 'stream', 'model': chat_request.model})
+    
+    if is_gemini:
+        yield gemini_from_text(content="所有API密钥均请求失败\n具体错误请查看轮询日志",finish_reason="STOP",stream=True)
+    else:
+        yield openAI_from_text(model=chat_request.model,content="所有API密钥均请求失败\n具体错误请查看轮询日志",finish_reason="stop",stream=True)
+    yield "data: [DONE]\n\n"
+
+# 真流式模式的上游驱动
+async def true_stream_chunks(chat_request, contents, system_instruction, key_manager, cfg):
+    """
+    尝试使用不同API密钥调用上游流式接口，直到达到最大重试次数或空响应限制。
+
+    逐个产出 GeminiResponseWrapper；空响应次数达到上限时产出 STREAM_EMPTY_LIMIT，
+    所有密钥均失败时产出 STREAM_FAILED。由 stream_hub 在后台驱动，结果广播给所有订阅者。
+    """
+    max_retry_num = cfg.MAX_RETRY_NUM
+    current_try_num = 0
+    empty_response_count = 0
+
+    while (current_try_num < max_retry_num) and (empty_response_count < cfg.MAX_EMPTY_RESPONSES):
+        # 获取当前批次的密钥
+        valid_keys = await key_manager.checkout_keys(1)
         
         # 如果没有获取到任何有效密钥，跳出循环
         if not valid_keys:
@@ -238,13 +248,13 @@ async def stream_response_generator(
         success = False
         token = 0
         try:
-            client = GeminiClient(api_key)
+            client = GeminiClient(api_key, cfg=cfg)
             
             # 获取流式响应
             stream_generator = client.stream_chat(
                 chat_request,
                 contents,
-                safety_settings_g2 if 'gemini-2.5' in chat_request.model else safety_settings,
+                cfg.safety_settings(chat_request.model),
                 system_instruction
             )
             # 处理流式响应
@@ -254,21 +264,14 @@ async def stream_response_generator(
                     if chunk.total_token_count:
                         token = int(chunk.total_token_count)
                     success = True
-                    
-                    if is_gemini:
-                        json_payload = json.dumps(chunk.data, ensure_ascii=False)
-                        data = f"data: {json_payload}\n\n"
-                    else:
-                        data = openAI_from_Gemini(chunk,stream=True)
-                    
-                    # log('info', f"流式响应发送数据: {data}")
-                    yield data
+                    yield chunk
                     
                 else:
-                    log('warning', f"流式请求返回空响应，空响应计数: {empty_response_count}/{settings.MAX_EMPTY_RESPONSES}",
+                    log('warning', f"流式请求返回空响应，空响应计数: {empty_response_count}/{cfg.MAX_EMPTY_RESPONSES}",
                         extra={'key': api_key[:8], 'request_type': 'stream', 'model': chat_request.model})
                     # 增加空响应计数
                     empty_response_count += 1
+                    metrics.empty_responses_total.labels(chat_request.model, "stream").inc()
                     await update_api_call_stats(
                         settings.api_call_stats, 
                         endpoint=api_key, 
@@ -282,51 +285,40 @@ async def stream_response_generator(
             log('error', f"流式响应: API密钥 {api_key[:8]}... 请求失败: {error_detail}",
                 extra={'key': api_key[:8], 'request_type': 'stream', 'model': chat_request.model})
         finally: 
-            # 如果成功获取相应，更新API调用统计
+            # 如果成功获取相应，更新API调用统计（客户端中途断开时同样记录）
             if success:
+                key_manager.report_success(api_key)
+                metrics.attempts_per_request.labels("stream").observe(current_try_num)
                 await update_api_call_stats(
                     settings.api_call_stats, 
                     endpoint=api_key, 
                     model=chat_request.model,
                     token=token
                 )
-                return
+
+        if success:
+            return
             
-            # 如果空响应次数达到限制，跳出循环
-            if empty_response_count >= settings.MAX_EMPTY_RESPONSES:
-                
-                log('warning', f"空响应次数达到限制 ({empty_response_count}/{settings.MAX_EMPTY_RESPONSES})，停止轮询",
-                    extra={'request_type': 'stream', 'model': chat_request.model})
-                
-                if is_gemini:
-                    yield gemini_from_text(content="空响应次数达到上限\n请修改输入提示词",finish_reason="STOP",stream=True)
-                else:
-                    yield openAI_from_text(model=chat_request.model,content="空响应次数达到上限\n请修改输入提示词",finish_reason="stop",stream=True)
-                yield "data: [DONE]\n\n"
-                
-                return
-    
-    # 所有API密钥都尝试失败的处理
-    log('error', "所有 API 密钥均请求失败，请稍后重试",
-        extra={'key': 'ALL', 'request_type': 'stream', 'model': chat_request.model})
-    
-    if is_gemini:
-        yield gemini_from_text(content="所有API密钥均请求失败\n具体错误请查看轮询日志",finish_reason="STOP",stream=True)
-    else:
-        yield openAI_from_text(model=chat_request.model,content="所有API密钥均请求失败\n具体错误请查看轮询日志",finish_reason="stop",stream=True)
-    yield "data: [DONE]\n\n"
+        # 如果空响应次数达到限制，跳出循环
+        if empty_response_count >= cfg.MAX_EMPTY_RESPONSES:
+            log('warning', f"空响应次数达到限制 ({empty_response_count}/{cfg.MAX_EMPTY_RESPONSES})，停止轮询",
+                extra={'request_type': 'stream', 'model': chat_request.model})
+            yield STREAM_EMPTY_LIMIT
+            return
+
+    yield STREAM_FAILED
 
 # 处理假流式模式
-async def handle_fake_streaming(api_key, chat_request, contents, response_cache_manager, system_instruction, safety_settings, safety_settings_g2, cache_key, key_manager):
+async def handle_fake_streaming(api_key, chat_request, contents, response_cache_manager, system_instruction, cfg, cache_key, key_manager):
     
     # 使用非流式请求内容
-    gemini_client = GeminiClient(api_key)
+    gemini_client = GeminiClient(api_key, cfg=cfg)
     
     gemini_task = asyncio.create_task(
         gemini_client.complete_chat( 
             chat_request,
             contents,
-            safety_settings_g2 if 'gemini-2.5' in chat_request.model else safety_settings,
+            cfg.safety_settings(chat_request.model),
             system_instruction
         )
     )
@@ -365,8 +357,7 @@ async def process_stream_request(
     chat_request: ChatCompletionRequest,
     key_manager,
     response_cache_manager,
-    safety_settings,
-    safety_settings_g2,
+    cfg,
     cache_key: str
 ) -> StreamingResponse:
     """处理流式API请求"""
@@ -375,7 +366,6 @@ async def process_stream_request(
                 chat_request,
                 key_manager,
                 response_cache_manager,
-                safety_settings,
-                safety_settings_g2,
+                cfg,
                 cache_key
             ), media_type="text/event-stream")
@@ -1,14 +1,19 @@
 import json
 import os
-import inspect
 import pathlib
-import mysql.connector
 import ast
+import queue
 import time
+import threading
 from abc import ABC, abstractmethod
-from typing import Any, Optional
+from contextlib import contextmanager
+from typing import Any, Optional, Tuple
 from app.config import settings
 from app.utils.logging import log
+from app.utils.lazy_import import lazy_import
+
+# 只有 PERSISTENCE_MODE=mysql 时才会用到，第一次连接时导入
+mysql_connector = lazy_import("mysql.connector")
 
 # 定义不应该被保存或加载的配置项
 EXCLUDED_SETTINGS = [
@@ -30,44 +35,223 @@ EXCLUDED_SETTINGS = [
     "MYSQL_PASSWORD",
     "MYSQL_DATABASE",
     "MYSQL_PORT",
+    "MYSQL_POOL_SIZE",
+    "USAGE_FLUSH_INTERVAL",
+    "USAGE_SNAPSHOT_INTERVAL",
+    "DASHBOARD_REFRESH_INTERVAL",
+    "SETTINGS_SAVE_DEBOUNCE",
 ]
 
+# 需要保存的配置项，保存时只读取这些字段，不再遍历整个 settings 模块
+PERSISTED_SETTINGS = (
+    # 基础配置
+    "GEMINI_API_KEYS",
+    "INVALID_API_KEYS",
+    "GEMINI_BASE_URL",
+    "FAKE_STREAMING",
+    "LOG_LEVEL",
+    "LOG_SAMPLE_RATES",
+    "LOG_AGGREGATE_INTERVAL",
+    "LOG_REPEAT_LIMIT",
+    # 并发与对冲请求
+    "CONCURRENT_REQUESTS",
+    "INCREASE_CONCURRENT_ON_FAILURE",
+    "MAX_CONCURRENT_REQUESTS",
+    "HEDGE_ENABLED",
+    "HEDGE_PERCENTILE",
+    "HEDGE_MIN_DELAY",
+    "HEDGE_DEFAULT_DELAY",
+    # 上游连接池与密钥检测
+    "HTTP2_ENABLED",
+    "HTTP_MAX_CONNECTIONS",
+    "HTTP_MAX_KEEPALIVE_CONNECTIONS",
+    "HTTP_KEEPALIVE_EXPIRY",
+    "HTTP_TIMEOUT",
+    "HTTP_CONNECT_TIMEOUT",
+    "KEY_CHECK_CONCURRENCY",
+    "KEY_CHECK_QPS",
+    "KEY_CHECK_TIMEOUT",
+    "STARTUP_TASK_TIMEOUT",
+    "STREAM_REPLAY_MAX_CHUNKS",
+    # 缓存
+    "CACHE_EXPIRY_TIME",
+    "MAX_CACHE_ENTRIES",
+    "MAX_CACHE_BYTES",
+    "CALCULATE_CACHE_ENTRIES",
+    "PRECISE_CACHE",
+    # Vertex
+    "ENABLE_VERTEX",
+    "GOOGLE_CREDENTIALS_JSON",
+    "ENABLE_VERTEX_EXPRESS",
+    "VERTEX_EXPRESS_API_KEY",
+    # 联网搜索、随机字符串、空响应重试
+    "search",
+    "RANDOM_STRING",
+    "RANDOM_STRING_LENGTH",
+    "MAX_EMPTY_RESPONSES",
+    # 访问限制与密钥使用限制
+    "MAX_RETRY_NUM",
+    "MAX_REQUESTS_PER_MINUTE",
+    "MAX_REQUESTS_PER_DAY_PER_IP",
+    "RATE_LIMIT_BACKEND",
+    "REDIS_URL",
+    "API_KEY_DAILY_LIMIT",
+    "KEY_COOLDOWN_BASE",
+    "KEY_COOLDOWN_MAX",
+    # 跨域
+    "ALLOWED_ORIGINS_STR",
+    "ALLOWED_ORIGINS",
+    # 假流式与保活
+    "FAKE_STREAMING_INTERVAL",
+    "FAKE_STREAMING_CHUNK_SIZE",
+    "FAKE_STREAMING_DELAY_PER_CHUNK",
+    "NONSTREAM_KEEPALIVE_ENABLED",
+    "NONSTREAM_KEEPALIVE_INTERVAL",
+)
+
+
+def collect_settings() -> dict:
+    """按 PERSISTED_SETTINGS 读取当前配置"""
+    return {name: getattr(settings, name) for name in PERSISTED_SETTINGS if hasattr(settings, name)}
+
+
+def atomic_write(path: pathlib.Path, data: bytes):
+    """先写临时文件再原子替换，崩溃时旧文件保持完整"""
+    tmp_file = path.with_suffix(".tmp")
+    with open(tmp_file, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+
+
+class SettingsWriter:
+    """
+    设置的防抖写入器。
+
+    mark_dirty() 只记录设置已修改并唤醒后台线程，立即返回，可以在事件循环中的热路径上调用；
+    后台线程等待一个防抖窗口（SETTINGS_SAVE_DEBOUNCE 秒），把窗口内的多次修改合并为一次写入，
+    写入时按 PERSISTED_SETTINGS 取当前配置。短时间内大量密钥失效时只会写入一次。
+    写入失败时修改保持未保存状态，后台线程等待 retry_delay() 秒后重试。
+    flush() 立即同步写入尚未保存的修改，用于关闭应用时。
+    """
+
+    def __init__(self, write, debounce: Optional[float] = None, retry_delay=None):
+        self.write = write
+        self.debounce = settings.SETTINGS_SAVE_DEBOUNCE if debounce is None else debounce
+        self.retry_delay = retry_delay or (lambda: 5.0)
+        self._dirty = False
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = None
+
+    def mark_dirty(self):
+        with self._condition:
+            self._dirty = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="settings-writer", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    @property
+    def pending(self) -> bool:
+        """是否有尚未保存的修改"""
+        return self._dirty
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._dirty)
+            time.sleep(self.debounce)
+            if not self.flush() and self._dirty:
+                delay = self.retry_delay()
+                log('warning', f"保存设置失败，{delay:.0f} 秒后重试")
+                time.sleep(delay)
+
+    def flush(self) -> bool:
+        """写入尚未保存的修改，写入成功时返回 True；没有修改或写入失败时返回 False"""
+        with self._write_lock:
+            with self._condition:
+                if not self._dirty:
+                    return False
+                self._dirty = False
+            try:
+                self.write(collect_settings())
+            except Exception as e:
+                log('error', f"保存设置时出错: {e}")
+                # 写入期间的新修改也一并留到下次重试
+                with self._condition:
+                    self._dirty = True
+                return False
+            return True
+
 class Persistence(ABC):
+    # 关闭应用时写入设置失败后，最多等待多少秒再重试一次
+    shutdown_retry_limit = 5.0
+
+    def __init__(self):
+        self.settings_writer = SettingsWriter(self.write_settings, retry_delay=self.retry_delay)
+
+    def save_settings(self):
+        """标记设置已修改，由后台线程在防抖窗口结束后合并写入"""
+        self.settings_writer.mark_dirty()
+
+    def retry_delay(self) -> float:
+        """写入设置失败后等待多少秒再重试"""
+        return 5.0
+
+    def flush_settings(self) -> bool:
+        """
+        立即写入尚未保存的设置修改（阻塞调用），用于关闭应用时。
+        写入失败时等待 retry_delay()（最多 shutdown_retry_limit 秒）后再试一次，仍失败则记录错误。
+        """
+        if self.settings_writer.flush():
+            return True
+        if not self.settings_writer.pending:
+            return False
+        time.sleep(min(self.retry_delay(), self.shutdown_retry_limit))
+        if self.settings_writer.flush():
+            return True
+        log('error', "关闭前未能保存最新的设置修改")
+        return False
+
     @abstractmethod
-    def save_settings(self) -> Any:
+    def write_settings(self, settings_dict: dict) -> Any:
+        """写入一份配置快照，在后台线程中执行；写入失败时抛出异常，由 SettingsWriter 重试"""
         pass
 
     @abstractmethod
     def load_settings(self) -> Any:
         pass
 
+    # 以下为用量快照和增量日志的存取，均为阻塞调用，应在线程中执行（asyncio.to_thread）
+    def save_usage_snapshot(self, data: bytes):
+        """保存用量快照，并清空已包含在快照中的增量日志"""
+        pass
+
+    def append_usage_deltas(self, data: bytes):
+        """追加一批增量记录"""
+        pass
+
+    def load_usage(self) -> Tuple[Optional[bytes], bytes]:
+        """读取 (快照, 增量日志)，不存在时返回 (None, b"")"""
+        return None, b""
+
 class FilePersistence(Persistence):
     def __init__(self):
+        super().__init__()
         storage_dir = pathlib.Path(settings.STORAGE_DIR)
         storage_dir.mkdir(parents=True, exist_ok=True)
         self.settings_file = storage_dir / "settings.json"
+        self.usage_snapshot_file = storage_dir / "usage.snapshot"
+        self.usage_delta_file = storage_dir / "usage.delta"
 
-    def save_settings(self):
-        """
-        将settings中所有的从os.environ.get获取的配置保存到JSON文件中，
-        但排除特定的配置项
-        """
+    def write_settings(self, settings_dict: dict):
+        """将配置快照原子地写入JSON文件"""
         if settings.ENABLE_STORAGE:
-            settings_dict = {}
-            for name, value in inspect.getmembers(settings):
-                if (not name.startswith('_') and
-                    not inspect.isfunction(value) and
-                    not inspect.ismodule(value) and
-                    not inspect.isclass(value) and
-                    name not in EXCLUDED_SETTINGS):
-                    try:
-                        json.dumps({name: value})
-                        settings_dict[name] = value
-                    except (TypeError, OverflowError):
-                        continue
             log('info', f"保存设置到JSON文件: {self.settings_file}")
-            with open(self.settings_file, 'w', encoding='utf-8') as f:
-                json.dump(settings_dict, f, ensure_ascii=False, indent=4)
+            data = json.dumps(settings_dict, ensure_ascii=False, indent=4).encode('utf-8')
+            atomic_write(self.settings_file, data)
             return self.settings_file
 
     def load_settings(self):
@@ -125,6 +309,28 @@ class FilePersistence(Persistence):
                 log('error', f"从文件加载设置时出错: {e}")
                 return False
 
+    def save_usage_snapshot(self, data: bytes):
+        if not settings.ENABLE_STORAGE:
+            return
+        atomic_write(self.usage_snapshot_file, data)
+        with open(self.usage_delta_file, 'wb'):
+            pass
+
+    def append_usage_deltas(self, data: bytes):
+        if not settings.ENABLE_STORAGE:
+            return
+        with open(self.usage_delta_file, 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def load_usage(self):
+        if not settings.ENABLE_STORAGE:
+            return None, b""
+        snapshot = self.usage_snapshot_file.read_bytes() if self.usage_snapshot_file.exists() else None
+        deltas = self.usage_delta_file.read_bytes() if self.usage_delta_file.exists() else b""
+        return snapshot, deltas
+
     def _reload_vertex_config(self):
         try:
             if (hasattr(settings, 'GOOGLE_CREDENTIALS_JSON') and settings.GOOGLE_CREDENTIALS_JSON) or \
@@ -145,152 +351,268 @@ class FilePersistence(Persistence):
             log('error', f"更新配置时出错: {str(e)}")
 
 
+class PersistenceUnavailable(Exception):
+    """数据库暂时无法连接（处于重连退避期或连接池已满）"""
+
+
+class ConnectionPool:
+    """
+    有上限的阻塞连接池，只在后台线程中使用。
+
+    连接按需建立，同时最多 size 个；使用中出错的连接直接丢弃，下次取用时重新建立。
+    建立连接失败后进入退避期（1 秒起指数增长，最长 max_backoff 秒），
+    退避期内取连接立即抛出 PersistenceUnavailable，调用方不会阻塞在重连上。
+    """
+
+    def __init__(self, connect, size: int, acquire_timeout: float = 30, max_backoff: float = 60):
+        self.connect = connect
+        self.size = size
+        self.acquire_timeout = acquire_timeout
+        self.max_backoff = max_backoff
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._backoff = 0.0
+        self._retry_at = 0.0
+
+    def retry_in(self) -> float:
+        """距离下次允许建立连接的秒数"""
+        return max(0.0, self._retry_at - time.monotonic())
+
+    def _checkout(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if not hasattr(conn, 'is_connected') or conn.is_connected():
+                return conn
+            self._discard(conn)
+
+        with self._lock:
+            if self.retry_in() > 0:
+                raise PersistenceUnavailable(f"数据库连接失败，{self.retry_in():.0f} 秒后重试")
+            try:
+                conn = self.connect()
+            except Exception as e:
+                self._backoff = min(max(self._backoff * 2, 1.0), self.max_backoff)
+                self._retry_at = time.monotonic() + self._backoff
+                raise PersistenceUnavailable(f"数据库连接失败: {e}") from e
+            self._backoff = 0.0
+            return conn
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise PersistenceUnavailable("等待数据库连接超时")
+        try:
+            conn = self._checkout()
+            try:
+                yield conn
+            except BaseException:
+                self._discard(conn)
+                raise
+            self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+
 class MySQLPersistence(Persistence):
+    """
+    MySQL 持久化。
+
+    所有数据库操作都是阻塞调用，只在后台线程中执行（设置写入线程、asyncio.to_thread），
+    连接来自有上限的连接池（MYSQL_POOL_SIZE），各线程互不干扰。连接失败时不在调用方等待重连，
+    退避期内的操作立即失败（保存设置由 SettingsWriter 在退避期结束后重试）；
+    只有启动时的 load_settings 会等待数据库就绪。
+    保存设置时与上次写入（或加载）的值比较，只在一个事务中批量写入有变化的配置项。
+    """
+
+    # 参数占位符和自增主键的写法，测试中替换为 SQLite 的写法
+    placeholder = "%s"
+    delta_id_column = "BIGINT AUTO_INCREMENT PRIMARY KEY"
+    connect_timeout = 10
+    load_attempts = 15
+
     def __init__(self):
+        super().__init__()
         self.host = settings.MYSQL_HOST
         self.user = settings.MYSQL_USER
         self.password = settings.MYSQL_PASSWORD
         self.database = settings.MYSQL_DATABASE
         self.port = settings.MYSQL_PORT
-        self.connection = None
-        self._connect()
-        self._create_table()
-
-    def _connect(self):
-        max_attempts = 15
-        delay = 1  # 初始延迟1秒
-        
-        for attempt in range(1, max_attempts + 1):
-            try:
-                self.connection = mysql.connector.connect(
-                    host=self.host,
-                    user=self.user,
-                    password=self.password,
-                    database=self.database,
-                    port=self.port
-                )
-                log('info', "成功连接到MySQL数据库")
-                return  # 成功连接，退出方法
-            except mysql.connector.Error as err:
-                if attempt < max_attempts:
-                    log('warning', f"数据库连接失败，将在 {delay} 秒后进行第 {attempt}/{max_attempts} 次重试...")
-                    time.sleep(delay)
-                    delay *= 2  # 指数退避
-                else:
-                    log('error', f"连接MySQL失败: {err}")
-                    self.connection = None
-
-    def _create_table(self):
-        if not self.connection:
-            return
-        try:
-            cursor = self.connection.cursor()
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS settings (
-                    `key` VARCHAR(255) PRIMARY KEY,
-                    `value` TEXT
-                )
-            """)
-            log('info', "设置表已存在或已成功创建")
-        except mysql.connector.Error as err:
-            log('error', f"创建表失败: {err}")
+        self.pool = ConnectionPool(self._new_connection, settings.MYSQL_POOL_SIZE)
+        self._tables_ready = False
+        # 数据库中各配置项的当前值（字符串），用于只写入有变化的配置项
+        self._saved = {}
 
-    def save_settings(self):
-        if not self.connection or not self.connection.is_connected():
-            log('warning', "MySQL连接丢失。正在尝试重新连接...")
-            self._connect()
+    @property
+    def db_error(self):
+        """数据库驱动的异常基类"""
+        return mysql_connector.Error
+
+    def retry_delay(self) -> float:
+        # 连接失败后等到连接池的退避期结束再重试
+        return max(self.pool.retry_in(), 1.0)
+
+    def _new_connection(self):
+        return mysql_connector.connect(
+            host=self.host,
+            user=self.user,
+            password=self.password,
+            database=self.database,
+            port=self.port,
+            connection_timeout=self.connect_timeout
+        )
+
+    @contextmanager
+    def _connection(self):
+        with self.pool.connection() as conn:
+            if not self._tables_ready:
+                self._create_table(conn)
+            yield conn
 
-        if not self.connection:
-            log('error', "无法保存设置，没有活动的MySQL连接。")
+    def _create_table(self, conn):
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS settings (
+                `key` VARCHAR(255) PRIMARY KEY,
+                `value` TEXT
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS usage_snapshot (
+                `id` TINYINT PRIMARY KEY,
+                `data` LONGBLOB
+            )
+        """)
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS usage_delta (
+                `id` {self.delta_id_column},
+                `data` MEDIUMBLOB
+            )
+        """)
+        conn.commit()
+        self._tables_ready = True
+        log('info', "设置表已存在或已成功创建")
+
+    def write_settings(self, settings_dict: dict):
+        changed = {}
+        for key, value in settings_dict.items():
+            # 统一按字符串保存，dict/list 序列化为 JSON
+            if isinstance(value, (dict, list)):
+                value = json.dumps(value, ensure_ascii=False)
+            else:
+                value = str(value)
+            if self._saved.get(key) != value:
+                changed[key] = value
+        if not changed:
             return
-        try:
-            cursor = self.connection.cursor()
-            settings_dict = {}
-            for name, value in inspect.getmembers(settings):
-                if (not name.startswith('_') and
-                    not inspect.isfunction(value) and
-                    not inspect.ismodule(value) and
-                    not inspect.isclass(value) and
-                    name not in EXCLUDED_SETTINGS):
-                    try:
-                        # For simplicity, we'll store all values as strings.
-                        # Complex objects would need serialization (e.g., to JSON).
-                        if isinstance(value, (dict, list)):
-                            settings_dict[name] = json.dumps(value, ensure_ascii=False)
-                        else:
-                            settings_dict[name] = str(value)
-                    except (TypeError, OverflowError):
-                        continue
-            
-            for key, value in settings_dict.items():
-                cursor.execute(
-                    "INSERT INTO settings (`key`, `value`) VALUES (%s, %s) ON DUPLICATE KEY UPDATE `value` = %s",
-                    (key, value, value)
-                )
-            self.connection.commit()
-            log('info', "设置已成功保存到MySQL数据库")
-        except mysql.connector.Error as err:
-            log('error', f"保存设置到MySQL失败: {err}")
-            self.connection.rollback()
+
+        p = self.placeholder
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(f"REPLACE INTO settings (`key`, `value`) VALUES ({p}, {p})", list(changed.items()))
+            conn.commit()
+        self._saved.update(changed)
+        log('info', f"已保存 {len(changed)} 项设置到MySQL数据库")
+
+    def save_usage_snapshot(self, data: bytes):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"REPLACE INTO usage_snapshot (`id`, `data`) VALUES (1, {self.placeholder})", (data,))
+            cursor.execute("DELETE FROM usage_delta")
+            conn.commit()
+
+    def append_usage_deltas(self, data: bytes):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"INSERT INTO usage_delta (`data`) VALUES ({self.placeholder})", (data,))
+            conn.commit()
+
+    def load_usage(self):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT `data` FROM usage_snapshot WHERE `id` = 1")
+            row = cursor.fetchone()
+            snapshot = bytes(row[0]) if row else None
+            cursor.execute("SELECT `data` FROM usage_delta ORDER BY `id`")
+            deltas = b"".join(bytes(row[0]) for row in cursor.fetchall())
+            return snapshot, deltas
 
     def load_settings(self):
-        if not self.connection or not self.connection.is_connected():
-            log('warning', "MySQL连接丢失。正在尝试重新连接...")
-            self._connect()
+        """启动时加载设置，数据库尚未就绪时按连接池的退避间隔重试"""
+        for attempt in range(1, self.load_attempts + 1):
+            try:
+                with self._connection() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT `key`, `value` FROM settings")
+                    loaded_settings = dict(cursor.fetchall())
+                break
+            except (PersistenceUnavailable, self.db_error) as err:
+                if attempt == self.load_attempts:
+                    log('error', f"从MySQL加载设置失败: {err}")
+                    return False
+                delay = max(self.pool.retry_in(), 1.0)
+                log('warning', f"数据库连接失败，将在 {delay:.0f} 秒后进行第 {attempt}/{self.load_attempts} 次重试...")
+                time.sleep(delay)
 
-        if not self.connection:
-            log('error', "无法加载设置，没有活动的MySQL连接。")
-            return False
-        try:
-            cursor = self.connection.cursor(dictionary=True)
-            cursor.execute("SELECT `key`, `value` FROM settings")
-            loaded_settings = {row['key']: row['value'] for row in cursor.fetchall()}
-
-            for name, value in loaded_settings.items():
-                if hasattr(settings, name) and name not in EXCLUDED_SETTINGS:
-                    original_value = getattr(settings, name)
-                    original_type = type(original_value)
-                    try:
-                        if original_type == bool:
-                            converted_value = value.lower() in ['true', '1', 'yes']
-                        elif original_type == int:
-                            converted_value = int(value)
-                        elif original_type == float:
-                            converted_value = float(value)
-                        elif original_type == list or original_type == set:
-                            # Assuming comma-separated strings for lists/sets
-                            converted_value = original_type([item.strip() for item in value.split(',') if item.strip()])
-                        elif original_type == dict:
+        self._saved = dict(loaded_settings)
+        for name, value in loaded_settings.items():
+            if hasattr(settings, name) and name not in EXCLUDED_SETTINGS:
+                original_value = getattr(settings, name)
+                original_type = type(original_value)
+                try:
+                    if original_type == bool:
+                        converted_value = value.lower() in ['true', '1', 'yes']
+                    elif original_type == int:
+                        converted_value = int(value)
+                    elif original_type == float:
+                        converted_value = float(value)
+                    elif original_type == list or original_type == set:
+                        # Assuming comma-separated strings for lists/sets
+                        converted_value = original_type([item.strip() for item in value.split(',') if item.strip()])
+                    elif original_type == dict:
+                        try:
+                            converted_value = json.loads(value)
+                        except json.JSONDecodeError:
                             try:
-                                converted_value = json.loads(value)
-                            except json.JSONDecodeError:
-                                try:
-                                    # Try to evaluate as a Python literal, e.g., a dict with single quotes
-                                    converted_value = ast.literal_eval(value)
-                                    if not isinstance(converted_value, original_type):
-                                        log('warning', f"Evaluated literal for '{name}' has wrong type, keeping as string.")
-                                        converted_value = value
-                                except (ValueError, SyntaxError):
-                                    log('warning', f"Could not decode JSON or literal for setting '{name}', keeping as string.")
+                                # Try to evaluate as a Python literal, e.g., a dict with single quotes
+                                converted_value = ast.literal_eval(value)
+                                if not isinstance(converted_value, original_type):
+                                    log('warning', f"Evaluated literal for '{name}' has wrong type, keeping as string.")
                                     converted_value = value
-                        else:
-                            converted_value = value
-                        setattr(settings, name, converted_value)
-                    except (ValueError, TypeError) as e:
-                        log('warning', f"无法将加载的设置 '{name}' 的值 '{value}' 转换为类型 {original_type.__name__}: {e}")
-            
-            log('info', "从MySQL加载设置成功")
-            return True
-        except mysql.connector.Error as err:
-            log('error', f"从MySQL加载设置失败: {err}")
-            return False
+                            except (ValueError, SyntaxError):
+                                log('warning', f"Could not decode JSON or literal for setting '{name}', keeping as string.")
+                                converted_value = value
+                    else:
+                        converted_value = value
+                    setattr(settings, name, converted_value)
+                except (ValueError, TypeError) as e:
+                    log('warning', f"无法将加载的设置 '{name}' 的值 '{value}' 转换为类型 {original_type.__name__}: {e}")
+
+        log('info', "从MySQL加载设置成功")
+        return True
+
+_persistence = None
 
 def get_persistence():
-    mode = settings.PERSISTENCE_MODE
-    if mode == 'mysql':
-        return MySQLPersistence()
-    elif mode == 'file':
-        return FilePersistence()
-    else:
-        log('warning', f"未知的持久化模式: {mode}. 回退到文件模式。")
-        return FilePersistence()
\ No newline at end of file
+    """返回全局持久化实例，所有调用方共用同一个连接和设置写入器"""
+    global _persistence
+    if _persistence is None:
+        mode = settings.PERSISTENCE_MODE
+        if mode == 'mysql':
+            _persistence = MySQLPersistence()
+        elif mode == 'file':
+            _persistence = FilePersistence()
+        else:
+            log('warning', f"未知的持久化模式: {mode}. 回退到文件模式。")
+            _persistence = FilePersistence()
+    return _persistence
@@ -24,6 +24,16 @@ FAKE_STREAMING = os.environ.get("FAKE_STREAMING", "true").lower() in ["true", "1
 # 配置持久化存储目录
 STORAGE_DIR = os.environ.get("STORAGE_DIR", "/hajimi/settings/")
 ENABLE_STORAGE = os.environ.get("ENABLE_STORAGE", "false").lower() in ["true", "1", "yes"]
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "DEBUG").upper()  # 最低日志级别：DEBUG/INFO/WARNING/ERROR，默认与原先一样输出全部日志
+# 高频日志按类别采样（类别:采样率，1 为全部输出），被省略的日志每个聚合周期汇总为一条
+LOG_SAMPLE_RATES = os.environ.get("LOG_SAMPLE_RATES", "auth:0,cache_key:0.1,stats:0.1")
+LOG_AGGREGATE_INTERVAL = float(os.environ.get("LOG_AGGREGATE_INTERVAL", "10"))  # 日志聚合周期（秒）
+# 未分类日志按消息模板（数字视为相同）聚合，每个周期内同一模板最多输出的条数，0 为不限制
+LOG_REPEAT_LIMIT = int(os.environ.get("LOG_REPEAT_LIMIT", "20"))
+USAGE_FLUSH_INTERVAL = float(os.environ.get("USAGE_FLUSH_INTERVAL", "5"))  # 用量增量日志的写入间隔（秒）
+USAGE_SNAPSHOT_INTERVAL = float(os.environ.get("USAGE_SNAPSHOT_INTERVAL", "300"))  # 用量快照的写入间隔（秒）
+DASHBOARD_REFRESH_INTERVAL = float(os.environ.get("DASHBOARD_REFRESH_INTERVAL", "2"))  # 仪表盘快照的重建间隔（秒）
+SETTINGS_SAVE_DEBOUNCE = float(os.environ.get("SETTINGS_SAVE_DEBOUNCE", "1"))  # 设置修改后合并写入的防抖窗口（秒）
 
 # 持久化模式 ('file' or 'mysql')
 PERSISTENCE_MODE = os.environ.get("PERSISTENCE_MODE", "file").lower()
@@ -34,15 +44,40 @@ MYSQL_USER = os.environ.get("MYSQL_USER", "root")
 MYSQL_PASSWORD = os.environ.get("MYSQL_PASSWORD", "")
 MYSQL_DATABASE = os.environ.get("MYSQL_DATABASE", "hajimi")
 MYSQL_PORT = int(os.environ.get("MYSQL_PORT", "3306"))
+MYSQL_POOL_SIZE = int(os.environ.get("MYSQL_POOL_SIZE", "5"))  # MySQL 连接池最大连接数
 
 # 并发请求配置
 CONCURRENT_REQUESTS = int(os.environ.get("CONCURRENT_REQUESTS", "1"))  # 默认并发请求数
 INCREASE_CONCURRENT_ON_FAILURE = int(os.environ.get("INCREASE_CONCURRENT_ON_FAILURE", "0"))  # 失败时增加的并发数
 MAX_CONCURRENT_REQUESTS = int(os.environ.get("MAX_CONCURRENT_REQUESTS", "3"))  # 最大并发请求数
 
+# 对冲请求配置：开启后并发请求不再同时发出，先发一个，超过最近耗时的 p95 仍未完成时才追加下一个
+HEDGE_ENABLED = os.environ.get("HEDGE_ENABLED", "false").lower() in ["true", "1", "yes"]
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "0.95"))  # 对冲延迟取最近耗时的分位数
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", "2"))  # 对冲延迟下限（秒）
+HEDGE_DEFAULT_DELAY = float(os.environ.get("HEDGE_DEFAULT_DELAY", "10"))  # 耗时样本不足时的对冲延迟（秒）
+
+# 上游连接池配置
+HTTP2_ENABLED = os.environ.get("HTTP2_ENABLED", "true").lower() in ["true", "1", "yes"]  # 是否启用 HTTP/2
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "100"))  # 连接池最大连接数
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))  # 最大保活连接数
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "30"))  # 空闲连接保活时间（秒）
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", "380"))  # 上游请求超时时间（秒）
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "380"))  # 上游连接超时时间（秒）
+
+# API密钥检测配置
+KEY_CHECK_CONCURRENCY = int(os.environ.get("KEY_CHECK_CONCURRENCY", "20"))  # 同时检测的密钥数
+KEY_CHECK_QPS = float(os.environ.get("KEY_CHECK_QPS", "20"))  # 每秒最多发起的检测请求数，0 表示不限制
+KEY_CHECK_TIMEOUT = float(os.environ.get("KEY_CHECK_TIMEOUT", "15"))  # 单个密钥检测的超时时间（秒）
+STARTUP_TASK_TIMEOUT = float(os.environ.get("STARTUP_TASK_TIMEOUT", "30"))  # 启动时各后台步骤（Vertex初始化、版本检查、加载模型）的超时时间（秒）
+
+# 真流式模式下，相同请求共享上游流时的重放缓冲区大小（块数）
+STREAM_REPLAY_MAX_CHUNKS = int(os.environ.get("STREAM_REPLAY_MAX_CHUNKS", "1024"))
+
 # 缓存配置
 CACHE_EXPIRY_TIME = int(os.environ.get("CACHE_EXPIRY_TIME", "21600"))  # 默认缓存 6 小时 (21600 秒)
 MAX_CACHE_ENTRIES = int(os.environ.get("MAX_CACHE_ENTRIES", "500"))  # 默认最多缓存500条响应
+MAX_CACHE_BYTES = int(os.environ.get("MAX_CACHE_BYTES", "0"))  # 缓存最大占用字节数，默认 0 表示不限制
 CALCULATE_CACHE_ENTRIES = int(os.environ.get("CALCULATE_CACHE_ENTRIES", "6"))  # 默认取最后 6 条消息算缓存键
 PRECISE_CACHE = os.environ.get("PRECISE_CACHE", "false").lower() in ["true", "1", "yes"] #是否取所有消息来算缓存键
 
@@ -73,9 +108,13 @@ MAX_EMPTY_RESPONSES = int(os.environ.get("MAX_EMPTY_RESPONSES", "5"))  # 默认
 MAX_RETRY_NUM = int(os.environ.get("MAX_RETRY_NUM", "15")) # 请求时的最大总轮询 key 数
 MAX_REQUESTS_PER_MINUTE = int(os.environ.get("MAX_REQUESTS_PER_MINUTE", "30")) 
 MAX_REQUESTS_PER_DAY_PER_IP = int(os.environ.get("MAX_REQUESTS_PER_DAY_PER_IP", "600"))
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory").lower()  # 访问限制存储：memory（进程内）或 redis（多进程共享）
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
 
 # API密钥使用限制
 API_KEY_DAILY_LIMIT = int(os.environ.get("API_KEY_DAILY_LIMIT", "100"))# 默认每个API密钥每24小时可使用100次
+KEY_COOLDOWN_BASE = float(os.environ.get("KEY_COOLDOWN_BASE", "5"))  # 密钥临时失败后的初始冷却时间（秒），连续失败时指数增长
+KEY_COOLDOWN_MAX = float(os.environ.get("KEY_COOLDOWN_MAX", "1800"))  # 密钥冷却时间上限（秒）
 
 # 模型屏蔽黑名单，格式应为逗号分隔的模型名称集合
 BLOCKED_MODELS = { model.strip() for model in os.environ.get("BLOCKED_MODELS", "").split(",") if model.strip() }
@@ -0,0 +1,111 @@
+import threading
+from types import MappingProxyType
+from typing import Iterable, List, Optional
+from app.config import settings
+from app.config.safety import SAFETY_SETTINGS, SAFETY_SETTINGS_G2
+
+
+def _split_keys(value) -> tuple:
+    """解析逗号分隔的密钥列表，去掉空白和重复项"""
+    return tuple(dict.fromkeys(key.strip() for key in (value or "").split(',') if key.strip()))
+
+
+def _model_safety(model: str):
+    """模型使用的安全设置，gemini-2.5 系列使用 G2 版本"""
+    return SAFETY_SETTINGS_G2 if 'gemini-2.5' in model else SAFETY_SETTINGS
+
+
+def _freeze(value):
+    """把配置值转换为不可变类型"""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(value)
+    return value
+
+
+class SettingsSnapshot:
+    """
+    不可变的配置快照。
+
+    包含 settings 模块中所有大写配置项（以及联网搜索配置 search），通过属性读取，如 cfg.MAX_RETRY_NUM；
+    dict/list/set 会被转换为只读类型。每个请求在入口取一次快照并在整个处理过程中使用，
+    处理期间仪表盘修改配置不会让同一请求前后读到不一致的值。
+    由配置派生的值在快照中只计算一次：模型白名单/黑名单集合、小写的 User-Agent 白名单、
+    解析后的密钥列表（api_keys、invalid_api_keys、vertex_express_api_keys），
+    以及可用模型列表中每个模型的安全设置（model_safety）。
+    """
+    __slots__ = ('version', '_values', 'whitelist_models', 'blocked_models', 'whitelist_user_agent',
+                 'api_keys', 'invalid_api_keys', 'vertex_express_api_keys', 'model_safety')
+
+    def __init__(self, values: dict, version: int = 0, models: Iterable[str] = ()):
+        set_attr = object.__setattr__
+        set_attr(self, 'version', version)
+        set_attr(self, '_values', MappingProxyType({name: _freeze(value) for name, value in values.items()}))
+        set_attr(self, 'whitelist_models', frozenset(values.get('WHITELIST_MODELS') or ()))
+        set_attr(self, 'blocked_models', frozenset(values.get('BLOCKED_MODELS') or ()))
+        set_attr(self, 'whitelist_user_agent', frozenset(ua.lower() for ua in values.get('WHITELIST_USER_AGENT') or ()))
+        set_attr(self, 'api_keys', _split_keys(values.get('GEMINI_API_KEYS')))
+        set_attr(self, 'invalid_api_keys', frozenset(_split_keys(values.get('INVALID_API_KEYS'))))
+        set_attr(self, 'vertex_express_api_keys', _split_keys(values.get('VERTEX_EXPRESS_API_KEY')))
+        set_attr(self, 'model_safety', MappingProxyType({model: _model_safety(model) for model in models}))
+
+    @classmethod
+    def capture(cls, version: int = 0, models: Iterable[str] = ()) -> 'SettingsSnapshot':
+        """读取 settings 模块的当前值生成快照"""
+        values = {name: value for name, value in vars(settings).items()
+                  if name.isupper() or name == 'search'}
+        return cls(values, version, models)
+
+    def __getattr__(self, name: str):
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError(f"配置项 {name} 不存在") from None
+
+    def __setattr__(self, name, value):
+        raise AttributeError("配置快照是只读的，请修改 settings 后调用 publish_settings()")
+
+    def model_allowed(self, model: str) -> bool:
+        """模型是否在白名单中（未配置白名单时为不在黑名单中）"""
+        if self.whitelist_models:
+            return model in self.whitelist_models
+        return model not in self.blocked_models
+
+    def filter_models(self, models: Iterable[str]) -> List[str]:
+        return [model for model in models if self.model_allowed(model)]
+
+    def safety_settings(self, model: str):
+        """模型使用的安全设置，gemini-2.5 系列使用 G2 版本；不在可用模型列表中的模型（如 Gemini 格式请求）按名称判断"""
+        safety = self.model_safety.get(model)
+        return safety if safety is not None else _model_safety(model)
+
+
+_current = None
+_models: tuple = ()
+_lock = threading.Lock()
+
+
+def current_settings() -> SettingsSnapshot:
+    """当前配置快照；返回的对象不会再变化，配置修改后会被整体替换"""
+    snapshot = _current
+    if snapshot is None:
+        snapshot = publish_settings()
+    return snapshot
+
+
+def publish_settings(models: Optional[Iterable[str]] = None) -> SettingsSnapshot:
+    """
+    修改 settings 后调用，重新生成快照并原子地替换当前快照。
+
+    可用模型列表更新后传入 models，之后的快照为这些模型预先计算安全设置；不传时沿用上次的列表。
+    """
+    global _current, _models
+    with _lock:
+        if models is not None:
+            _models = tuple(models)
+        version = _current.version + 1 if _current is not None else 1
+        _current = SettingsSnapshot.capture(version, _models)
+        return _current
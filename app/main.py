@@ -7,20 +7,25 @@ from app.models.schemas import ErrorResponse
 from app.services import GeminiClient
 from app.utils import (
     APIKeyManager, 
-    test_api_key, 
     ResponseCacheManager,
-    ActiveRequestsManager,
+    RequestCoalescer,
     check_version,
     schedule_cache_cleanup,
     handle_exception,
     log
 )
+from app.utils.http_client import init_http_client, close_http_client
+from app.utils.logging import configure_log_sampling, set_log_level
+from app.utils.stats import api_stats_manager
+from app.utils.usage_journal import UsageJournal
+from app.utils.key_validation import key_validator
+from app.utils.readiness import readiness
 from app.config.persistence import get_persistence
+from app.config.snapshot import publish_settings
 from app.api import router, init_router, dashboard_router, init_dashboard_router
-from app.vertex.vertex_ai_init import init_vertex_ai
-from app.vertex.credentials_manager import CredentialManager
+from app.api.dashboard import dashboard_snapshot
+from app.utils.lazy_import import lazy_import
 import app.config.settings as settings
-from app.config.safety import SAFETY_SETTINGS, SAFETY_SETTINGS_G2
 import asyncio
 import sys
 import pathlib
@@ -41,11 +46,19 @@ if settings.ALLOWED_ORIGINS:
         allow_headers=["*"],
     )
 
+# Vertex 依赖 google-genai、google-auth 等重量级 SDK，只有启用 Vertex 时才导入
+vertex_ai_init = lazy_import("app.vertex.vertex_ai_init")
+vertex_credentials = lazy_import("app.vertex.credentials_manager")
+
 # --------------- 全局实例 ---------------
 persistence = get_persistence()
 persistence.load_settings()
+set_log_level(settings.LOG_LEVEL)
+configure_log_sampling(settings.LOG_SAMPLE_RATES, settings.LOG_AGGREGATE_INTERVAL, settings.LOG_REPEAT_LIMIT)
 # 初始化API密钥管理器
 key_manager = APIKeyManager(persistence=persistence)
+# 密钥/模型用量的快照与增量日志，重启后恢复已消耗的额度
+usage_journal = UsageJournal(persistence, api_stats_manager, key_manager.key_scheduler)
 
 # 创建全局缓存字典，将作为缓存管理器的内部存储
 response_cache = {}
@@ -54,17 +67,18 @@ response_cache = {}
 response_cache_manager = ResponseCacheManager(
     expiry_time=settings.CACHE_EXPIRY_TIME,
     max_entries=settings.MAX_CACHE_ENTRIES,
-    cache_dict=response_cache
+    cache_dict=response_cache,
+    max_bytes=settings.MAX_CACHE_BYTES
 )
 
-# 活跃请求池 - 将作为活跃请求管理器的内部存储
-active_requests_pool = {}
-
-# 初始化活跃请求管理器
-active_requests_manager = ActiveRequestsManager(requests_pool=active_requests_pool)
+# 初始化请求合并器，相同的并发请求只调用一次上游
+request_coalescer = RequestCoalescer()
 
 SKIP_CHECK_API_KEY = True
 
+# 后台执行的启动步骤
+startup_tasks = []
+
 # --------------- 工具函数 ---------------
 # @app.middleware("http")
 # async def log_requests(request: Request, call_next):
@@ -81,44 +95,88 @@ SKIP_CHECK_API_KEY = True
 #     response = await call_next(request)
 #     return response
 
-async def check_remaining_keys_async(keys_to_check: list, initial_invalid_keys: list):
+async def run_startup_step(name: str, coro):
     """
-    在后台异步检查剩余的 API 密钥。
+    在后台执行一个启动步骤，超过 STARTUP_TASK_TIMEOUT 秒视为超时，结果记录到就绪状态。
     """
-    local_invalid_keys = []
-    found_valid_keys =False
-
-    log('info', f" 开始在后台检查剩余 API Key 是否有效")
-    for key in keys_to_check:
-        is_valid = await test_api_key(key)
-        if is_valid:
-            if key not in key_manager.api_keys: # 避免重复添加
-                key_manager.api_keys.append(key)
-                found_valid_keys = True
-            # log('info', f"API Key {key[:8]}... 有效")
-        else:
-            local_invalid_keys.append(key)
-            log('warning', f" API Key {key[:8]}... 无效")
-        
-        await asyncio.sleep(0.05) # 短暂休眠，避免请求过于密集
+    try:
+        await asyncio.wait_for(coro, settings.STARTUP_TASK_TIMEOUT)
+        readiness.set(name)
+    except asyncio.TimeoutError:
+        readiness.set(name, "timeout")
+        log('warning', f"启动步骤 {name} 超时（{settings.STARTUP_TASK_TIMEOUT:.0f} 秒），已在后台放弃")
+    except Exception as e:
+        readiness.set(name, "failed")
+        log('error', f"启动步骤 {name} 失败: {str(e)}")
+
+async def init_vertex(credential_manager_instance):
+    """初始化Vertex AI服务，启用了Vertex但没有可用凭证时视为失败"""
+    if not await vertex_ai_init.init_vertex_ai(credential_manager=credential_manager_instance) and settings.ENABLE_VERTEX:
+        raise RuntimeError("没有可用的Vertex凭证")
+
+async def load_available_models(api_key: str) -> bool:
+    """使用有效密钥加载可用模型列表"""
+    try:
+        all_models = await asyncio.wait_for(GeminiClient.list_available_models(api_key), settings.STARTUP_TASK_TIMEOUT)
+    except Exception as e:
+        log('warning', f"使用密钥 {api_key[:8]}... 加载可用模型失败", extra={'error_message': str(e)})
+        return False
+    GeminiClient.AVAILABLE_MODELS = [model.replace("models/", "") for model in all_models]
+    # 新的快照为可用模型预先计算安全设置
+    publish_settings(GeminiClient.AVAILABLE_MODELS)
+    log('info', f"使用密钥 {api_key[:8]}... 加载可用模型成功")
+    readiness.set('models')
+    return True
+
+async def check_keys_async(initial_keys: list):
+    """
+    在后台并发检测 API 密钥并加载模型列表。
 
-    if found_valid_keys:
-        key_manager._reset_key_stack() # 如果找到新的有效key，重置栈
+    出现第一个有效密钥后立即用它加载模型列表，此时服务即就绪；
+    SKIP_CHECK_API_KEY 为 True 时，模型列表加载成功后停止检测，未检测的密钥直接保留，
+    检测出的无效密钥只从本次运行中移出，不写入 INVALID_API_KEYS。
+    超时等无法判断的结果不算无效（见 KeyValidator）。
+    """
+    models_task = None
+    if not initial_keys:
+        log('error', "启动时未能找到任何有效 API 密钥！")
+        return
+
+    def on_result(key: str, is_valid: bool):
+        nonlocal models_task
+        key_manager.apply_validation(key, is_valid)
+        if not is_valid:
+            return
+        if not readiness.ok('api_key'):
+            log('info', f"找到第一个有效密钥: {key[:8]}...")
+            readiness.set('api_key')
+        if not readiness.ok('models') and (models_task is None or models_task.done()):
+            models_task = asyncio.create_task(load_models_with(key))
 
-    # 合并所有无效密钥 (初始无效 + 后台检查出的无效)
-    combined_invalid_keys = list(set(initial_invalid_keys + local_invalid_keys))
+    async def load_models_with(key: str):
+        if await load_available_models(key) and SKIP_CHECK_API_KEY:
+            key_validator.cancel()
+
+    log('info', f"开始在后台检查 API Key 是否有效，共 {len(initial_keys)} 个")
+    _, invalid_keys = await key_validator.run(initial_keys, on_result=on_result)
+    if models_task is not None:
+        await models_task
+
+    if not readiness.ok('api_key'):
+        log('error', "启动时未能找到任何有效 API 密钥！")
 
     # 获取当前设置中的无效密钥
     current_invalid_keys_str = settings.INVALID_API_KEYS or ""
     current_invalid_keys_set = set(k.strip() for k in current_invalid_keys_str.split(',') if k.strip())
 
     # 更新无效密钥集合
-    new_invalid_keys_set = current_invalid_keys_set.union(set(combined_invalid_keys))
+    new_invalid_keys_set = current_invalid_keys_set.union(set(invalid_keys))
 
-    # 只有当无效密钥列表发生变化时才保存
-    if new_invalid_keys_set != current_invalid_keys_set:
+    # 只有当无效密钥列表发生变化时才保存；跳过检查时无效密钥只从本次运行中移出，不持久化
+    if not SKIP_CHECK_API_KEY and new_invalid_keys_set != current_invalid_keys_set:
         settings.INVALID_API_KEYS = ','.join(sorted(list(new_invalid_keys_set)))
         persistence.save_settings()
+        publish_settings()
 
     log('info', f"密钥检查任务完成。当前总可用密钥数量: {len(key_manager.api_keys)}")
 
@@ -130,8 +188,12 @@ sys.excepthook = handle_exception
 @app.on_event("startup")
 async def startup_event():
     
-    # 首先加载持久化设置，确保所有配置都是最新的
-    persistence.load_settings()
+    # 首先加载持久化设置，确保所有配置都是最新的（在线程中执行，等待数据库时不阻塞事件循环）
+    await asyncio.to_thread(persistence.load_settings)
+    publish_settings()
+    # 恢复重启前的用量数据，并开始定期写入
+    await usage_journal.recover()
+    usage_journal.start()
 
     # 添加配置调试信息
     log('info', f"[DEBUG] 应用启动配置检查",
@@ -151,98 +213,74 @@ async def startup_event():
     logging.getLogger("uvicorn").disabled = True
     logging.getLogger("uvicorn.access").disabled = True
     
+    # 创建全局共享的上游连接池，供 GeminiClient、密钥检测和模型列表使用
+    await init_http_client()
+    
     
     # 重新加载vertex配置，确保获取到最新的持久化设置
     import app.vertex.config as vertex_config
     vertex_config.reload_config()
     
     
-    # 初始化CredentialManager
-    credential_manager_instance = CredentialManager()
-    # 添加到应用程序状态
-    app.state.credential_manager = credential_manager_instance
-    
-    # 初始化Vertex AI服务
-    await init_vertex_ai(credential_manager=credential_manager_instance)
-    schedule_cache_cleanup(response_cache_manager, active_requests_manager)
-    # 检查版本
-    await check_version()
+    # 初始化CredentialManager（未启用 Vertex 时不加载 Vertex SDK，运行中启用后由 Vertex 路由按需创建）
+    credential_manager_instance = None
+    vertex_enabled = settings.ENABLE_VERTEX or settings.ENABLE_VERTEX_EXPRESS
+    if vertex_enabled:
+        credential_manager_instance = vertex_credentials.CredentialManager()
+        # 添加到应用程序状态
+        app.state.credential_manager = credential_manager_instance
     
-    # 密钥检查 
-    initial_keys = key_manager.api_keys.copy()
-    key_manager.api_keys = [] # 清空，等待检查结果
-    first_valid_key = None
-    initial_invalid_keys = []
-    keys_to_check_later = []
-
-    # 阻塞式查找第一个有效密钥
-    for index, key in enumerate(initial_keys):
-        is_valid = await test_api_key(key)
-        if is_valid:
-            log('info', f"找到第一个有效密钥: {key[:8]}...")
-            first_valid_key = key
-            key_manager.api_keys.append(key) # 添加到管理器
-            key_manager._reset_key_stack()
-            # 将剩余的key放入后台检查列表
-            keys_to_check_later = initial_keys[index + 1:]
-            break # 找到即停止
-        else:
-            log('warning', f"密钥 {key[:8]}... 无效")
-            initial_invalid_keys.append(key)
-    
-    if not first_valid_key:
-        log('error', "启动时未能找到任何有效 API 密钥！")
-        keys_to_check_later = [] # 没有有效key，无需后台检查
-    else:
-        # 使用第一个有效密钥加载模型
-        try:
-            all_models = await GeminiClient.list_available_models(first_valid_key)
-            GeminiClient.AVAILABLE_MODELS = [model.replace("models/", "") for model in all_models]
-            log('info', f"使用密钥 {first_valid_key[:8]}... 加载可用模型成功")
-        except Exception as e:
-            log('warning', f"使用密钥 {first_valid_key[:8]}... 加载可用模型失败",extra={'error_message': str(e)})
+    schedule_cache_cleanup(response_cache_manager, request_coalescer)
 
+    # 耗时的启动步骤在后台并发执行，不阻塞服务开始接受连接，就绪状态通过 /ready 查询
+    initial_keys = key_manager.api_keys.copy()
+    if initial_keys:
+        readiness.require('api_key', 'models')
+    elif settings.ENABLE_VERTEX:
+        readiness.require('vertex')
     if not SKIP_CHECK_API_KEY:
-        # 创建后台任务检查剩余密钥
-        if keys_to_check_later:
-            asyncio.create_task(check_remaining_keys_async(keys_to_check_later, initial_invalid_keys))
-        else:
-            # 如果没有需要后台检查的key，也要处理初始无效key
-            current_invalid_keys_str = settings.INVALID_API_KEYS or ""
-            current_invalid_keys_set = set(k.strip() for k in current_invalid_keys_str.split(',') if k.strip())
-            new_invalid_keys_set = current_invalid_keys_set.union(set(initial_invalid_keys))
-            if new_invalid_keys_set != current_invalid_keys_set:
-                 settings.INVALID_API_KEYS = ','.join(sorted(list(new_invalid_keys_set)))
-                 persistence.save_settings()
-                 log('info', f"更新初始无效密钥列表完成，总无效密钥数: {len(new_invalid_keys_set)}")
-
-    else: # 跳过检查
-        log('info',"跳过 API 密钥检查")
-        key_manager.api_keys.extend(keys_to_check_later)
-        key_manager._reset_key_stack()
+        # 需要完整检测时，密钥检测通过后才加入调度
+        key_manager.api_keys = []
+        key_manager.refresh_keys()
+    if vertex_enabled:
+        startup_tasks.append(asyncio.create_task(run_startup_step('vertex', init_vertex(credential_manager_instance))))
+    startup_tasks.extend([
+        asyncio.create_task(run_startup_step('version', check_version())),
+        asyncio.create_task(check_keys_async(initial_keys)),
+    ])
 
     # 初始化路由器
     init_router(
         key_manager,
         response_cache_manager,
-        active_requests_manager,
-        SAFETY_SETTINGS,
-        SAFETY_SETTINGS_G2,
-        first_valid_key,
-        settings.FAKE_STREAMING,
-        settings.FAKE_STREAMING_INTERVAL,
-        settings.PASSWORD,
-        settings.MAX_REQUESTS_PER_MINUTE,
-        settings.MAX_REQUESTS_PER_DAY_PER_IP
+        request_coalescer,
+        None
     )
         
     # 初始化仪表盘路由器
     init_dashboard_router(
         key_manager,
         response_cache_manager,
-        active_requests_manager,
+        request_coalescer,
         credential_manager_instance
     )
+    # 启动仪表盘快照的后台构建
+    dashboard_snapshot.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # 取消尚未完成的启动步骤
+    for task in startup_tasks:
+        task.cancel()
+    # 关闭全局共享的上游连接池
+    await close_http_client()
+    # 处理统计缓冲区中剩余的调用记录
+    await api_stats_manager.close()
+    # 写入最终的用量快照
+    await usage_journal.close()
+    await dashboard_snapshot.close()
+    # 写入防抖窗口内尚未保存的设置
+    await asyncio.to_thread(persistence.flush_settings)
 
 # --------------- 异常处理 ---------------
 
@@ -262,6 +300,11 @@ app.include_router(dashboard_router)
 # 挂载静态文件目录
 app.mount("/assets", StaticFiles(directory="templates/assets"), name="assets")
 
+@app.get("/ready")
+async def ready():
+    """就绪检查：已有可用密钥并加载了模型列表时返回 200，否则返回 503"""
+    return JSONResponse(status_code=200 if readiness.is_ready else 503, content=readiness.status())
+
 # 设置根路由路径
 dashboard_path = f"/{settings.DASHBOARD_URL}" if settings.DASHBOARD_URL else "/"
 
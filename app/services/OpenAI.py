@@ -10,6 +10,7 @@ import secrets
 import string
 from app.utils import format_log_message
 import app.config.settings as settings
+from app.config.snapshot import SettingsSnapshot, current_settings
 
 from app.utils.logging import log
 
@@ -28,8 +29,9 @@ class OpenAIClient:
     AVAILABLE_MODELS = []
     EXTRA_MODELS = os.environ.get("EXTRA_MODELS", "").split(",")
 
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, cfg: Optional[SettingsSnapshot] = None):
         self.api_key = api_key
+        self.cfg = cfg or current_settings()
 
     def filter_data_by_whitelist(data, allowed_keys):
         """
@@ -54,7 +56,7 @@ class OpenAIClient:
         data = self.filter_data_by_whitelist(request, whitelist)
 
         
-        if settings.search["search_mode"] and data.model.endswith("-search"):
+        if self.cfg.search["search_mode"] and data.model.endswith("-search"):
             log('INFO', "开启联网搜索模式", extra={'key': self.api_key[:8], 'model':request.model})
             data.setdefault("tools", []).append({"google_search": {}})
                 
@@ -65,7 +67,7 @@ class OpenAIClient:
         log('INFO', "流式请求开始", extra=extra_log)
 
         
-        url = f"{settings.GEMINI_BASE_URL}/v1beta/openai/chat/completions"
+        url = f"{self.cfg.GEMINI_BASE_URL}/v1beta/openai/chat/completions"
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}"
@@ -8,8 +8,12 @@ import httpx
 import secrets
 import string
 import app.config.settings as settings
+from app.config.snapshot import SettingsSnapshot, current_settings
 
 from app.utils.logging import log
+from app.utils.http_client import create_http_client, get_http_client
+from app.utils import metrics
+import time
 
 def generate_secure_random_string(length):
     all_characters = string.ascii_letters + string.digits
@@ -22,18 +26,32 @@ class GeneratedText:
     finish_reason: Optional[str] = None
 
 
+# 惰性字段尚未计算时的占位值（字段本身可能合法地为 None）
+_UNSET = object()
+
+
 class GeminiResponseWrapper:
-    def __init__(self, data: Dict[Any, Any]):  
+    """
+    Gemini 响应包装器。
+
+    流式响应中每个 chunk 都会创建一个实例，因此各字段在首次访问时才解析并缓存，
+    json_dumps 只在真正读取时才进行格式化序列化。
+    """
+    __slots__ = ('_data', '_model', '_text', '_finish_reason', '_prompt_token_count',
+                 '_candidates_token_count', '_total_token_count', '_thoughts',
+                 '_function_call', '_json_dumps')
+
+    def __init__(self, data: Dict[Any, Any]):
         self._data = data
-        self._text = self._extract_text()
-        self._finish_reason = self._extract_finish_reason()
-        self._prompt_token_count = self._extract_prompt_token_count()
-        self._candidates_token_count = self._extract_candidates_token_count()
-        self._total_token_count = self._extract_total_token_count()
-        self._thoughts = self._extract_thoughts()
-        self._function_call = self._extract_function_call()
-        self._json_dumps = json.dumps(self._data, indent=4, ensure_ascii=False)
         self._model = "gemini"
+        self._text = _UNSET
+        self._finish_reason = _UNSET
+        self._prompt_token_count = _UNSET
+        self._candidates_token_count = _UNSET
+        self._total_token_count = _UNSET
+        self._thoughts = _UNSET
+        self._function_call = _UNSET
+        self._json_dumps = _UNSET
 
     def _extract_thoughts(self) -> Optional[str]:
         try:
@@ -95,36 +113,59 @@ class GeminiResponseWrapper:
     def set_model(self,model) -> Optional[str]:
         self._model = model
 
+    def prepare_for_cache(self):
+        """
+        存入响应缓存前调用：计算读取缓存时会访问的惰性字段，使缓存测量的大小包含这些字段。
+        json_dumps 不会在缓存的响应上读取，仍保持惰性。
+        """
+        for field in ('text', 'thoughts', 'finish_reason', 'function_call',
+                      'prompt_token_count', 'candidates_token_count', 'total_token_count'):
+            getattr(self, field)
+
     @property
     def data(self) -> Dict[Any, Any]:
         return self._data
 
     @property
     def text(self) -> str:
+        if self._text is _UNSET:
+            self._text = self._extract_text()
         return self._text
 
     @property
     def finish_reason(self) -> Optional[str]:
+        if self._finish_reason is _UNSET:
+            self._finish_reason = self._extract_finish_reason()
         return self._finish_reason
 
     @property
     def prompt_token_count(self) -> Optional[int]:
+        if self._prompt_token_count is _UNSET:
+            self._prompt_token_count = self._extract_prompt_token_count()
         return self._prompt_token_count
 
     @property
     def candidates_token_count(self) -> Optional[int]:
+        if self._candidates_token_count is _UNSET:
+            self._candidates_token_count = self._extract_candidates_token_count()
         return self._candidates_token_count
 
     @property
     def total_token_count(self) -> Optional[int]:
+        if self._total_token_count is _UNSET:
+            self._total_token_count = self._extract_total_token_count()
         return self._total_token_count
 
     @property
     def thoughts(self) -> Optional[str]:
+        if self._thoughts is _UNSET:
+            self._thoughts = self._extract_thoughts()
         return self._thoughts
 
     @property
     def json_dumps(self) -> str:
+        if self._json_dumps is _UNSET:
+            self._json_dumps = json.dumps(self._data, indent=4, ensure_ascii=False)
         return self._json_dumps
 
     @property
@@ -133,6 +174,8 @@ class GeminiResponseWrapper:
 
     @property
     def function_call(self) -> Optional[Dict[str, Any]]:
+        if self._function_call is _UNSET:
+            self._function_call = self._extract_function_call()
         return self._function_call
 
 
@@ -142,8 +185,13 @@ class GeminiClient:
     extra_models_str = os.environ.get("EXTRA_MODELS", "")
     EXTRA_MODELS = [model.strip() for model in extra_models_str.split(",") if model.strip()]
 
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, http_client: Optional[httpx.AsyncClient] = None,
+                 cfg: Optional[SettingsSnapshot] = None):
         self.api_key = api_key
+        # 优先使用注入的连接池，其次使用全局共享连接池
+        self.http_client = http_client
+        # 请求处理期间使用同一份配置快照（联网搜索、随机字符串、上游地址）
+        self.cfg = cfg or current_settings()
 
     # 请求参数处理
     def _convert_request_data(self, request, contents, safety_settings, system_instruction):
@@ -169,7 +217,7 @@ class GeminiClient:
             api_version, data = self._convert_openAI_request(request, contents, safety_settings, system_instruction)
 
         # 联网模式
-        if settings.search["search_mode"] and request.model.endswith("-search"):
+        if self.cfg.search["search_mode"] and request.model.endswith("-search"):
             log('INFO', "开启联网搜索模式", extra={'key': self.api_key[:8], 'model':request.model})
             
             data.setdefault("tools", []).append({"google_search": {}})
@@ -276,17 +324,33 @@ class GeminiClient:
         api_version, model, data = self._convert_request_data(request, contents, safety_settings, system_instruction)
         
         
-        url = f"{settings.GEMINI_BASE_URL}/{api_version}/models/{model}:streamGenerateContent?key={self.api_key}&alt=sse"
+        url = f"{self.cfg.GEMINI_BASE_URL}/{api_version}/models/{model}:streamGenerateContent?key={self.api_key}&alt=sse"
         headers = {
             "Content-Type": "application/json",
         }
         
-        # 配置连接参数和超时
-        timeout = httpx.Timeout(380.0, connect=380.0)
-        limits = httpx.Limits(max_keepalive_connections=20, max_connections=100)
-        
-        async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        client = self.http_client or get_http_client()
+        if client is None:
+            # 连接池未初始化（例如脚本中直接调用），退回到临时客户端
+            async with create_http_client() as temp_client:
+                async for chunk in self._stream_chat_with(temp_client, request, url, headers, data):
+                    yield chunk
+            return
+
+        async for chunk in self._stream_chat_with(client, request, url, headers, data):
+            yield chunk
+
+    async def _stream_chat_with(self, client: httpx.AsyncClient, request, url, headers, data):
+        start = time.perf_counter()
+        key_label = metrics.key_label(self.api_key)
+        first_chunk = True
+        # 热路径上复用子指标，每个块只做一次加法
+        chunks_metric = metrics.upstream_chunks_total.labels(request.model)
+        responded = False
+        try:
             async with client.stream("POST", url, headers=headers, json=data) as response:
+                metrics.upstream_requests_total.labels(key_label, request.model, "stream", str(response.status_code)).inc()
+                responded = True
                 response.raise_for_status()
                 buffer = b"" # 用于累积可能不完整的 JSON 数据
                 try:
@@ -295,17 +359,21 @@ class GeminiClient:
                             continue
                         if line.startswith("data: "):
                             line = line[len("data: "):].strip() # 去除 "data: " 前缀
-                        
+                    
                         # 检查是否是结束标志，如果是，结束循环
                         if line == "[DONE]":
                             break 
-                        
+                    
                         buffer += line.encode('utf-8')
                         try:
                             # 尝试解析整个缓冲区
                             data = json.loads(buffer.decode('utf-8'))
                             # 解析成功，清空缓冲区
                             buffer = b"" 
+                            if first_chunk:
+                                first_chunk = False
+                                metrics.upstream_ttfb.labels(key_label, request.model, "stream").observe(time.perf_counter() - start)
+                            chunks_metric.inc()
                             yield GeminiResponseWrapper(data)
 
                         except json.JSONDecodeError:
@@ -319,28 +387,40 @@ class GeminiClient:
                     raise e
                 finally:
                     log('info', "流式请求结束")
+        except httpx.TransportError as e:
+            # 连接失败或超时，上游没有返回状态码
+            if not responded:
+                metrics.upstream_requests_total.labels(key_label, request.model, "stream", metrics.upstream_error_status(e)).inc()
+            raise
 
     # 非流式处理
     async def complete_chat(self, request, contents, safety_settings, system_instruction):
 
         api_version, model, data = self._convert_request_data(request, contents, safety_settings, system_instruction)
         
-        url = f"{settings.GEMINI_BASE_URL}/{api_version}/models/{model}:generateContent?key={self.api_key}"
+        url = f"{self.cfg.GEMINI_BASE_URL}/{api_version}/models/{model}:generateContent?key={self.api_key}"
         headers = {
             "Content-Type": "application/json",
         }
         
+        key_label = metrics.key_label(self.api_key)
         try:
-            # 配置连接参数和超时
-            timeout = httpx.Timeout(380.0, connect=380.0)
-            limits = httpx.Limits(max_keepalive_connections=20, max_connections=100)
-            
-            async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+            start = time.perf_counter()
+            client = self.http_client or get_http_client()
+            if client is None:
+                # 连接池未初始化时退回到临时客户端
+                async with create_http_client() as temp_client:
+                    response = await temp_client.post(url, headers=headers, json=data)
+            else:
                 response = await client.post(url, headers=headers, json=data) 
-                response.raise_for_status() # 检查 HTTP 错误状态
+            metrics.upstream_requests_total.labels(key_label, request.model, "non-stream", str(response.status_code)).inc()
+            response.raise_for_status() # 检查 HTTP 错误状态
+            metrics.upstream_ttfb.labels(key_label, request.model, "non-stream").observe(time.perf_counter() - start)
             
             return GeminiResponseWrapper(response.json())
-        except Exception as e:
+        except httpx.TransportError as e:
+            # 连接失败或超时，上游没有返回状态码
+            metrics.upstream_requests_total.labels(key_label, request.model, "non-stream", metrics.upstream_error_status(e)).inc()
             raise
 
     # OpenAI 格式请求转换为 gemini 格式请求
@@ -451,29 +531,34 @@ class GeminiClient:
         # --- 后处理 ---
         
         # 注入搜索提示
-        if settings.search["search_mode"] and model and model.endswith("-search"):
-            gemini_history.insert(len(gemini_history)-2,{'role': 'user', 'parts': [{'text':settings.search["search_prompt"]}]})
+        cfg = self.cfg
+        if cfg.search["search_mode"] and model and model.endswith("-search"):
+            gemini_history.insert(len(gemini_history)-2,{'role': 'user', 'parts': [{'text':cfg.search["search_prompt"]}]})
         
         # 注入随机字符串
-        if settings.RANDOM_STRING:
-            gemini_history.insert(1,{'role': 'user', 'parts': [{'text': generate_secure_random_string(settings.RANDOM_STRING_LENGTH)}]})
-            gemini_history.insert(len(gemini_history)-1,{'role': 'user', 'parts': [{'text': generate_secure_random_string(settings.RANDOM_STRING_LENGTH)}]})
+        if cfg.RANDOM_STRING:
+            gemini_history.insert(1,{'role': 'user', 'parts': [{'text': generate_secure_random_string(cfg.RANDOM_STRING_LENGTH)}]})
+            gemini_history.insert(len(gemini_history)-1,{'role': 'user', 'parts': [{'text': generate_secure_random_string(cfg.RANDOM_STRING_LENGTH)}]})
             log('INFO', "伪装消息成功")
         
         return gemini_history, system_instruction
 
     @staticmethod
-    async def list_available_models(api_key) -> list:
+    async def list_available_models(api_key, http_client: Optional[httpx.AsyncClient] = None) -> list:
         url = f"{settings.GEMINI_BASE_URL}/v1beta/models?key={api_key}"
-        async with httpx.AsyncClient() as client:
+        client = http_client or get_http_client()
+        if client is None:
+            async with create_http_client() as temp_client:
+                response = await temp_client.get(url)
+        else:
             response = await client.get(url)
-            response.raise_for_status()
-            data = response.json()
-            models = []
-            for model in data.get("models", []):
-                models.append(model["name"])
-                if model["name"].startswith("models/gemini-2") and settings.search["search_mode"]:
-                    models.append(model["name"] + "-search")
-            models.extend(GeminiClient.EXTRA_MODELS)
-                
-            return models
+        response.raise_for_status()
+        data = response.json()
+        models = []
+        for model in data.get("models", []):
+            models.append(model["name"])
+            if model["name"].startswith("models/gemini-2") and settings.search["search_mode"]:
+                models.append(model["name"] + "-search")
+        models.extend(GeminiClient.EXTRA_MODELS)
+            
+        return models
@@ -1,13 +1,12 @@
-import random
 import re
 import os
-import logging
 import asyncio
-from datetime import datetime, timedelta
-from apscheduler.schedulers.background import BackgroundScheduler
-from app.utils.logging import format_log_message
+from app.utils.logging import log
+from app.utils.http_client import create_http_client, get_http_client
+from app.utils.key_scheduler import KeyScheduler
+from app.config.snapshot import publish_settings
 import app.config.settings as settings
-logger = logging.getLogger("my_logger")
+from typing import Optional
 
 class APIKeyManager:
     def __init__(self, persistence=None):
@@ -20,101 +19,121 @@ class APIKeyManager:
             else:
                 break
 
-        self.key_stack = [] # 初始化密钥栈
-        self.temp_failed_keys = set()
         self.lock = asyncio.Lock()
         self.persistence = persistence
-        self._reset_key_stack() # 初始化时创建随机密钥栈
-        self.scheduler = BackgroundScheduler()
-        self.scheduler.add_job(self.reactivate_temp_failed_keys, 'cron', hour=8, minute=0, timezone='UTC')
-        self.scheduler.start()
+        self.key_scheduler = KeyScheduler()
+        self.refresh_keys() # 初始化时将密钥加入调度器
 
-    def _reset_key_stack(self):
-        """创建并随机化密钥栈"""
-        shuffled_keys = self.api_keys[:]  # 创建 api_keys 的副本以避免直接修改原列表
-        random.shuffle(shuffled_keys)
-        self.key_stack = shuffled_keys
+    def refresh_keys(self):
+        """api_keys 变化后调用，使调度器与当前密钥列表保持一致"""
+        self.key_scheduler.set_keys(self.api_keys)
 
-    async def get_available_key(self):
-        """从栈顶获取密钥，若栈空则重新生成
-        
-        实现负载均衡：
-        1. 维护一个随机排序的栈存储apikey
-        2. 每次调用从栈顶取出一个key返回
-        3. 栈空时重新随机生成栈
-        4. 确保异步和并发安全
+    def apply_validation(self, api_key: str, is_valid: bool):
+        """逐个应用密钥检测结果：有效密钥立即加入调度，无效密钥立即移出"""
+        if is_valid:
+            if api_key not in self.key_scheduler:
+                if api_key not in self.api_keys:
+                    self.api_keys.append(api_key)
+                self.key_scheduler.add(api_key)
+        elif api_key in self.key_scheduler:
+            if api_key in self.api_keys:
+                self.api_keys.remove(api_key)
+            self.key_scheduler.remove(api_key)
+
+    async def checkout_keys(self, n: int, exclude=()):
         """
-        async with self.lock:
-            # 如果栈为空，重新生成
-            if not self.key_stack:
-                self._reset_key_stack()
-            
-            # 从栈顶取出key
-            if self.key_stack:
-                return self.key_stack.pop()
-            
-            # 如果没有可用的API密钥，记录错误
+        一次取出最多 n 个互不相同的可用密钥，用于并发请求；exclude 中的密钥不会被返回。
+
+        调度器优先返回用量少、近期错误率低的密钥，并在内部完成每日限额检查；
+        每日限额按最近 24 小时的滑动窗口计算，所有密钥均已达到限额时只返回用量最少的一个。
+        """
+        keys = self.key_scheduler.checkout(n, exclude)
+        if not keys:
             if not self.api_keys:
-                log_msg = format_log_message('ERROR', "没有配置任何 API 密钥！")
-                logger.error(log_msg)
-            log_msg = format_log_message('ERROR', "没有可用的API密钥！")
-            logger.error(log_msg)
-            return None
+                log('error', "没有配置任何 API 密钥！")
+            log('error', "没有可用的API密钥！")
+        elif self.key_scheduler.get_usage(keys[0]) >= settings.API_KEY_DAILY_LIMIT > 0:
+            release_in = self.key_scheduler.next_release_in()
+            log('warning', f"所有API密钥已达到24小时调用限制，使用用量最少的密钥，最早 {release_in:.0f} 秒后恢复额度")
+        return keys
+
+    async def get_available_key(self):
+        """获取当前评分最优的一个密钥，没有可用密钥时返回 None"""
+        keys = await self.checkout_keys(1)
+        return keys[0] if keys else None
+
+    def report_success(self, api_key: str):
+        """请求成功后调用，累计密钥当日用量并降低其错误率"""
+        self.key_scheduler.record_success(api_key)
+
+    def report_failure(self, api_key: str):
+        """请求失败后调用，提高密钥的错误率使其被调度的优先级降低"""
+        self.key_scheduler.record_failure(api_key)
+
+    def get_usage(self, api_key: str) -> int:
+        """密钥最近 24 小时的调用次数"""
+        return self.key_scheduler.get_usage(api_key)
+
+    def reset_usage(self):
+        """手动重置统计时清零调度器中的密钥用量"""
+        self.key_scheduler.reset_usage()
 
     def show_all_keys(self):
-        log_msg = format_log_message('INFO', f"当前可用API key个数: {len(self.api_keys)} ")
-        logger.info(log_msg)
+        log('info', f"当前可用API key个数: {len(self.api_keys)} ")
         for i, api_key in enumerate(self.api_keys):
-            log_msg = format_log_message('INFO', f"API Key{i}: {api_key[:8]}...{api_key[-3:]}")
-            logger.info(log_msg)
+            log('info', f"API Key{i}: {api_key[:8]}...{api_key[-3:]}")
 
     async def handle_permanent_failure(self, api_key: str):
         async with self.lock:
             if api_key in self.api_keys:
                 self.api_keys.remove(api_key)
-                log_msg = format_log_message('WARNING', f"永久移除API Key: {api_key[:8]}...")
-                logger.warning(log_msg)
+                log('warning', f"永久移除API Key: {api_key[:8]}...")
                 
                 invalid_keys = set(settings.INVALID_API_KEYS.split(',')) if settings.INVALID_API_KEYS else set()
                 invalid_keys.add(api_key)
                 settings.INVALID_API_KEYS = ",".join(invalid_keys)
+                publish_settings()
                 
                 if self.persistence:
                     self.persistence.save_settings()
                 
-                self._reset_key_stack()
+                self.key_scheduler.remove(api_key)
 
     async def handle_temporary_failure(self, api_key: str):
-        async with self.lock:
-            if api_key in self.api_keys:
-                self.api_keys.remove(api_key)
-                self.temp_failed_keys.add(api_key)
-                log_msg = format_log_message('WARNING', f"暂时禁用API Key: {api_key[:8]}...")
-                logger.warning(log_msg)
-                self._reset_key_stack()
+        """临时失败（429、连接错误、超时）后让密钥按指数退避冷却，到期后自动恢复调度"""
+        delay = self.key_scheduler.record_failure(api_key, cooldown=True)
+        if delay:
+            log('warning', f"暂时禁用API Key: {api_key[:8]}...，{delay:.1f} 秒后恢复")
 
-    def reactivate_temp_failed_keys(self):
-        asyncio.run(self._reactivate_temp_failed_keys_async())
+    def get_cooldowns(self):
+        """获取冷却中的密钥列表，用于仪表盘展示"""
+        return self.key_scheduler.get_cooldowns()
 
-    async def _reactivate_temp_failed_keys_async(self):
-        async with self.lock:
-            if self.temp_failed_keys:
-                log_msg = format_log_message('INFO', f"重新激活 {len(self.temp_failed_keys)} 个临时失效的API Key")
-                logger.info(log_msg)
-                self.api_keys.extend(list(self.temp_failed_keys))
-                self.temp_failed_keys.clear()
-                self._reset_key_stack()
-
-async def test_api_key(api_key: str) -> bool:
+# 400 响应中表示密钥本身无效的标识，其他 400 错误不能说明密钥无效
+_INVALID_KEY_REASONS = ("API_KEY_INVALID", "API key not valid")
+
+async def test_api_key(api_key: str, http_client=None) -> Optional[bool]:
     """
     测试 API 密钥是否有效。
+
+    Returns:
+        True 有效；False 确认无效（400 密钥无效、401、403）；
+        None 无法判断（429、5xx、网络错误等），调用方应保持密钥原状态
     """
+    url = f"{settings.GEMINI_BASE_URL}/v1beta/models?key={api_key}"
     try:
-        import httpx
-        url = f"{settings.GEMINI_BASE_URL}/v1beta/models?key={api_key}"
-        async with httpx.AsyncClient() as client:
+        client = http_client or get_http_client()
+        if client is None:
+            async with create_http_client() as temp_client:
+                response = await temp_client.get(url)
+        else:
             response = await client.get(url)
-            response.raise_for_status()
-            return True
     except Exception:
+        return None
+    if response.is_success:
+        return True
+    if response.status_code in (401, 403):
+        return False
+    if response.status_code == 400 and any(reason in response.text for reason in _INVALID_KEY_REASONS):
         return False
+    return None
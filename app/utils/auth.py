@@ -40,7 +40,8 @@ async def custom_verify_password(
                'expected_password': settings.PASSWORD,
                'authorization_header': authorization,
                'x_goog_api_key_header': x_goog_api_key,
-               'key_query_param': key})
+               'key_query_param': key},
+        category='auth')
 
     # 进行校验和比对
     if not client_provided_api_key:
@@ -57,7 +58,7 @@ async def custom_verify_password(
         raise HTTPException(status_code=401, detail="Unauthorized: Invalid token")
     
     log('info', f"[DEBUG] 密码认证成功",
-        extra={'auth_method': auth_method})
+        extra={'auth_method': auth_method}, category='auth')
 
 def verify_web_password(password:str):
     if password != settings.WEB_PASSWORD:
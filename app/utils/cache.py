@@ -1,46 +1,143 @@
+import sys
 import time
 import xxhash 
 import asyncio
-from typing import Dict, Any, Optional, Tuple
+import heapq
+import itertools
+from typing import Dict, Any, Optional, Tuple, List
 import logging
-from collections import deque
+from collections import OrderedDict
 from app.utils.logging import log
 logger = logging.getLogger("my_logger")
-import heapq
 
 # 定义缓存项的结构
 CacheItem = Dict[str, Any]
 
+def estimate_retained_size(obj: Any) -> int:
+    """
+    估算对象及其引用的所有子对象占用的内存字节数。
+
+    递归遍历 dict/list/tuple/set 以及普通对象的 __dict__ / __slots__，
+    同一个对象只计算一次。用于在存入缓存时测量条目的实际内存占用。
+    """
+    seen = set()
+    stack = [obj]
+    total = 0
+    while stack:
+        current = stack.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        total += sys.getsizeof(current)
+
+        if isinstance(current, (str, bytes, bytearray, int, float, bool, type(None))):
+            continue
+        if isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            stack.extend(current)
+        else:
+            instance_dict = getattr(current, '__dict__', None)
+            if instance_dict is not None:
+                stack.append(instance_dict)
+            for cls in type(current).__mro__:
+                for slot in getattr(cls, '__slots__', ()):
+                    if hasattr(current, slot):
+                        stack.append(getattr(current, slot))
+    return total
+
 class ResponseCacheManager:
-    """管理API响应缓存的类，一个键可以对应多个缓存项（使用deque）"""
+    """
+    管理API响应缓存的类，一个键可以对应多个缓存项。
+
+    容量限制同时支持总条目数（max_entries）和总字节数（max_bytes，0 表示不限制），
+    每个条目的内存占用在存入时测量一次。
+
+    内部维护三个索引，使 get/store/淘汰 都是 O(1)（过期清理按实际移除数量计费）：
+    - cache: 缓存键 -> 按插入顺序排列的 {条目ID: 缓存项}
+    - _order: 全局 LRU 顺序索引 {条目ID: 缓存键}，最旧的在最前面，用于容量淘汰
+    - _expiry_heap: (过期时间, 条目ID) 最小堆，用于过期清理；已删除条目的堆记录惰性丢弃
+    """
     
     def __init__(self, expiry_time: int, max_entries: int, 
-                 cache_dict: Dict[str, deque[CacheItem]] = None):
+                 cache_dict: Dict[str, "OrderedDict[int, CacheItem]"] = None,
+                 max_bytes: int = 0):
         """
         初始化缓存管理器。
         
         Args:
             expiry_time (int): 缓存项的过期时间（秒）。
             max_entries (int): 缓存中允许的最大总条目数。
-            cache_dict (Dict[str, deque[CacheItem]], optional): 初始缓存字典。默认为 None。
+            cache_dict (Dict[str, OrderedDict[int, CacheItem]], optional): 初始缓存字典。默认为 None。
+            max_bytes (int, optional): 缓存中允许的最大总字节数，0 表示不限制。默认为 0。
         """
-        self.cache: Dict[str, deque[CacheItem]] = cache_dict if cache_dict is not None else {}
+        self.cache: Dict[str, "OrderedDict[int, CacheItem]"] = cache_dict if cache_dict is not None else {}
         self.expiry_time = expiry_time
         self.max_entries = max_entries # 总条目数限制
-        self.cur_cache_num = 0 # 当前条目数
+        self.max_bytes = max_bytes # 总字节数限制
+        self.cur_cache_bytes = 0 # 当前缓存占用字节数
+        self.evicted_bytes = 0 # 因容量限制累计淘汰的字节数
         self.lock = asyncio.Lock() # Added lock
 
+        self._order: "OrderedDict[int, str]" = OrderedDict()
+        self._expiry_heap: List[Tuple[float, int]] = []
+        self._ids = itertools.count()
+
+    @property
+    def cur_cache_num(self) -> int:
+        """当前条目数"""
+        return len(self._order)
+
+    def _remove_item(self, item_id: int, cache_key: str) -> Optional[CacheItem]:
+        """从所有索引中移除一个条目（调用方需持有锁）"""
+        self._order.pop(item_id, None)
+        items = self.cache.get(cache_key)
+        if items is None:
+            return None
+        item = items.pop(item_id, None)
+        if not items:
+            del self.cache[cache_key]
+        if item is not None:
+            self.cur_cache_bytes -= item.get('size', 0)
+        return item
+
+    def _over_capacity(self) -> bool:
+        """是否超出条目数或字节数限制"""
+        if len(self._order) > self.max_entries:
+            return True
+        # 至少保留最新的一个条目，避免刚存入的响应在被读取前就被淘汰
+        return self.max_bytes > 0 and self.cur_cache_bytes > self.max_bytes and len(self._order) > 1
+
+    def _evict_oldest(self) -> int:
+        """按 LRU 顺序淘汰最旧的条目直到满足容量限制，返回淘汰数量（调用方需持有锁）"""
+        removed = 0
+        while self._order and self._over_capacity():
+            item_id, cache_key = next(iter(self._order.items()))
+            item = self._remove_item(item_id, cache_key)
+            if item is not None:
+                self.evicted_bytes += item.get('size', 0)
+            removed += 1
+        return removed
+
+    def _compact_expiry_heap(self):
+        """当堆中已删除条目的记录过多时重建堆，保证堆大小与存活条目数同阶"""
+        if len(self._expiry_heap) > 2 * len(self._order) + 1024:
+            self._expiry_heap = [entry for entry in self._expiry_heap if entry[1] in self._order]
+            heapq.heapify(self._expiry_heap)
+
     async def get(self, cache_key: str) -> Tuple[Optional[Any], bool]: # Made async
         """获取指定键的第一个有效缓存项（不删除）"""
         now = time.time()
         async with self.lock:
-            if cache_key in self.cache:
-                cache_deque = self.cache[cache_key]
+            items = self.cache.get(cache_key)
+            if items:
                 # 查找第一个未过期的项，且不删除
-                for item in cache_deque:
+                for item_id, item in items.items():
                     if now < item.get('expiry_time', 0):
-                        response = item.get('response',None)
-                        return response, True
+                        # 命中后移动到 LRU 队尾
+                        self._order.move_to_end(item_id)
+                        return item.get('response', None), True
             
             return None, False
 
@@ -48,152 +145,92 @@ class ResponseCacheManager:
         """获取并删除指定键的第一个有效缓存项。"""
         now = time.time()
         async with self.lock:
-            if cache_key in self.cache:
-                cache_deque = self.cache[cache_key]
+            items = self.cache.get(cache_key)
+            if not items:
+                return None, False
 
-                # 查找第一个有效项并收集过期项
-                valid_item_to_remove = None
-                response_to_return = None
-                new_deque = deque()
-                items_removed_count = 0
+            # 查找第一个有效项，顺带移除排在它前面的过期项
+            expired_ids = []
+            found_id = None
+            for item_id, item in items.items():
+                if now < item.get('expiry_time', 0):
+                    found_id = item_id
+                    break
+                expired_ids.append(item_id)
 
-                for item in cache_deque:
-                    if now < item.get('expiry_time', 0):
-                        if valid_item_to_remove is None: # 找到第一个有效项
-                            valid_item_to_remove = item
-                            response_to_return = item.get('response', None)
-                            items_removed_count += 1 # 计数此项为移除
-                            
-                        else:
-                            new_deque.append(item) # 保留后续有效项
-                    else:
-                        items_removed_count += 1 # 计数过期项为移除
-
-                # 更新缓存状态
-                if items_removed_count > 0:
-                    self.cur_cache_num = max(0, self.cur_cache_num - items_removed_count)
-                    if not new_deque:
-                        # 如果所有项都被移除（过期或我们取的那个）
-                        del self.cache[cache_key]
-                    else:
-                        self.cache[cache_key] = new_deque
-
-                if valid_item_to_remove:
-                    return response_to_return, True # 返回找到的有效项
-
-            # 如果键不存在或未找到有效项
-            return None, False
+            for item_id in expired_ids:
+                self._remove_item(item_id, cache_key)
+
+            if found_id is None:
+                return None, False
+
+            item = self._remove_item(found_id, cache_key)
+            return item.get('response', None), True
 
     async def store(self, cache_key: str, response: Any):
-        """存储响应到缓存（追加到键对应的deque）"""
+        """存储响应到缓存（追加到键对应的条目末尾）"""
         now = time.time()
+        item_id = next(self._ids)
         new_item: CacheItem = {
             'response': response,
             'expiry_time': now + self.expiry_time,
             'created_at': now,
         }
+        # 惰性计算字段的响应先计算出读取时会用到的字段，否则测量的大小会偏小
+        prepare = getattr(response, 'prepare_for_cache', None)
+        if prepare is not None:
+            prepare()
+        # 在锁外测量条目的内存占用（未启用字节限制时也统计，便于在仪表盘上评估内存）
+        new_item['size'] = estimate_retained_size(response)
 
-        needs_cleaning = False
         async with self.lock:
-            if cache_key not in self.cache:
-                self.cache[cache_key] = deque()
-            
-            self.cache[cache_key].append(new_item) # 追加到deque末尾
-            self.cur_cache_num += 1
-            needs_cleaning = self.cur_cache_num > self.max_entries
-
-        if needs_cleaning:
-             # 在锁外调用清理，避免长时间持有锁
-             await self.clean_if_needed()
+            items = self.cache.get(cache_key)
+            if items is None:
+                items = self.cache[cache_key] = OrderedDict()
+            items[item_id] = new_item
+            self._order[item_id] = cache_key
+            self.cur_cache_bytes += new_item['size']
+            heapq.heappush(self._expiry_heap, (new_item['expiry_time'], item_id))
+
+            removed = self._evict_oldest()
+            self._compact_expiry_heap()
+
+        if removed:
+            log('info', f"因容量限制，清理了 {removed} 个旧缓存项。清理后缓存数: {self.cur_cache_num}")
+        if self.max_bytes > 0 and new_item['size'] > self.max_bytes:
+            log('warning', f"单个缓存项大小 {new_item['size']} 字节超过缓存字节上限 {self.max_bytes}")
 
     async def clean_expired(self):
-        """清理所有缓存项中已过期的项。"""
+        """清理已过期的缓存项，只访问真正需要移除的条目。"""
         now = time.time()
-        keys_to_remove = []
         total_cleaned = 0
         async with self.lock:
-            # 迭代 cache 的副本以允许在循环中安全地修改 cache
-            for key, cache_deque in list(self.cache.items()):
-                original_len = len(cache_deque)
-                # 创建一个新的 deque，只包含未过期的项
-                valid_items = deque(item for item in cache_deque if now < item.get('expiry_time', 0))
-                cleaned_count = original_len - len(valid_items)
-
-                if cleaned_count > 0:
-                    log('info', f"清理键 {key[:8]}... 的过期缓存项 {cleaned_count} 个。")
-                    total_cleaned += cleaned_count
-
-                if not valid_items:
-                    keys_to_remove.append(key) # 标记此键以便稍后删除
-                    # 在持有锁时直接删除键
-                    if key in self.cache:
-                         del self.cache[key]
-                         log('info', f"缓存键 {key[:8]}... 的所有项均已过期，移除该键。")
-                elif cleaned_count > 0:
-                    # 替换为只包含有效项的 deque
-                    self.cache[key] = valid_items
-
-            # 统一更新缓存计数
-            if total_cleaned > 0:
-                 self.cur_cache_num = max(0, self.cur_cache_num - total_cleaned)
+            heap = self._expiry_heap
+            while heap and heap[0][0] <= now:
+                _, item_id = heapq.heappop(heap)
+                cache_key = self._order.get(item_id)
+                if cache_key is None:
+                    continue  # 已被取走或淘汰
+                self._remove_item(item_id, cache_key)
+                total_cleaned += 1
+
+        if total_cleaned > 0:
+            log('info', f"清理过期缓存项 {total_cleaned} 个。当前缓存数: {self.cur_cache_num}")
 
     async def clean_if_needed(self):
-        """如果缓存总条目数超过限制，清理全局最旧的项目。"""
-
-        async with self.lock: 
-            if self.cur_cache_num <= self.max_entries:
-                return
-
-            # 计算目标大小和需要移除的数量
-            target_size = max(self.max_entries - 10, 10)
-            if self.cur_cache_num <= target_size:
-                return
-
-            items_to_remove_count = self.cur_cache_num - target_size
-            log('info', f"缓存总数 {self.cur_cache_num} 超过限制 {self.max_entries}，需要清理 {items_to_remove_count} 个")
-
-            # 收集所有缓存项及其元数据
-            all_items_meta = []
-            for key, cache_deque in self.cache.items():
-                for item in cache_deque:
-                    all_items_meta.append({'key': key, 'created_at': item.get('created_at', 0), 'item': item})
-
-            # 找出最旧的 N 项
-            actual_remove_count = min(items_to_remove_count, len(all_items_meta))
-            if actual_remove_count <= 0:
-                return # 没有项目可移除或无需移除
-
-            items_to_remove = heapq.nsmallest(actual_remove_count, all_items_meta, key=lambda x: x['created_at'])
-
-            # 执行移除
-            items_actually_removed = 0
-            keys_potentially_empty = set()
-            for item_meta in items_to_remove:
-                key_to_clean = item_meta['key']
-                item_to_clean = item_meta['item']
-
-                if key_to_clean in self.cache:
-                    try:
-                        # 直接从 deque 中移除指定的 item 对象
-                        self.cache[key_to_clean].remove(item_to_clean)
-                        items_actually_removed += 1
-                        # 计数器在最后统一更新
-                        log('info', f"因容量限制，删除键 {key_to_clean[:8]}... 的旧缓存项 (创建于 {item_meta['created_at']})。")
-                        keys_potentially_empty.add(key_to_clean)
-                    except (KeyError, ValueError):
-                        log('warning', f"尝试因容量限制删除缓存项时未找到 (可能已被提前移除): {key_to_clean[:8]}...")
-                        pass
-
-            # 检查是否有 deque 因本次清理变空
-            for key in keys_potentially_empty:
-                 if key in self.cache and not self.cache[key]:
-                     del self.cache[key]
-                     log('info', f"因容量限制清理后，键 {key[:8]}... 的deque已空，移除该键。")
-
-            # 统一更新缓存计数
-            if items_actually_removed > 0:
-                 self.cur_cache_num = max(0, self.cur_cache_num - items_actually_removed)
-                 log('info', f"因容量限制，共清理了 {items_actually_removed} 个旧缓存项。清理后缓存数: {self.cur_cache_num}")
+        """如果缓存总条目数超过限制，按 LRU 顺序清理最旧的项目。"""
+        async with self.lock:
+            removed = self._evict_oldest()
+
+        if removed:
+            log('info', f"因容量限制，共清理了 {removed} 个旧缓存项。清理后缓存数: {self.cur_cache_num}")
+
+def generate_payload_key(chat_request) -> str:
+    """
+    根据完整的请求内容（模型、全部消息、采样参数、工具等）生成键。
+    用于共享进行中的上游流：只有上游请求完全相同时才能共享同一个结果。
+    """
+    return xxhash.xxh64(chat_request.model_dump_json().encode("utf-8")).hexdigest()
 
 def generate_cache_key(chat_request, last_n_messages: int = 65536, is_gemini=False) -> str:
     """
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import time
+import xxhash
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional, Set
+from app.utils.logging import log
+import app.config.settings as settings
+
+# 每次构建都会变化、不参与变化检测的字段
+VOLATILE_FIELDS = ('current_time',)
+
+
+def _digest(value) -> str:
+    return xxhash.xxh64(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _event(name: str, data: dict) -> str:
+    return f"event: {name}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+class DashboardSnapshot:
+    """
+    仪表盘数据的后台快照。
+
+    有 SSE 订阅者、或最近一个刷新间隔内有轮询时，后台任务每 DASHBOARD_REFRESH_INTERVAL 秒调用 builder
+    重新构建一次数据；没有人查看仪表盘时后台任务休眠，current() 在快照过期时按需重建。
+    构建时按顶层字段（分区）计算摘要，有分区变化时版本号加一，并预先序列化 JSON 和计算 ETag。
+    /api/dashboard-data 直接返回预先序列化的快照（If-None-Match 命中时返回 304），
+    /api/dashboard-stream 的订阅者只收到发生变化的分区，多个仪表盘同时打开也只构建一次。
+    """
+
+    def __init__(self, builder: Callable[[], Awaitable[dict]], interval: Optional[float] = None):
+        self.builder = builder
+        self.interval = interval
+        self.version = 0
+        self.data: Dict[str, object] = {}
+        self.digests: Dict[str, str] = {}
+        self.body = b""
+        self.etag = ""
+        self.built_at = 0.0
+        self.dirty = True
+        self.last_polled = float('-inf')
+        self.subscribers: Set[asyncio.Queue] = set()
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def _interval(self) -> float:
+        return self.interval if self.interval is not None else settings.DASHBOARD_REFRESH_INTERVAL
+
+    async def refresh(self):
+        """重新构建快照，有分区变化时更新版本并通知订阅者"""
+        async with self._lock:
+            data = await self.builder()
+            digests = {name: _digest(value) for name, value in data.items() if name not in VOLATILE_FIELDS}
+            changed = [name for name, digest in digests.items() if self.digests.get(name) != digest]
+            removed = [name for name in self.digests if name not in digests]
+            self.built_at = time.monotonic()
+            self.dirty = False
+            if not changed and not removed and self.version:
+                return
+
+            self.version += 1
+            self.data = data
+            self.digests = digests
+            self.body = json.dumps(data, ensure_ascii=False, default=str).encode('utf-8')
+            self.etag = '"%s"' % xxhash.xxh64("".join(sorted(digests.values())).encode('ascii')).hexdigest()
+            self._publish({name: data[name] for name in changed + list(VOLATILE_FIELDS) if name in data})
+
+    def _publish(self, sections: dict):
+        for queue in self.subscribers:
+            try:
+                queue.put_nowait((self.version, sections))
+            except asyncio.QueueFull:
+                # 订阅者消费过慢：丢弃积压的增量，改为下次发送完整快照
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    def invalidate(self):
+        """配置或统计被修改后调用，下次读取时立即重建"""
+        self.dirty = True
+
+    def _stale(self) -> bool:
+        return time.monotonic() - self.built_at >= self._interval()
+
+    def _watched(self) -> bool:
+        """有 SSE 订阅者，或最近一个刷新间隔内有轮询"""
+        return bool(self.subscribers) or time.monotonic() - self.last_polled < self._interval()
+
+    async def current(self) -> 'DashboardSnapshot':
+        """返回最新快照；尚未构建、已失效或已过期时先重建，并唤醒后台任务"""
+        self.last_polled = time.monotonic()
+        self._wake.set()
+        if self.dirty or self._stale() or not self.version:
+            await self.refresh()
+        return self
+
+    async def stream(self) -> AsyncIterator[str]:
+        """SSE 事件流：先发送完整快照，之后只发送变化的分区"""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=16)
+        self.subscribers.add(queue)
+        try:
+            await self.current()
+            sent = self.version
+            yield _event('snapshot', {'version': sent, 'sections': self.data})
+            while True:
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if item is None:
+                    sent = self.version
+                    yield _event('snapshot', {'version': sent, 'sections': self.data})
+                elif item[0] > sent:
+                    # 已包含在之前发送的完整快照中的增量不再发送
+                    sent, sections = item
+                    yield _event('update', {'version': sent, 'sections': sections})
+        finally:
+            self.subscribers.discard(queue)
+
+    async def _run(self):
+        while True:
+            if not self._watched():
+                # 没有人查看仪表盘，等到下一次轮询或订阅再继续构建
+                self._wake.clear()
+                await self._wake.wait()
+            if self._stale():
+                try:
+                    await self.refresh()
+                except Exception as e:
+                    log('error', f"构建仪表盘快照失败: {str(e)}")
+            await asyncio.sleep(self._interval())
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -55,18 +55,24 @@ async def handle_gemini_error(error, current_api_key, key_manager) -> str:
             error_message = f'Gemini API 内部错误'
             log('WARNING', error_message,
                 extra={'key': current_api_key[:8], 'status_code': status_code})
+            if key_manager:
+                key_manager.report_failure(current_api_key)
             return error_message
    
         if status_code == 503:
             error_message = f"Gemini API 服务繁忙"
             log('WARNING', error_message,
                 extra={'key': current_api_key[:8], 'status_code': status_code})
+            if key_manager:
+                key_manager.report_failure(current_api_key)
             return error_message
         
         else:
             error_message = f"未知错误: {status_code}"
             log('WARNING', f"{status_code} 未知错误",
                 extra={'key': current_api_key[:8], 'status_code': status_code, 'error_message': error_message})
+            if key_manager:
+                key_manager.report_failure(current_api_key)
             
             return f"未知错误/模型不可用: {status_code}"
 
@@ -0,0 +1,149 @@
+import asyncio
+import math
+from collections import defaultdict, deque
+from typing import Awaitable, Callable, Dict, List, Tuple
+from app.utils.logging import log
+from app.utils.stats import api_stats_manager
+from app.utils import metrics
+import app.config.settings as settings
+
+
+class LatencyTracker:
+    """按模型记录最近成功请求的耗时，用于计算对冲延迟"""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: Dict[str, deque] = defaultdict(lambda: deque(maxlen=self.window))
+
+    def record(self, model: str, seconds: float):
+        self._samples[model].append(seconds)
+
+    def percentile(self, model: str, q: float):
+        """返回最近耗时的 q 分位数，样本不足时返回 None"""
+        samples = self._samples.get(model)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))
+        return ordered[index]
+
+    def hedge_delay(self, model: str, cfg=settings) -> float:
+        """对冲延迟：最近耗时的 HEDGE_PERCENTILE 分位数，不低于 HEDGE_MIN_DELAY"""
+        p = self.percentile(model, cfg.HEDGE_PERCENTILE)
+        if p is None:
+            return cfg.HEDGE_DEFAULT_DELAY
+        return max(cfg.HEDGE_MIN_DELAY, p)
+
+
+latency_tracker = LatencyTracker()
+
+
+class HedgedAttempts:
+    """
+    一批使用不同密钥的并发尝试，最多发出 budget 个。
+
+    未开启对冲时与原先行为一致，所有尝试同时发出；开启对冲（HEDGE_ENABLED）时先只发出第一个，
+    超过对冲延迟仍未完成、或进行中的尝试都已失败时才追加下一个。
+    密钥在尝试真正发出时才通过 checkout(n, exclude) 取出，未发出的对冲不占用密钥的调度顺序，
+    launched 只统计实际发出的尝试。
+    任一尝试成功后调用 settle()，取消其余仍在进行的尝试并记录被浪费的次数。
+    """
+
+    def __init__(self, checkout: Callable[..., Awaitable[List[str]]], budget: int,
+                 launch: Callable[[str], Awaitable[str]], model: str, cfg=settings):
+        self.model = model
+        self.checkout = checkout
+        self.budget = budget
+        self.launch = launch
+        self.used = set()
+        self.tasks: Dict[asyncio.Task, str] = {}
+        self.started: Dict[asyncio.Task, float] = {}
+        self.launched = 0
+        self.hedge = cfg.HEDGE_ENABLED
+        self.delay = latency_tracker.hedge_delay(model, cfg) if self.hedge else 0
+        self.next_hedge_at = None
+
+    async def start(self) -> bool:
+        """发出第一个尝试（未开启对冲时为全部尝试），没有可用密钥时返回 False"""
+        await self._launch(1 if self.hedge else self.budget)
+        return self.launched > 0
+
+    def __bool__(self):
+        return bool(self.tasks) or self.launched < self.budget
+
+    async def _launch(self, n: int):
+        keys = await self.checkout(n, exclude=self.used)
+        if not keys:
+            # 没有可用密钥，不再追加尝试
+            self.budget = self.launched
+        loop = asyncio.get_running_loop()
+        for api_key in keys:
+            log('info', f"非流式请求开始，使用密钥: {api_key[:8]}...",
+                extra={'key': api_key[:8], 'request_type': 'non-stream', 'model': self.model})
+            task = asyncio.create_task(self.launch(api_key))
+            self.used.add(api_key)
+            self.tasks[task] = api_key
+            self.started[task] = loop.time()
+            self.launched += 1
+        self.next_hedge_at = loop.time() + self.delay if (self.hedge and self.launched < self.budget) else None
+
+    async def wait(self, timeout: float = None) -> List[Tuple[str, asyncio.Task]]:
+        """
+        等待任一尝试完成，期间到达对冲时间则追加尝试。
+
+        Returns:
+            已完成的 (api_key, task) 列表；timeout 到期仍无完成的尝试时返回空列表
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+        while True:
+            if not self.tasks:
+                if self.launched >= self.budget:
+                    return []
+                # 进行中的尝试都已结束，无需等待对冲延迟
+                await self._launch(1)
+                if not self.tasks:
+                    return []
+
+            now = loop.time()
+            waits = [t - now for t in (deadline, self.next_hedge_at) if t is not None]
+            done, _ = await asyncio.wait(
+                list(self.tasks),
+                timeout=max(0, min(waits)) if waits else None,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            if done:
+                return [(self.tasks.pop(task), task) for task in done]
+
+            now = loop.time()
+            if self.next_hedge_at is not None and now >= self.next_hedge_at:
+                log('info', f"请求超过对冲延迟 {self.delay:.1f} 秒未完成，追加对冲请求",
+                    extra={'request_type': 'non-stream', 'model': self.model})
+                await self._launch(1)
+            if deadline is not None and now >= deadline:
+                return []
+
+    def settle(self, winner: asyncio.Task) -> int:
+        """
+        某个尝试成功后调用：记录其耗时，取消其余尝试。
+
+        Returns:
+            int: 被取消的尝试数（浪费的上游请求）
+        """
+        started = self.started.get(winner)
+        if started is not None:
+            latency_tracker.record(self.model, asyncio.get_running_loop().time() - started)
+
+        wasted = len(self.tasks)
+        for task in self.tasks:
+            task.cancel()
+        self.tasks.clear()
+        self.budget = self.launched
+
+        api_stats_manager.record_attempts(self.launched, wasted)
+        metrics.attempts_per_request.labels("non-stream").observe(self.launched)
+        if wasted:
+            log('info', f"已取消 {wasted} 个未完成的并发请求",
+                extra={'request_type': 'non-stream', 'model': self.model})
+        return wasted
@@ -0,0 +1,93 @@
+import httpx
+from typing import Optional
+from app.utils.logging import log
+import app.config.settings as settings
+
+# 全局共享的上游连接池，在 main.py 的 startup 事件中创建，shutdown 事件中关闭
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def _http2_available() -> bool:
+    """检查是否安装了 HTTP/2 支持所需的 h2 包"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def create_http_client() -> httpx.AsyncClient:
+    """
+    根据配置创建一个新的 httpx.AsyncClient。
+
+    连接池参数来自 settings 中的 HTTP_* 配置项，超时时间与原先每次请求创建的客户端保持一致。
+    """
+    http2 = settings.HTTP2_ENABLED
+    if http2 and not _http2_available():
+        log('warning', "未安装 h2 包，上游连接池回退到 HTTP/1.1")
+        http2 = False
+
+    timeout = httpx.Timeout(settings.HTTP_TIMEOUT, connect=settings.HTTP_CONNECT_TIMEOUT)
+    limits = httpx.Limits(
+        max_connections=settings.HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY,
+    )
+    return httpx.AsyncClient(timeout=timeout, limits=limits, http2=http2)
+
+
+async def init_http_client() -> httpx.AsyncClient:
+    """创建全局共享连接池（已存在时直接返回）"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = create_http_client()
+        log('info', "上游连接池已创建",
+            extra={'http2': settings.HTTP2_ENABLED,
+                   'max_connections': settings.HTTP_MAX_CONNECTIONS,
+                   'max_keepalive_connections': settings.HTTP_MAX_KEEPALIVE_CONNECTIONS})
+    return _http_client
+
+
+async def close_http_client():
+    """关闭全局共享连接池"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+        log('info', "上游连接池已关闭")
+
+
+def get_http_client() -> Optional[httpx.AsyncClient]:
+    """获取全局共享连接池，未初始化时返回 None"""
+    if _http_client is None or _http_client.is_closed:
+        return None
+    return _http_client
+
+
+def get_pool_stats() -> dict:
+    """
+    获取共享连接池的状态。
+
+    Returns:
+        dict: open(已打开连接数)、idle(空闲连接数)、in_flight(正在进行的请求数)
+    """
+    stats = {"enabled": False, "http2": False, "open": 0, "idle": 0, "in_flight": 0}
+    client = get_http_client()
+    if client is None:
+        return stats
+
+    stats["enabled"] = True
+    # httpx 未公开连接池状态，这里读取底层 httpcore 连接池的私有属性；
+    # httpx/httpcore 版本变化导致结构不一致时只返回已取得的部分，不影响仪表盘
+    try:
+        pool = getattr(getattr(client, "_transport", None), "_pool", None)
+        if pool is None:
+            return stats
+        stats["http2"] = bool(getattr(pool, "_http2", False))
+        connections = list(getattr(pool, "connections", None) or [])
+        stats["open"] = sum(1 for conn in connections if not getattr(conn, "is_closed", lambda: False)())
+        stats["idle"] = sum(1 for conn in connections if getattr(conn, "is_idle", lambda: False)())
+        stats["in_flight"] = len(getattr(pool, "_requests", None) or [])
+    except Exception:
+        pass
+    return stats
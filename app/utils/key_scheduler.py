@@ -0,0 +1,259 @@
+import heapq
+import random
+import threading
+import time
+from typing import Collection, Dict, List, Optional
+from app.utils.key_usage import KeyUsageWindow
+import app.config.settings as settings
+
+# 错误率指数滑动平均的平滑系数
+ERROR_EWMA_ALPHA = 0.2
+# 错误率在评分中的权重，1.0 表示错误率 100% 的密钥相当于多用了一整天的额度
+ERROR_WEIGHT = 1.0
+
+
+class KeyState:
+    """单个 API 密钥的健康状态"""
+    __slots__ = ('key', 'error_rate', 'failures', 'cooldown_until', 'version')
+
+    def __init__(self, key: str):
+        self.key = key
+        self.error_rate = 0.0       # 最近错误率（指数滑动平均）
+        self.failures = 0           # 连续临时失败次数，用于计算退避时间
+        self.cooldown_until = 0.0   # 冷却截止时间（time.monotonic），0 表示未冷却
+        self.version = 0            # 状态版本号，用于识别堆中的过期条目
+
+
+class KeyScheduler:
+    """
+    基于健康评分的 API 密钥调度器。
+
+    就绪密钥保存在最小堆中，按 (是否超出每日限额, 评分, 取出序号) 排序：
+    评分 = 最近 24 小时用量 / 每日限额 + 错误率 * ERROR_WEIGHT，取出序号保证评分相同的密钥轮流使用。
+    用量由 KeyUsageWindow 按分钟滑动统计，窗口前进使某些密钥用量减少时重新入堆，
+    因此密钥额度随时间连续恢复，负载在整个 24 小时窗口内均匀分布。
+    冷却中的密钥保存在另一个按到期时间排序的堆中，取密钥时惰性移回就绪堆。
+
+    状态变化时不在堆中原地修改，而是递增版本号并压入新条目，旧条目在弹出时丢弃，
+    因此取密钥、上报结果均为 O(log n)。
+    """
+
+    def __init__(self):
+        self._states: Dict[str, KeyState] = {}
+        self._ready = []       # (over_limit, score, seq, key, version)
+        self._cooling = []     # (cooldown_until, key, version)
+        self._seq = 0
+        self._usage = KeyUsageWindow()
+        self._lock = threading.Lock()
+        self.journal = None    # UsageJournal，计入用量窗口的调用同时写入增量日志
+
+    def _score(self, state: KeyState):
+        usage = self._usage.count(state.key)
+        limit = settings.API_KEY_DAILY_LIMIT
+        if limit > 0:
+            return usage >= limit, usage / limit + state.error_rate * ERROR_WEIGHT
+        return False, usage + state.error_rate * ERROR_WEIGHT
+
+    def _push(self, state: KeyState):
+        """递增版本号并将密钥按当前状态压入对应的堆"""
+        state.version += 1
+        if state.cooldown_until > time.monotonic():
+            heapq.heappush(self._cooling, (state.cooldown_until, state.key, state.version))
+        else:
+            state.cooldown_until = 0.0
+            over_limit, score = self._score(state)
+            self._seq += 1
+            heapq.heappush(self._ready, (over_limit, score, self._seq, state.key, state.version))
+            if len(self._ready) > 2 * len(self._states) + 1024:
+                self._rebuild()
+
+    def _rebuild(self):
+        """丢弃所有过期条目，按当前状态重建两个堆"""
+        self._ready = []
+        self._cooling = []
+        for state in self._states.values():
+            self._push(state)
+
+    def _release_cooled(self, now: float):
+        """将冷却已到期的密钥移回就绪堆"""
+        while self._cooling and self._cooling[0][0] <= now:
+            _, key, version = heapq.heappop(self._cooling)
+            state = self._states.get(key)
+            if state is not None and state.version == version:
+                state.cooldown_until = 0.0
+                self._push(state)
+
+    def _advance_window(self):
+        """推进用量窗口，用量减少的密钥按新评分重新入堆"""
+        for key in self._usage.advance():
+            state = self._states.get(key)
+            if state is not None:
+                self._push(state)
+
+    def _pop_ready(self) -> Optional[tuple]:
+        """弹出就绪堆中第一个有效条目"""
+        while self._ready:
+            entry = heapq.heappop(self._ready)
+            state = self._states.get(entry[3])
+            if state is not None and state.version == entry[4]:
+                return entry
+        return None
+
+    def set_keys(self, keys: List[str]):
+        """
+        设置参与调度的密钥集合。
+
+        已存在的密钥保留其用量和健康状态，新密钥以随机顺序加入，不再存在的密钥被移出调度。
+        """
+        with self._lock:
+            new_keys = [key for key in dict.fromkeys(keys) if key not in self._states]
+            random.shuffle(new_keys)
+            keep = set(keys)
+            # 暂时移出的密钥保留用量窗口，重新加入时额度不会被重置
+            self._states = {key: state for key, state in self._states.items() if key in keep}
+            for key in new_keys:
+                self._states[key] = KeyState(key)
+                self._usage.add_key(key)
+            self._rebuild()
+
+    def add(self, key: str):
+        """加入单个密钥，已存在时不做处理"""
+        with self._lock:
+            if key in self._states:
+                return
+            state = self._states[key] = KeyState(key)
+            self._usage.add_key(key)
+            self._push(state)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._states
+
+    def remove(self, key: str):
+        """移除密钥，堆中残留的条目会在弹出时被丢弃"""
+        with self._lock:
+            self._states.pop(key, None)
+            self._usage.remove_key(key)
+
+    def checkout(self, n: int = 1, exclude: Collection[str] = ()) -> List[str]:
+        """
+        取出最多 n 个互不相同的可用密钥，exclude 中的密钥（如本批次已在使用的）不会被返回，也不改变其调度顺序。
+
+        优先返回未超出每日限额的密钥；若所有就绪密钥均已超出限额，则返回用量最少的一个，
+        与原先"重置密钥栈后再取一个"的行为保持一致。冷却中的密钥不会被返回。
+        """
+        with self._lock:
+            self._release_cooled(time.monotonic())
+            self._advance_window()
+            taken = []
+            skipped = []
+            while len(taken) < n:
+                entry = self._pop_ready()
+                if entry is None:
+                    break
+                if entry[3] in exclude:
+                    skipped.append(entry)
+                    continue
+                over_limit = entry[0]
+                if over_limit and taken:
+                    # 堆顶已超出限额，说明剩余密钥都已超出限额
+                    heapq.heappush(self._ready, entry)
+                    break
+                taken.append(self._states[entry[3]])
+                if over_limit:
+                    break
+
+            for entry in skipped:
+                heapq.heappush(self._ready, entry)
+            # 重新入堆，取出序号递增使同评分的其他密钥排在前面
+            for state in taken:
+                self._push(state)
+            return [state.key for state in taken]
+
+    def record_success(self, key: str):
+        """记录一次成功调用：累计用量并降低错误率"""
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                return
+            self._advance_window()
+            now = time.time()
+            self._usage.record(key, now)
+            if self.journal is not None:
+                self.journal.append_key_use(key, now)
+            state.failures = 0
+            state.error_rate *= (1 - ERROR_EWMA_ALPHA)
+            self._push(state)
+
+    def record_failure(self, key: str, cooldown: bool = False) -> float:
+        """
+        记录一次失败调用并提高错误率。
+
+        cooldown 为 True 时（429、连接错误、超时等临时失败）按连续失败次数指数退避：
+        冷却时间 = min(KEY_COOLDOWN_MAX, KEY_COOLDOWN_BASE * 2^(连续失败次数-1))，
+        并在 [50%, 100%] 范围内随机抖动，避免大量密钥同时恢复。
+
+        Returns:
+            float: 本次设置的冷却秒数，未冷却时为 0
+        """
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                return 0.0
+            state.error_rate = state.error_rate * (1 - ERROR_EWMA_ALPHA) + ERROR_EWMA_ALPHA
+            delay = 0.0
+            if cooldown:
+                state.failures += 1
+                backoff = settings.KEY_COOLDOWN_BASE * (2 ** min(state.failures - 1, 32))
+                delay = min(settings.KEY_COOLDOWN_MAX, backoff) * random.uniform(0.5, 1.0)
+                state.cooldown_until = max(state.cooldown_until, time.monotonic() + delay)
+            self._push(state)
+            return delay
+
+    def reset_usage(self):
+        """清零所有密钥的用量窗口（仪表盘手动重置统计时调用）"""
+        with self._lock:
+            self._usage.clear()
+            self._rebuild()
+
+    def get_cooldowns(self) -> List[dict]:
+        """获取所有冷却中密钥的状态，按剩余时间升序排列"""
+        now = time.monotonic()
+        with self._lock:
+            cooling = [state for state in self._states.values() if state.cooldown_until > now]
+        cooling.sort(key=lambda state: state.cooldown_until)
+        return [{
+            'api_key': state.key[:8],
+            'remaining': round(state.cooldown_until - now, 1),
+            'failures': state.failures,
+        } for state in cooling]
+
+    def export_usage(self) -> Dict[str, List[tuple]]:
+        """导出所有密钥窗口内的分钟计数，用于持久化快照"""
+        with self._lock:
+            self._advance_window()
+            return self._usage.export()
+
+    def restore_usage(self, usage: Dict[str, List[tuple]]):
+        """从快照或增量日志恢复密钥的分钟计数，之后按新的用量重建调度堆"""
+        with self._lock:
+            self._advance_window()
+            for key, entries in usage.items():
+                self._usage.add_key(key)
+                for minute, count in entries:
+                    self._usage.add_count(key, minute, count)
+            self._rebuild()
+
+    def get_usage(self, key: str) -> int:
+        """密钥最近 24 小时的调用次数"""
+        with self._lock:
+            self._advance_window()
+            return self._usage.count(key)
+
+    def next_release_in(self) -> float:
+        """所有密钥中最早恢复一次额度还需的秒数，用于所有密钥都达到每日限额时提示"""
+        with self._lock:
+            self._advance_window()
+            return self._usage.next_release_in(self._states)
+
+    def __len__(self):
+        return len(self._states)
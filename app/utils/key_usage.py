@@ -0,0 +1,182 @@
+import bisect
+import heapq
+import time
+from array import array
+from collections import deque
+from typing import Dict, Iterable, List, Optional
+
+# 滑动窗口长度（分钟），即 API_KEY_DAILY_LIMIT 对应的 24 小时
+USAGE_WINDOW_MINUTES = 1440
+
+
+class KeyUsageWindow:
+    """
+    按密钥统计最近 24 小时调用次数的滑动窗口。
+
+    所有密钥共用一个 密钥数 × 1440 的 array('l') 矩阵，每行是一个密钥按分钟划分的环形计数，
+    totals 保存每行的窗口内总数，因此"最近 24 小时调用次数"为 O(1) 查询。
+    每行另外按时间顺序记录计数非零的分钟，最早的一个即下一次恢复额度的时间，同样为 O(1) 查询；
+    active 记录每个分钟计数非零的行，时间前进时只清零真正有调用的格子，
+    不再依赖每日定时重置，密钥额度随时间连续恢复。
+    """
+
+    def __init__(self, minutes: int = USAGE_WINDOW_MINUTES):
+        self.minutes = minutes
+        self.rows: Dict[str, int] = {}
+        self.row_keys: Dict[int, str] = {}
+        self.free_rows: List[int] = []
+        self.counts = array('l')
+        self.totals = array('q')
+        self.used: List[deque] = []             # 每行计数非零的分钟序号，升序
+        self.active: Dict[int, set] = {}        # 分钟序号 -> 该分钟计数非零的行
+        self.expiry: List[int] = []             # active 中分钟序号的最小堆
+        self.head = self._minute(time.time())   # 最新的分钟序号
+
+    @staticmethod
+    def _minute(now: float) -> int:
+        return int(now // 60)
+
+    def add_key(self, key: str):
+        if key in self.rows:
+            return
+        if self.free_rows:
+            row = self.free_rows.pop()
+        else:
+            row = len(self.totals)
+            self.counts.extend(bytes(self.counts.itemsize * self.minutes))
+            self.totals.append(0)
+            self.used.append(deque())
+        self.rows[key] = row
+        self.row_keys[row] = key
+
+    def remove_key(self, key: str):
+        row = self.rows.pop(key, None)
+        if row is None:
+            return
+        del self.row_keys[row]
+        self._clear_row(row)
+        self.free_rows.append(row)
+
+    def _clear_row(self, row: int):
+        base = row * self.minutes
+        for m in self.used[row]:
+            self.counts[base + m % self.minutes] = 0
+            self.active[m].discard(row)
+        self.used[row].clear()
+        self.totals[row] = 0
+
+    def _add(self, row: int, minute: int, count: int):
+        if not (self.head - self.minutes < minute <= self.head):
+            return
+        index = row * self.minutes + minute % self.minutes
+        if not self.counts[index]:
+            used = self.used[row]
+            if not used or used[-1] < minute:
+                used.append(minute)
+            else:
+                # 恢复快照时可能追加较早的分钟
+                used.insert(bisect.bisect_left(used, minute), minute)
+            rows = self.active.get(minute)
+            if rows is None:
+                rows = self.active[minute] = set()
+                heapq.heappush(self.expiry, minute)
+            rows.add(row)
+        self.counts[index] += count
+        self.totals[row] += count
+
+    def advance(self, now: Optional[float] = None) -> List[str]:
+        """
+        将窗口推进到当前分钟，清零滑出窗口的分钟。
+
+        Returns:
+            窗口内调用次数因此减少的密钥列表
+        """
+        minute = self._minute(time.time() if now is None else now)
+        if minute <= self.head:
+            return []
+        if minute - self.head >= self.minutes:
+            # 整个窗口都已滑出，直接整体清零
+            changed = [row for row in range(len(self.totals)) if self.totals[row]]
+            self._reset()
+        else:
+            changed = set()
+            cutoff = minute - self.minutes
+            while self.expiry and self.expiry[0] <= cutoff:
+                m = heapq.heappop(self.expiry)
+                column = m % self.minutes
+                for row in self.active.pop(m):
+                    index = row * self.minutes + column
+                    self.totals[row] -= self.counts[index]
+                    self.counts[index] = 0
+                    self.used[row].popleft()
+                    changed.add(row)
+        self.head = minute
+        return [self.row_keys[row] for row in changed if row in self.row_keys]
+
+    def record(self, key: str, now: Optional[float] = None):
+        """记录密钥的一次调用"""
+        row = self.rows.get(key)
+        if row is None:
+            return
+        now = time.time() if now is None else now
+        self.advance(now)
+        self._add(row, self._minute(now), 1)
+
+    def add_count(self, key: str, minute: int, count: int):
+        """向某一分钟追加计数，已滑出窗口或尚未到达的分钟被忽略"""
+        row = self.rows.get(key)
+        if row is not None:
+            self._add(row, minute, count)
+
+    def export(self) -> Dict[str, List[tuple]]:
+        """导出每个密钥窗口内非零的 (分钟序号, 计数)"""
+        result = {}
+        for key, row in self.rows.items():
+            if not self.totals[row]:
+                continue
+            base = row * self.minutes
+            result[key] = [(m, self.counts[base + m % self.minutes]) for m in self.used[row]]
+        return result
+
+    def count(self, key: str) -> int:
+        """密钥最近 24 小时的调用次数（调用前应先 advance）"""
+        row = self.rows.get(key)
+        return self.totals[row] if row is not None else 0
+
+    def seconds_until_free(self, key: str, now: Optional[float] = None) -> float:
+        """距离该密钥窗口内最早的一次调用滑出窗口（额度恢复一次）还有多少秒，窗口内没有调用时为 0"""
+        row = self.rows.get(key)
+        if row is None or not self.used[row]:
+            return 0.0
+        now = time.time() if now is None else now
+        return max(0.0, (self.used[row][0] + self.minutes) * 60 - now)
+
+    def next_release_in(self, keys: Iterable[str], now: Optional[float] = None) -> float:
+        """
+        keys 中最早恢复一次额度还需的秒数，都没有调用时为 0。
+
+        所有行中最早的分钟通常就属于 keys 中的密钥，此时为 O(1)；
+        只有它属于已移出调度的密钥时才逐个比较。
+        """
+        now = time.time() if now is None else now
+        while self.expiry and not self.active[self.expiry[0]]:
+            # 移除密钥留下的空分钟
+            del self.active[heapq.heappop(self.expiry)]
+        if not self.expiry:
+            return 0.0
+        oldest = self.expiry[0]
+        if any(self.row_keys.get(row) in keys for row in self.active[oldest]):
+            return max(0.0, (oldest + self.minutes) * 60 - now)
+        return min((self.seconds_until_free(key, now) for key in keys
+                    if key in self.rows and self.used[self.rows[key]]), default=0.0)
+
+    def _reset(self):
+        self.counts = array('l', bytes(len(self.counts) * self.counts.itemsize))
+        self.totals = array('q', bytes(len(self.totals) * self.totals.itemsize))
+        for used in self.used:
+            used.clear()
+        self.active.clear()
+        self.expiry.clear()
+
+    def clear(self):
+        self._reset()
@@ -0,0 +1,122 @@
+import asyncio
+import time
+from typing import Callable, Iterable, List, Optional, Tuple
+from app.utils.api_key import test_api_key
+from app.utils.logging import log
+import app.config.settings as settings
+
+
+class KeyValidator:
+    """
+    异步 API 密钥校验引擎。
+
+    在事件循环中用固定数量的 worker 从同一个迭代器中取密钥，并发数由 KEY_CHECK_CONCURRENCY 限制，
+    所有 worker 共用一个按时间槽分配的全局速率限制（KEY_CHECK_QPS），请求复用共享的上游连接池，
+    检测结果分为有效、无效和无法判断三种：只有上游明确拒绝密钥时才算无效，
+    限流、服务端错误、网络错误和超过 KEY_CHECK_TIMEOUT 秒未返回都算无法判断，密钥保持原状态。
+    有效和无效结果立即写入 progress 并通过 on_result 回调交给调用方（如 APIKeyManager.apply_validation），
+    不必等全部密钥检测完成；cancel() 会取消所有进行中的检测。
+    同一时间只运行一轮检测。
+    """
+
+    def __init__(self, check: Optional[Callable] = None):
+        self.check = check or test_api_key
+        self.progress = {
+            "is_running": False,
+            "completed": 0,
+            "total": 0,
+            "valid": 0,
+            "invalid": 0,
+            "unknown": 0,
+            "is_completed": False,
+            "cancelled": False
+        }
+        self._next_slot = 0.0
+        self._workers: List[asyncio.Task] = []
+
+    @property
+    def is_running(self) -> bool:
+        return self.progress["is_running"]
+
+    async def _throttle(self, qps: float):
+        """按全局速率分配时间槽，在槽到达前等待"""
+        if qps <= 0:
+            return
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + 1 / qps
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def run(self, keys: Iterable[str], on_result: Optional[Callable[[str, bool], None]] = None,
+                  concurrency: Optional[int] = None, qps: Optional[float] = None) -> Tuple[List[str], List[str]]:
+        """
+        检测一组密钥。
+
+        Returns:
+            (有效密钥列表, 无效密钥列表)，无法判断的密钥不在其中；被取消时只包含已完成检测的密钥
+        """
+        if self.is_running:
+            raise RuntimeError("已有API密钥检测正在进行中")
+        keys = list(dict.fromkeys(keys))
+        concurrency = concurrency or settings.KEY_CHECK_CONCURRENCY
+        qps = settings.KEY_CHECK_QPS if qps is None else qps
+        self.progress.update({
+            "is_running": True,
+            "completed": 0,
+            "total": len(keys),
+            "valid": 0,
+            "invalid": 0,
+            "unknown": 0,
+            "is_completed": False,
+            "cancelled": False
+        })
+        valid_keys, invalid_keys = [], []
+        pending = iter(keys)
+
+        async def worker():
+            for key in pending:
+                await self._throttle(qps)
+                try:
+                    is_valid = await asyncio.wait_for(self.check(key), settings.KEY_CHECK_TIMEOUT)
+                except asyncio.TimeoutError:
+                    log('warning', f"测试API密钥 {key[:8]}... 超时")
+                    is_valid = None
+                except Exception as e:
+                    log('error', f"测试API密钥 {key[:8]}... 时出错: {str(e)}")
+                    is_valid = None
+                self.progress["completed"] += 1
+                if is_valid is None:
+                    self.progress["unknown"] += 1
+                    log('warning', f"无法判断API密钥 {key[:8]}... 是否有效，保持原状态")
+                    continue
+                if is_valid:
+                    valid_keys.append(key)
+                    self.progress["valid"] += 1
+                else:
+                    invalid_keys.append(key)
+                    self.progress["invalid"] += 1
+                    log('warning', f"API密钥 {key[:8]}... 无效")
+                if on_result is not None:
+                    on_result(key, is_valid)
+
+        self._workers = [asyncio.create_task(worker()) for _ in range(min(concurrency, len(keys)))]
+        try:
+            await asyncio.gather(*self._workers, return_exceptions=True)
+        finally:
+            self._workers = []
+            self.progress.update({"is_running": False, "is_completed": True})
+        return valid_keys, invalid_keys
+
+    def cancel(self) -> bool:
+        """取消当前检测，已完成的结果保留；没有检测在运行时返回 False"""
+        if not self.is_running:
+            return False
+        self.progress["cancelled"] = True
+        for task in self._workers:
+            task.cancel()
+        return True
+
+
+# 全局密钥校验引擎，仪表盘的手动检测和启动时的后台检测共用
+key_validator = KeyValidator()
@@ -0,0 +1,37 @@
+import importlib
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+    延迟导入的模块代理，第一次访问其属性时才真正导入模块。
+
+    Vertex（google-genai、google-auth、openai）和 MySQL 等后端只有启用或第一次使用时才需要，
+    在模块顶层用 lazy_import() 代替 import，未启用这些后端时重量级 SDK 不会被加载，
+    从而缩短冷启动时间并减少常驻内存。
+    """
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.__dict__['_module'] = None
+
+    def _load(self) -> types.ModuleType:
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, name: str):
+        return getattr(self._load(), name)
+
+
+def lazy_import(name: str) -> LazyModule:
+    """返回模块 name 的延迟导入代理"""
+    return LazyModule(name)
+
+
+def is_loaded(name: str) -> bool:
+    """模块是否已经被导入"""
+    return name in sys.modules
@@ -1,4 +1,11 @@
+import atexit
 import logging
+import math
+import queue
+import re
+import sys
+import threading
+import time
 from datetime import datetime
 from collections import deque
 from threading import Lock
@@ -24,44 +31,104 @@ console_formatter = logging.Formatter('%(message)s')
 console_handler.setFormatter(console_formatter) 
 logger.addHandler(console_handler)
 
-# 日志缓存，用于在网页上显示最近的日志
-class LogManager:
-    def __init__(self, max_logs=100):
-        self.logs = deque(maxlen=max_logs)  # 使用双端队列存储最近的日志
+# 日志缓存，用于在网页上按序号增量获取日志
+class LogStore:
+    """
+    有界的日志存储，每条日志带单调递增的序号 seq。
+
+    日志按序号连续存放，序号减去最旧序号即为在 deque 中的位置（deque 按位置访问靠近两端时很快，
+    访问中间位置的开销随长度线性增长）；对 index_fields 中的字段（如级别、密钥、模型）
+    另外维护 字段值 -> 序号队列 的二级索引，按条件查询新日志时只遍历对应索引的末尾，
+    不必扫描全部日志。超出容量时最旧的日志被淘汰，索引中失效的序号在写入时顺带清理。
+    """
+
+    def __init__(self, max_logs=5000, index_fields=('level', 'key', 'model')):
+        self.logs = deque(maxlen=max_logs)
+        self.index_fields = index_fields
+        self.indexes = {field: {} for field in index_fields}
+        self.last_seq = 0
         self.lock = Lock()
-    
+
+    @property
+    def first_seq(self):
+        return self.last_seq - len(self.logs) + 1
+
     def add_log(self, log_entry):
         with self.lock:
+            self.last_seq += 1
+            log_entry['seq'] = self.last_seq
             self.logs.append(log_entry)
-    
-    def get_recent_logs(self, count=50):
-        with self.lock:
-            return list(self.logs)[-count:]
+            first_seq = self.first_seq
+            for field, index in self.indexes.items():
+                seqs = index.get(log_entry.get(field, ''))
+                if seqs is None:
+                    seqs = index[log_entry.get(field, '')] = deque()
+                seqs.append(self.last_seq)
+                while seqs[0] < first_seq:
+                    seqs.popleft()
+            if len(self.logs) == self.logs.maxlen and self.last_seq % self.logs.maxlen == 0:
+                self._prune(first_seq)
 
-# 创建日志管理器实例 (输出到前端)
-log_manager = LogManager()
+    def _prune(self, first_seq):
+        # 每写满一轮清理一次只在淘汰时出现过的字段值，避免索引字典无限增长
+        for index in self.indexes.values():
+            for value in [value for value, seqs in index.items() if seqs[-1] < first_seq]:
+                del index[value]
 
-# Vertex日志缓存，用于在网页上显示最近的Vertex日志
-class VertexLogManager:
-    def __init__(self, max_logs=100):
-        self.logs = deque(maxlen=max_logs)  # 使用双端队列存储最近的Vertex日志
-        self.lock = Lock()
-    
-    def add_log(self, log_entry):
+    def query(self, after=0, limit=500, **filters):
+        """
+        返回 (序号大于 after 且满足所有过滤条件的日志, 下次查询使用的 after, 是否还有更多日志)。
+
+        日志按序号升序，最多 limit 条，超出时返回最旧的 limit 条，下次查询的 after 为最后一条的序号，
+        客户端接着查询即可取得剩余日志，不会出现缺口；没有更多日志时为当前最新序号。
+        filters 中值为空的条件被忽略；字段有二级索引时从最短的索引遍历，否则遍历全部日志。
+        """
+        filters = {field: value for field, value in filters.items() if value not in (None, '')}
         with self.lock:
-            self.logs.append(log_entry)
-    
+            first_seq = self.first_seq
+            start = max(after + 1, first_seq)
+            candidates = None
+            for field, value in filters.items():
+                if field in self.indexes:
+                    seqs = self.indexes[field].get(value, ())
+                    if candidates is None or len(seqs) < len(candidates):
+                        candidates = seqs
+            if candidates is None:
+                candidates = range(start, self.last_seq + 1)
+            else:
+                # 从索引末尾向前找到 after 之后的部分，只遍历新日志
+                newer = []
+                for seq in reversed(candidates):
+                    if seq < start:
+                        break
+                    newer.append(seq)
+                newer.reverse()
+                candidates = newer
+
+            result = []
+            for seq in candidates:
+                entry = self.logs[seq - first_seq]
+                if all(entry.get(field, '') == value for field, value in filters.items()):
+                    if len(result) >= limit:
+                        return result, result[-1]['seq'], True
+                    result.append(entry)
+            return result, self.last_seq, False
+
     def get_recent_logs(self, count=50):
         with self.lock:
             return list(self.logs)[-count:]
 
-# 创建Vertex日志管理器实例 (输出到前端)
-vertex_log_manager = VertexLogManager()
+# 创建日志管理器实例 (输出到前端)
+log_manager = LogStore()
+
+# Vertex日志管理器实例 (输出到前端)
+vertex_log_manager = LogStore(index_fields=('level', 'vertex_id', 'operation'))
 
-def format_log_message(level, message, extra=None):
+def format_log_message(level, message, extra=None, created=None):
     extra = extra or {}
+    asctime = datetime.fromtimestamp(created if created is not None else time.time()).strftime("%Y-%m-%d %H:%M:%S")
     log_values = {
-        'asctime': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'asctime': asctime,
         'levelname': level,
         'key': extra.get('key', ''),
         'request_type': extra.get('request_type', ''),
@@ -75,7 +142,7 @@ def format_log_message(level, message, extra=None):
     
     # 将格式化后的日志添加到日志管理器
     log_entry = {
-        'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'timestamp': asctime,
         'level': level,
         'key': extra.get('key', ''),
         'request_type': extra.get('request_type', ''),
@@ -89,10 +156,11 @@ def format_log_message(level, message, extra=None):
     
     return formatted_log
 
-def vertex_format_log_message(level, message, extra=None):
+def vertex_format_log_message(level, message, extra=None, created=None):
     extra = extra or {}
+    asctime = datetime.fromtimestamp(created if created is not None else time.time()).strftime("%Y-%m-%d %H:%M:%S")
     log_values = {
-        'asctime': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'asctime': asctime,
         'levelname': level,
         'vertex_id': extra.get('vertex_id', ''),
         'operation': extra.get('operation', ''),
@@ -105,7 +173,7 @@ def vertex_format_log_message(level, message, extra=None):
     
     # 将格式化后的Vertex日志添加到Vertex日志管理器
     log_entry = {
-        'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'timestamp': asctime,
         'level': level,
         'vertex_id': extra.get('vertex_id', ''),
         'operation': extra.get('operation', ''),
@@ -119,30 +187,212 @@ def vertex_format_log_message(level, message, extra=None):
     return formatted_log
     
     
+# 日志级别，低于该级别的日志在 log() 入口直接丢弃
+_LEVELS = {}
+for _name, _value in (('debug', logging.DEBUG), ('info', logging.INFO), ('warning', logging.WARNING),
+                      ('error', logging.ERROR), ('critical', logging.CRITICAL)):
+    _LEVELS[_name] = _LEVELS[_name.upper()] = _value
+_min_level = logging.DEBUG
+
+
+def configure_log_sampling(rates: str, interval: float, repeat_limit: int = 20):
+    """设置各类别日志的采样率、聚合周期（秒）和未分类日志的重复上限"""
+    log_pipeline.sampler.configure(rates, interval, repeat_limit)
+
+
+def set_log_level(level: str):
+    """设置最低日志级别（DEBUG/INFO/WARNING/ERROR/CRITICAL），未设置或无法识别时输出全部日志"""
+    global _min_level
+    _min_level = _LEVELS.get(level.strip(), logging.DEBUG) if level else logging.DEBUG
+
+
+class LogSampler:
+    """
+    按类别采样并聚合高频日志，在后台线程中使用。
+
+    带 category 的 DEBUG/INFO 日志按该类别的采样率输出（按计数均匀抽取，1 为全部输出，0 为全部省略）；
+    未指定类别的日志按消息模板（数字替换为 #）分组，每个周期内同一模板只输出前 repeat_limit 条。
+    每个聚合周期结束时，为有日志被省略的类别或模板输出一条汇总（"x1532，已省略 1380 条"）。
+    WARNING 及以上级别的日志始终输出。
+    """
+
+    # 一个周期内最多跟踪的消息模板数，超出后新模板直接输出，避免窗口无限增长
+    MAX_TEMPLATES = 1000
+    _DIGITS = re.compile(r'\d+')
+
+    def __init__(self):
+        self.rates = {}
+        self.interval = 10.0
+        self.repeat_limit = 20
+        self.window = {}   # 类别或 ('template', 消息模板) -> [出现次数, 输出次数, 最近一条消息]
+        self.templates = 0
+        self.window_start = time.monotonic()
+
+    def configure(self, rates: str = "", interval: float = 10.0, repeat_limit: int = 20):
+        """rates 格式为 类别:采样率,类别:采样率，例如 auth:0,stats:0.1"""
+        parsed = {}
+        for item in (rates or "").split(','):
+            if ':' not in item:
+                continue
+            category, rate = item.split(':', 1)
+            try:
+                parsed[category.strip()] = min(1.0, max(0.0, float(rate)))
+            except ValueError:
+                continue
+        self.rates = parsed
+        self.interval = interval
+        self.repeat_limit = repeat_limit
+
+    def admit(self, levelno: int, message: str, category) -> bool:
+        if levelno >= logging.WARNING:
+            return True
+        if category is None:
+            return self._admit_untagged(message)
+        stats = self.window.get(category)
+        if stats is None:
+            stats = self.window[category] = [0, 0, None]
+        stats[0] += 1
+        stats[2] = message
+        rate = self.rates.get(category, 1.0)
+        # 计数跨过 1/rate 的整数倍时输出一条，保证首条输出且采样均匀
+        if math.ceil(stats[0] * rate) > math.ceil((stats[0] - 1) * rate):
+            stats[1] += 1
+            return True
+        return False
+
+    def _admit_untagged(self, message: str) -> bool:
+        if self.repeat_limit <= 0:
+            return True
+        key = ('template', self._DIGITS.sub('#', str(message)))
+        stats = self.window.get(key)
+        if stats is None:
+            if self.templates >= self.MAX_TEMPLATES:
+                return True
+            self.templates += 1
+            stats = self.window[key] = [0, 0, None]
+        stats[0] += 1
+        stats[2] = message
+        if stats[0] <= self.repeat_limit:
+            stats[1] += 1
+            return True
+        return False
+
+    def timeout(self):
+        """距离本周期结束的秒数；没有被省略的日志时返回 None（无需定时唤醒）"""
+        if not any(seen > emitted for seen, emitted, _ in self.window.values()):
+            return None
+        return max(0.0, self.window_start + self.interval - time.monotonic())
+
+    def summaries(self, force: bool = False) -> list:
+        """周期结束时返回各类别的汇总消息并开始新周期"""
+        now = time.monotonic()
+        if not force and now - self.window_start < self.interval:
+            return []
+        elapsed = now - self.window_start
+        lines = [f"日志聚合 [{key if isinstance(key, str) else '重复消息'}]: 最近 {elapsed:.0f} 秒 x{seen}，"
+                 f"已省略 {seen - emitted} 条，最近一条: {last}"
+                 for key, (seen, emitted, last) in self.window.items() if seen > emitted]
+        self.window = {}
+        self.templates = 0
+        self.window_start = now
+        return lines
+
+
+class LogPipeline:
+    """
+    非阻塞日志管道。
+
+    请求路径上的 log() 只把 (时间, 级别, 消息, extra, 格式化函数) 元组放入 SimpleQueue；
+    后台线程负责格式化、写入前端日志缓存和控制台输出，事件循环不再等待 I/O 和线程锁。
+    """
+
+    _FLUSH = object()
+
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.sampler = LogSampler()
+        self._start_lock = Lock()
+
+    def submit(self, record: tuple):
+        if self.thread is None:
+            self._start()
+        self.queue.put(record)
+
+    def _start(self):
+        with self._start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="log-pipeline", daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                record = self.queue.get(timeout=self.sampler.timeout())
+            except queue.Empty:
+                record = False
+            if record is None:
+                self._emit_summaries(force=True)
+                return
+            if record is not False:
+                if record[0] is self._FLUSH:
+                    self._emit_summaries(force=True)
+                    record[1].set()
+                    continue
+                try:
+                    created, levelno, level, message, extra, formatter = record
+                    category = extra.get('category') if extra else None
+                    if self.sampler.admit(levelno, message, category):
+                        logger.log(levelno, formatter(level, message, extra=extra, created=created))
+                except Exception as e:
+                    # 格式化出错时不能再走 log()，直接把原始消息和错误写到标准错误
+                    self._fallback(record, e)
+            self._emit_summaries()
+
+    @staticmethod
+    def _fallback(record, error: Exception):
+        try:
+            message = record[3] if isinstance(record, tuple) and len(record) > 3 else record
+            sys.stderr.write(f"日志格式化失败: {type(error).__name__}: {error}; 原始消息: {message!r}\n")
+        except Exception:
+            pass
+
+    def _emit_summaries(self, force: bool = False):
+        for line in self.sampler.summaries(force):
+            logger.info(format_log_message('INFO', line))
+
+    def flush(self, timeout: float = 5.0):
+        """等待已提交的日志全部输出"""
+        if self.thread is None:
+            return
+        done = threading.Event()
+        self.queue.put((self._FLUSH, done))
+        done.wait(timeout)
+
+    def stop(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout=5.0)
+
+
+log_pipeline = LogPipeline()
+atexit.register(log_pipeline.stop)
+
+
+def _submit(level: str, message: str, extra, kwargs, formatter):
+    levelno = _LEVELS.get(level, logging.INFO)
+    if levelno < _min_level:
+        return
+    if extra is not None and not isinstance(extra, dict):
+        extra = None
+    if kwargs:
+        # kwargs 会覆盖 extra 中的同名键
+        extra = {**extra, **kwargs} if extra else kwargs
+    log_pipeline.submit((time.time(), levelno, level.upper(), message, extra, formatter))
+
+
 def log(level: str, message: str, extra: dict = None, **kwargs):
-    final_extra = {}
-    
-    if extra is not None and isinstance(extra, dict):
-        final_extra.update(extra)
-    
-    # 将 kwargs 中的其他关键字参数合并进来，kwargs 会覆盖 extra 中的同名键
-    final_extra.update(kwargs)
-    
-    # 调用 format_log_message，传递合并后的 final_extra 字典
-    msg = format_log_message(level.upper(), message, extra=final_extra)
-    
-    getattr(logger, level.lower())(msg)
+    _submit(level, message, extra, kwargs, format_log_message)
 
 def vertex_log(level: str, message: str, extra: dict = None, **kwargs):
-    final_extra = {}
-    
-    if extra is not None and isinstance(extra, dict):
-        final_extra.update(extra)
-    
-    # 将 kwargs 中的其他关键字参数合并进来，kwargs 会覆盖 extra 中的同名键
-    final_extra.update(kwargs)
-    
-    # 调用 vertex_format_log_message，传递合并后的 final_extra 字典
-    msg = vertex_format_log_message(level.upper(), message, extra=final_extra)
-    
-    getattr(logger, level.lower())(msg)
\ No newline at end of file
+    _submit(level, message, extra, kwargs, vertex_format_log_message)
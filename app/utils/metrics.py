@@ -0,0 +1,221 @@
+import hashlib
+import time
+import httpx
+from bisect import bisect_left
+from functools import lru_cache
+from typing import Collection, Dict, List, Tuple
+from fastapi.responses import StreamingResponse
+
+# 默认延迟分桶（秒），覆盖从首字节到长时间思考的完整请求
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+# 每个请求尝试的上游次数分桶
+ATTEMPT_BUCKETS = (1, 2, 3, 5, 8, 13, 21)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class GaugeChild(CounterChild):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # 最后一个为 +Inf 桶
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Metric:
+    """
+    按标签值分组的指标。
+
+    所有记录都在事件循环中进行，子指标的 inc/observe 只是属性加法，不加锁；
+    热路径（如每个 SSE 块）应先调用 labels() 取得子指标并复用。
+    """
+    kind = "untyped"
+    child_class = CounterChild
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children: Dict[Tuple[str, ...], object] = {}
+
+    def _new_child(self):
+        return self.child_class()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self._new_child()
+        return child
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+                for values, child in self.children.items()]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+
+class Gauge(Metric):
+    kind = "gauge"
+    child_class = GaugeChild
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return HistogramChild(self.buckets)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for values, child in self.children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format_value(float(bound))
+                bucket_labels = _format_labels(self.labelnames, values, 'le="%s"' % le)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """进程内指标注册表，按 Prometheus 文本格式输出"""
+
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+registry = MetricsRegistry()
+
+requests_total = registry.register(Counter(
+    "hajimi_requests_total", "客户端请求数", ("backend", "mode", "model", "status")))
+request_duration = registry.register(Histogram(
+    "hajimi_request_duration_seconds", "客户端请求总耗时（流式响应计算到最后一个块）", ("backend", "mode", "model")))
+inflight_streams = registry.register(Gauge(
+    "hajimi_inflight_streams", "正在向客户端发送的流式响应数", ("backend",)))
+upstream_requests_total = registry.register(Counter(
+    "hajimi_upstream_requests_total", "上游请求数", ("key", "model", "mode", "status")))
+upstream_ttfb = registry.register(Histogram(
+    "hajimi_upstream_ttfb_seconds", "上游首字节耗时（流式为第一个块，非流式为完整响应）", ("key", "model", "mode")))
+upstream_chunks_total = registry.register(Counter(
+    "hajimi_upstream_stream_chunks_total", "上游流式响应的块数", ("model",)))
+attempts_per_request = registry.register(Histogram(
+    "hajimi_attempts_per_request", "每个成功请求使用的上游请求次数（含重试与并发尝试）", ("mode",),
+    buckets=ATTEMPT_BUCKETS))
+empty_responses_total = registry.register(Counter(
+    "hajimi_empty_responses_total", "上游空响应数", ("model", "mode")))
+cache_requests_total = registry.register(Counter(
+    "hajimi_cache_requests_total", "响应缓存查询数", ("result",)))
+key_cooldowns = registry.register(Gauge(
+    "hajimi_key_cooldowns", "冷却中的API密钥数"))
+coalescer_flights = registry.register(Gauge(
+    "hajimi_coalescer_flights", "合并器中进行中的上游请求数"))
+
+
+def model_label(model: str, known: Collection[str]) -> str:
+    """模型标签：不在已知模型中的名称记为 other，客户端传入任意字符串不会让标签无限增长"""
+    return model if model in known else "other"
+
+
+@lru_cache(maxsize=1024)
+def key_label(api_key: str) -> str:
+    """
+    密钥标签：密钥哈希的前 8 位十六进制。
+    Gemini 密钥都以 AIzaSy 开头，直接截取前缀只剩两位可区分的字符，不同密钥会合并到同一条时间序列。
+    """
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:8]
+
+
+def upstream_error_status(error: Exception) -> str:
+    """上游请求未得到响应时的 status 标签"""
+    return "timeout" if isinstance(error, httpx.TimeoutException) else "error"
+
+
+def track_response(response, backend: str, mode: str, model: str, start: float):
+    """
+    记录客户端请求的次数和耗时。
+
+    StreamingResponse 包装其 body_iterator，在流结束（或客户端断开）时记录总耗时并维护进行中的流式响应数；
+    其他响应直接记录。返回原响应对象。
+    """
+    requests_total.labels(backend, mode, model, "ok").inc()
+    duration = request_duration.labels(backend, mode, model)
+    if not isinstance(response, StreamingResponse):
+        duration.observe(time.perf_counter() - start)
+        return response
+
+    body = response.body_iterator
+    inflight = inflight_streams.labels(backend)
+
+    async def tracked():
+        inflight.inc()
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            inflight.dec()
+            duration.observe(time.perf_counter() - start)
+
+    response.body_iterator = tracked()
+    return response
@@ -1,36 +1,155 @@
 import time
-import asyncio
+from array import array
+from typing import Dict, List
 from fastapi import HTTPException, Request
+from app.utils.logging import log
+import app.config.settings as settings
+
+# 每分钟限制：60 秒窗口划分为 60 个 1 秒的桶
+MINUTE_WINDOW = 60
+MINUTE_BUCKETS = 60
+# 每日限制：24 小时窗口划分为 24 个 1 小时的桶
+DAY_WINDOW = 86400
+DAY_BUCKETS = 24
+
+
+class RingCounter:
+    """
+    固定大小的环形计数器，实现近似滑动窗口计数。
+
+    窗口被划分为 buckets 个桶，slots 记录每个桶当前对应的时间片序号，
+    写入时若桶中是旧时间片的数据则先清零，统计时只累加仍在窗口内的桶。
+    """
+    __slots__ = ('counts', 'slots', 'last_seen')
+
+    def __init__(self, buckets: int):
+        self.counts = array('q', bytes(8 * buckets))
+        self.slots = array('q', bytes(8 * buckets))
+        self.last_seen = 0.0
+
+    def hit(self, now: float, window: int) -> int:
+        """计入一次请求，返回包含本次在内窗口内的请求总数"""
+        buckets = len(self.counts)
+        slot = int(now * buckets // window)
+        index = slot % buckets
+        if self.slots[index] != slot:
+            self.slots[index] = slot
+            self.counts[index] = 0
+        self.counts[index] += 1
+        self.last_seen = now
+
+        oldest = slot - buckets
+        return sum(count for count, s in zip(self.counts, self.slots) if s > oldest)
+
+
+class LocalRateLimiter:
+    """
+    进程内的分片滑动窗口限流器。
+
+    计数器按限流键的哈希分布在多个分片字典中，hit 为纯同步操作，
+    在事件循环中天然互斥，无需全局锁；evict_idle 每次只清理一个分片，
+    由定时任务轮流调用，空闲超过窗口期的计数器会被移除，内存不会无限增长。
+    """
+
+    def __init__(self, shards: int = 16):
+        self.shards: List[Dict[str, RingCounter]] = [{} for _ in range(shards)]
+        self._next_shard = 0
+
+    def _shard(self, key: str) -> Dict[str, RingCounter]:
+        return self.shards[hash(key) % len(self.shards)]
+
+    async def hit(self, key: str, window: int, buckets: int) -> int:
+        """计入一次请求，返回窗口内的请求总数"""
+        shard = self._shard(key)
+        counter = shard.get(key)
+        if counter is None:
+            counter = shard[key] = RingCounter(buckets)
+        return counter.hit(time.time(), window)
+
+    async def evict_idle(self, max_idle: int = DAY_WINDOW):
+        """清理一个分片中空闲超过 max_idle 秒的计数器"""
+        shard = self.shards[self._next_shard]
+        self._next_shard = (self._next_shard + 1) % len(self.shards)
+        threshold = time.time() - max_idle
+        idle = [key for key, counter in shard.items() if counter.last_seen < threshold]
+        for key in idle:
+            del shard[key]
+        return len(idle)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+
+class RedisRateLimiter:
+    """
+    基于 Redis（或兼容存储）的滑动窗口限流器，多个 uvicorn 工作进程共享限额。
+
+    每个桶对应一个带过期时间的计数键，统计时一次 MGET 读取窗口内的全部桶，
+    过期的桶由 Redis 自动删除，无需本地清理。
+    Redis 连接出错时记录警告并改用进程内限流器计数，retry_interval 秒后再尝试 Redis，
+    Redis 故障不会让请求失败。
+    """
+
+    retry_interval = 30
+
+    def __init__(self, url: str, prefix: str = "hajimi:ratelimit", client=None):
+        if client is None:
+            import redis.asyncio as redis
+            client = redis.from_url(url)
+            self.errors = (redis.RedisError, OSError)
+        else:
+            self.errors = (ConnectionError, OSError)
+        self.redis = client
+        self.prefix = prefix
+        self.fallback = LocalRateLimiter()
+        self._retry_at = 0.0
+
+    async def hit(self, key: str, window: int, buckets: int) -> int:
+        if time.time() < self._retry_at:
+            return await self.fallback.hit(key, window, buckets)
+        width = window // buckets
+        slot = int(time.time()) // width
+        current = f"{self.prefix}:{key}:{slot}"
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.incr(current)
+                pipe.expire(current, window + width)
+                pipe.mget([f"{self.prefix}:{key}:{s}" for s in range(slot - buckets + 1, slot)])
+                count, _, previous = await pipe.execute()
+        except self.errors as e:
+            log('warning', f"访问限制无法连接 Redis，{self.retry_interval} 秒内改用进程内计数: {e}")
+            self._retry_at = time.time() + self.retry_interval
+            return await self.fallback.hit(key, window, buckets)
+        return count + sum(int(value) for value in previous if value is not None)
+
+    async def evict_idle(self, max_idle: int = DAY_WINDOW):
+        return await self.fallback.evict_idle(max_idle)
+
+    def __len__(self):
+        return len(self.fallback)
+
+
+def create_rate_limiter():
+    """按 RATE_LIMIT_BACKEND 创建限流器，Redis 不可用时回退到进程内限流"""
+    if settings.RATE_LIMIT_BACKEND == "redis":
+        try:
+            limiter = RedisRateLimiter(settings.REDIS_URL)
+            log('info', f"访问限制使用 Redis 存储: {settings.REDIS_URL}")
+            return limiter
+        except ImportError:
+            log('warning', "未安装 redis 库，访问限制回退到进程内存储")
+    return LocalRateLimiter()
+
+
+rate_limiter = create_rate_limiter()
 
-rate_limit_data = {}
-rate_limit_lock = asyncio.Lock() 
 
 async def protect_from_abuse(request: Request, max_requests_per_minute: int = 30, max_requests_per_day_per_ip: int = 600):
-    now = int(time.time())
-    minute = now // 60
-    day = now // (60 * 60 * 24)
-
-    minute_key = f"{request.url.path}:{minute}"
-    day_key = f"{request.client.host}:{day}"
-
-    async with rate_limit_lock:
-        minute_count, minute_timestamp = rate_limit_data.get(minute_key, (0, now))
-        
-        if now - minute_timestamp >= 60:
-            minute_count = 0
-            minute_timestamp = now
-        minute_count += 1
-        rate_limit_data[minute_key] = (minute_count, minute_timestamp)
-
-        day_count, day_timestamp = rate_limit_data.get(day_key, (0, now))
-        if now - day_timestamp >= 86400:
-            day_count = 0
-            day_timestamp = now
-        day_count += 1
-        rate_limit_data[day_key] = (day_count, day_timestamp)
+    minute_count = await rate_limiter.hit(f"path:{request.url.path}", MINUTE_WINDOW, MINUTE_BUCKETS)
+    day_count = await rate_limiter.hit(f"ip:{request.client.host}", DAY_WINDOW, DAY_BUCKETS)
 
     if minute_count > max_requests_per_minute:
         raise HTTPException(status_code=429, detail={
             "message": "Too many requests per minute", "limit": max_requests_per_minute})
     if day_count > max_requests_per_day_per_ip:
-        raise HTTPException(status_code=429, detail={"message": "Too many requests per day from this IP", "limit": max_requests_per_day_per_ip})
\ No newline at end of file
+        raise HTTPException(status_code=429, detail={"message": "Too many requests per day from this IP", "limit": max_requests_per_day_per_ip})
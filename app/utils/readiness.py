@@ -0,0 +1,49 @@
+import time
+from typing import Dict, Iterable, Optional
+
+
+class Readiness:
+    """
+    启动就绪状态。
+
+    启动时的各个后台步骤完成后调用 set() 记录状态（ok / failed / timeout 等），
+    required 中的组件全部为 ok 时服务就绪，/ready 返回 200，负载均衡据此开始转发流量。
+    """
+
+    def __init__(self, required: Iterable[str] = ('api_key', 'models')):
+        self.required = tuple(required)
+        self.components: Dict[str, str] = {}
+        self.started_at = time.time()
+        self.ready_at: Optional[float] = None
+
+    def require(self, *names: str):
+        """设置就绪所需的组件"""
+        self.required = names
+        self._check()
+
+    def set(self, name: str, status: str = "ok"):
+        self.components[name] = status
+        self._check()
+
+    def ok(self, name: str) -> bool:
+        return self.components.get(name) == "ok"
+
+    def _check(self):
+        if self.ready_at is None and all(self.ok(name) for name in self.required):
+            self.ready_at = time.time()
+
+    @property
+    def is_ready(self) -> bool:
+        return self.ready_at is not None
+
+    def status(self) -> dict:
+        return {
+            "ready": self.is_ready,
+            "required": list(self.required),
+            "components": dict(self.components),
+            "startup_seconds": round(self.ready_at - self.started_at, 3) if self.ready_at else None,
+        }
+
+
+# 全局就绪状态
+readiness = Readiness()
@@ -1,52 +1,167 @@
 import asyncio
 import time
-from typing import Dict, Any
+from typing import Any, Awaitable, Callable, Dict, Optional
+from fastapi.responses import StreamingResponse
 from app.utils.logging import log
+from app.utils.stream_hub import Broadcast, StreamCancelledError
+import app.config.settings as settings
 
-class ActiveRequestsManager:
-    """管理活跃API请求的类"""
-    
-    def __init__(self, requests_pool: Dict[str, asyncio.Task] = None):
-        self.active_requests = requests_pool if requests_pool is not None else {}  # 存储活跃请求
-    
-    def add(self, key: str, task: asyncio.Task):
-        """添加新的活跃请求任务"""
-        task.creation_time = time.time()  # 添加创建时间属性
-        self.active_requests[key] = task
-    
-    def get(self, key: str):
-        """获取活跃请求任务"""
-        return self.active_requests.get(key)
-    
-    def remove(self, key: str):
-        """移除活跃请求任务"""
-        if key in self.active_requests:
-            del self.active_requests[key]
-            return True
-        return False
-    
-    def clean_completed(self):
-        """清理所有已完成或已取消的任务"""
-        
-        for key, task in self.active_requests.items():
-            if task.done() or task.cancelled():
-                del self.active_requests[key]        
-        
-        # if keys_to_remove:
-        #    log('info', f"清理已完成请求任务: {len(keys_to_remove)}个", cleanup='active_requests')
-    
-    def clean_long_running(self, max_age_seconds: int = 300):
-        """清理长时间运行的任务"""
+# 合并的流式响应在结束前被取消时订阅者收到的异常
+FlightCancelledError = StreamCancelledError
+
+# 领头请求被取消时，跟随者重新参与合并
+_RETRY = object()
+# 等待领头请求超时，或流式响应的开头已不在缓冲区中，跟随者自行发起请求
+_TIMEOUT = object()
+
+
+class Flight:
+    """一次进行中的上游请求，及其流式结果的广播"""
+    __slots__ = ('key', 'created_at', 'settled', 'result', 'error', 'is_stream',
+                 'media_type', 'status_code', 'broadcast', 'waiters')
+
+    def __init__(self, key: str):
+        self.key = key
+        self.created_at = time.time()
+        self.settled = asyncio.Event()      # 领头请求返回（或失败）后置位
+        self.result: Any = None             # 非流式结果
+        self.error: Optional[BaseException] = None
+        self.is_stream = False
+        self.media_type: Optional[str] = None
+        self.status_code = 200
+        self.broadcast: Optional[Broadcast] = None  # 领头请求流式响应的广播
+        self.waiters = 0                    # 正在等待领头请求返回的跟随者数
+
+    @property
+    def subscribers(self) -> int:
+        return self.broadcast.subscribers if self.broadcast is not None else 0
+
+
+class RequestCoalescer:
+    """
+    单飞（single-flight）请求合并器。
+
+    相同键的并发请求中，第一个成为领头请求并真正调用上游，其余请求等待领头请求的结果：
+    - 非流式结果（dict 等）直接共享给所有跟随者；
+    - StreamingResponse 交给 Broadcast 统一消费，产生的块写入有界重放缓冲区（STREAM_REPLAY_MAX_CHUNKS），
+      每个客户端（包括领头请求自身）都从头重放缓冲区并继续接收后续块；
+      缓冲区已丢弃开头的块时，新的跟随者改为自行发起请求。
+    因此 N 个相同请求只产生一次上游调用。
+    """
+
+    def __init__(self):
+        self.flights: Dict[str, Flight] = {}
+        self.leaders_total = 0      # 累计发起的上游请求数
+        self.coalesced_total = 0    # 累计被合并（未发起上游请求）的请求数
+
+    async def run(self, key: str, factory: Callable[[], Awaitable[Any]], timeout: float = 240):
+        """
+        执行或加入键为 key 的请求。
+
+        Args:
+            key: 合并键，相同键的请求共享同一次上游调用
+            factory: 无参协程函数，领头请求通过它发起真正的请求
+            timeout: 跟随者等待领头请求返回的最长时间，超时后自行发起请求
+        """
+        flight = self.flights.get(key)
+        if flight is None:
+            return await self._lead(key, factory)
+
+        log('info', f"发现相同请求的进行中任务，等待其结果",
+            extra={'request_type': 'coalesce'})
+        result = await self._follow(flight, timeout)
+        if result is _RETRY:
+            return await self.run(key, factory, timeout)
+        if result is _TIMEOUT:
+            return await factory()
+        return result
+
+    async def _lead(self, key: str, factory):
+        flight = Flight(key)
+        self.flights[key] = flight
+        self.leaders_total += 1
+        try:
+            result = await factory()
+        except BaseException as e:
+            flight.error = e
+            flight.settled.set()
+            self._finish(flight)
+            raise
+
+        if isinstance(result, StreamingResponse):
+            flight.is_stream = True
+            flight.media_type = result.media_type
+            flight.status_code = result.status_code
+            flight.broadcast = Broadcast(result.body_iterator, settings.STREAM_REPLAY_MAX_CHUNKS,
+                                         on_finish=lambda: self._finish(flight))
+            flight.settled.set()
+            return self._subscribe(flight)
+
+        flight.result = result
+        flight.settled.set()
+        self._finish(flight)
+        return result
+
+    async def _follow(self, flight: Flight, timeout: float):
+        flight.waiters += 1
+        try:
+            await asyncio.wait_for(flight.settled.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            log('warning', f"等待已有任务超时: {flight.key[:8]}...",
+                extra={'request_type': 'coalesce'})
+            return _TIMEOUT
+        finally:
+            flight.waiters -= 1
+
+        if isinstance(flight.error, asyncio.CancelledError):
+            return _RETRY
+        if flight.error is not None:
+            raise flight.error
+
+        if flight.is_stream:
+            if not flight.broadcast.joinable:
+                log('info', f"进行中的流式响应开头已不在缓冲区中，自行发起请求: {flight.key[:8]}...",
+                    extra={'request_type': 'coalesce'})
+                return _TIMEOUT
+            self.coalesced_total += 1
+            return self._subscribe(flight)
+        self.coalesced_total += 1
+        return flight.result
+
+    def _subscribe(self, flight: Flight) -> StreamingResponse:
+        return StreamingResponse(flight.broadcast.subscribe(), status_code=flight.status_code,
+                                 media_type=flight.media_type)
+
+    def _finish(self, flight: Flight):
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+
+    async def clean_long_running(self, max_age_seconds: int = 300):
+        """
+        移除长时间未完成的请求，之后的相同请求不再等待它。
+
+        没有客户端在读取的流式响应同时停止消费上游（尚未开始消费的直接关闭上游迭代器）；
+        仍有客户端在读取的长回复保持不变。
+        """
         now = time.time()
-        long_running_keys = []
-        
-        for key, task in list(self.active_requests.items()):
-            if (hasattr(task, 'creation_time') and
-                task.creation_time < now - max_age_seconds and
-                not task.done() and not task.cancelled()):
-                
-                long_running_keys.append(key)
-                task.cancel()  # 取消长时间运行的任务
-        
-        if long_running_keys:
-            log('warning', f"取消长时间运行的任务: {len(long_running_keys)}个", cleanup='long_running_tasks')
+        stale = [flight for flight in self.flights.values()
+                 if flight.created_at < now - max_age_seconds]
+        for flight in stale:
+            self._finish(flight)
+            if flight.is_stream and not flight.subscribers:
+                await flight.broadcast.close()
+
+        if stale:
+            log('warning', f"移除长时间运行的合并请求: {len(stale)}个", cleanup='long_running_tasks')
+
+    def get_stats(self) -> dict:
+        """获取合并器状态，用于仪表盘展示"""
+        flights = list(self.flights.values())
+        return {
+            "flights": len(flights),
+            "streaming": sum(1 for flight in flights if flight.is_stream),
+            "waiters": sum(flight.waiters for flight in flights),
+            "subscribers": sum(flight.subscribers for flight in flights),
+            "leaders_total": self.leaders_total,
+            "coalesced_total": self.coalesced_total,
+        }
@@ -1,17 +1,91 @@
-import asyncio 
+import asyncio
 from datetime import datetime, timedelta
 from app.utils.logging import log
 import app.config.settings as settings
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, deque
+from array import array
 import time
-import threading
-import queue
-import functools
+
+# 时间序列保留的分钟数（24小时）
+SERIES_MINUTES = 1440
+
+
+class MinuteSeries:
+    """
+    按分钟统计调用次数和token数的定长环形缓冲区。
+
+    calls/tokens 为 array('q')，第 m 分钟的数据位于下标 m % size。
+    head 为已写入的最新分钟，时间前进时先清零被跳过的槽位，
+    因此环中始终只保存最近 size 分钟的数据，内存恒定，窗口查询只需对连续切片求和。
+    """
+    __slots__ = ('size', 'calls', 'tokens', 'head')
+
+    def __init__(self, size: int = SERIES_MINUTES):
+        self.size = size
+        self.calls = array('q', bytes(8 * size))
+        self.tokens = array('q', bytes(8 * size))
+        self.head = 0
+
+    def advance(self, minute: int):
+        """将最新分钟推进到 minute，清零其间被跳过的槽位"""
+        if minute <= self.head:
+            return
+        start = max(self.head + 1, minute - self.size + 1)
+        for m in range(start, minute + 1):
+            index = m % self.size
+            self.calls[index] = 0
+            self.tokens[index] = 0
+        self.head = minute
+
+    def add(self, minute: int, calls: int, tokens: int):
+        self.advance(minute)
+        if minute <= self.head - self.size:
+            # 已滑出保留范围的迟到记录
+            return
+        index = minute % self.size
+        self.calls[index] += calls
+        self.tokens[index] += tokens
+
+    def _window_sum(self, series: array, minutes: int, end: int) -> int:
+        """对 (end-minutes, end] 范围内的槽位求和，环绕时拆成两段切片"""
+        self.advance(end)
+        minutes = min(minutes, self.size, end - (self.head - self.size))
+        if minutes <= 0:
+            return 0
+        stop = end % self.size + 1
+        start = stop - minutes
+        if start >= 0:
+            return sum(series[start:stop])
+        return sum(series[start:]) + sum(series[:stop])
+
+    def sum_calls(self, minutes: int, end: int) -> int:
+        return self._window_sum(self.calls, minutes, end)
+
+    def sum_tokens(self, minutes: int, end: int) -> int:
+        return self._window_sum(self.tokens, minutes, end)
+
+    def get(self, minute: int):
+        """返回某一分钟的 (calls, tokens)，超出保留范围时为 0"""
+        if minute > self.head or minute <= self.head - self.size:
+            return 0, 0
+        index = minute % self.size
+        return self.calls[index], self.tokens[index]
+
+    def clear(self):
+        for index in range(self.size):
+            self.calls[index] = 0
+            self.tokens[index] = 0
 
 class ApiStatsManager:
-    """API调用统计管理器，优化性能的新实现"""
+    """
+    API调用统计管理器，优化性能的新实现
+
+    请求路径上的 update_stats 只把调用记录写入预分配的环形缓冲区（O(1)），
+    由事件循环中的单个消费者任务批量应用到计数器并输出日志；消费者空闲时阻塞在事件上，不轮询。
+    所有统计数据只在事件循环中读写，因此不需要线程锁；读取前会先合并缓冲区中尚未处理的记录。
+    """
     
-    def __init__(self, enable_background=True, batch_interval=1.0):
+    def __init__(self, enable_background=True, batch_interval=1.0, buffer_size=4096):
         # 使用Counter记录API密钥和模型的调用次数
         self.api_key_counts = Counter()  # 记录每个API密钥的调用次数
         self.model_counts = Counter()    # 记录每个模型的调用次数
@@ -23,137 +97,118 @@ class ApiStatsManager:
         self.api_model_tokens = defaultdict(Counter)  # 记录每个API密钥对每个模型的token使用量
         
         # 用于时间序列分析的数据结构（最近24小时，按分钟分组）
-        self.time_buckets = {}  # 格式: {timestamp_minute: {"calls": count, "tokens": count}}
+        self.minute_series = MinuteSeries()
+        
+        # 并发尝试统计：requests(成功的请求数)、attempts(发出的上游请求数)、wasted(被取消的上游请求数)
+        self.attempt_counts = Counter()
         
         # 保存与兼容格式相关的调用日志（最小化存储）
-        self.recent_calls = []  # 仅保存最近的少量调用，用于前端展示
         self.max_recent_calls = 100  # 最大保存的最近调用记录数
-        
-        # 当前时间分钟桶的时间戳（分钟级别）
-        self.current_minute = self._get_minute_timestamp(datetime.now())
+        self.recent_calls = deque(maxlen=self.max_recent_calls)  # 仅保存最近的少量调用，用于前端展示
         
         # 清理间隔（小时）
         self.cleanup_interval = 1
         self.last_cleanup = time.time()
         
-        # 使用线程锁而不是asyncio锁
-        self._counters_lock = threading.Lock()
-        self._time_series_lock = threading.Lock()
-        self._recent_calls_lock = threading.Lock()
-        
-        # 后台处理相关
+        # 后台处理相关：预分配的环形缓冲区，_write/_read 为累计写入/读取序号
         self.enable_background = enable_background
         self.batch_interval = batch_interval
-        self._update_queue = queue.Queue()
-        self._worker_thread = None
-        self._stop_event = threading.Event()
+        self._buffer = [None] * buffer_size
+        self._write = 0
+        self._read = 0
+        self._wakeup = None
+        self._consumer = None
+        self._consumer_loop = None
         
-        if enable_background:
-            self._start_worker()
+        # 持久化日志（UsageJournal），启用后每次调用都会写入增量日志
+        self.journal = None
     
-    def _start_worker(self):
-        """启动后台工作线程"""
-        if self._worker_thread is None or not self._worker_thread.is_alive():
-            self._stop_event.clear()
-            self._worker_thread = threading.Thread(
-                target=self._worker_loop,
-                daemon=True
-            )
-            self._worker_thread.start()
+    def _ensure_consumer(self):
+        """在当前事件循环中启动消费者任务（事件循环变化时重新创建）"""
+        loop = asyncio.get_running_loop()
+        if self._consumer_loop is loop and not self._consumer.done():
+            return
+        self._consumer_loop = loop
+        self._wakeup = asyncio.Event()
+        self._consumer = loop.create_task(self._consume())
     
-    def _worker_loop(self):
-        """后台工作线程的主循环"""
-        batch = []
-        last_process = time.time()
-        
-        while not self._stop_event.is_set():
+    async def _consume(self):
+        """消费者主循环：等待新记录，攒够一个批处理间隔后统一应用"""
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.batch_interval)
+            self._wakeup.clear()
             try:
-                # 非阻塞获取更新
-                try:
-                    update = self._update_queue.get_nowait()
-                    batch.append(update)
-                except queue.Empty:
-                    pass
-                
-                # 处理批次或超时
-                current_time = time.time()
-                if batch and (current_time - last_process >= self.batch_interval):
-                    self._process_batch(batch)
-                    batch = []
-                    last_process = current_time
-                
-                # 短暂休眠以避免CPU占用过高
-                time.sleep(0.01)
-                
+                self._drain()
             except Exception as e:
-                log('error', f"后台处理线程错误: {str(e)}")
-                time.sleep(1)  # 发生错误时短暂休眠
+                log('error', f"统计批处理错误: {str(e)}")
     
-    def _process_batch(self, batch):
-        """处理一批更新"""
-        with self._counters_lock:
-            for api_key, model, tokens in batch:
-                self.api_key_counts[api_key] += 1
-                self.model_counts[model] += 1
-                self.api_model_counts[api_key][model] += 1
-                self.api_key_tokens[api_key] += tokens
-                self.model_tokens[model] += tokens
-                self.api_model_tokens[api_key][model] += tokens
+    def _drain(self):
+        """应用缓冲区中全部尚未处理的记录"""
+        size = len(self._buffer)
+        while self._read < self._write:
+            index = self._read % size
+            record = self._buffer[index]
+            self._buffer[index] = None
+            self._read += 1
+            self._apply(*record)
     
-    async def update_stats(self, api_key, model, tokens=0):
-        """更新API调用统计"""
-        if self.enable_background:
-            # 将更新放入队列
-            self._update_queue.put((api_key, model, tokens))
-        else:
-            # 同步更新
-            with self._counters_lock:
-                self.api_key_counts[api_key] += 1
-                self.model_counts[model] += 1
-                self.api_model_counts[api_key][model] += 1
-                self.api_key_tokens[api_key] += tokens
-                self.model_tokens[model] += tokens
-                self.api_model_tokens[api_key][model] += tokens
+    def _apply(self, api_key, model, tokens, timestamp):
+        """将一次调用应用到各项统计"""
+        self.api_key_counts[api_key] += 1
+        self.model_counts[model] += 1
+        self.api_model_counts[api_key][model] += 1
+        self.api_key_tokens[api_key] += tokens
+        self.model_tokens[model] += tokens
+        self.api_model_tokens[api_key][model] += tokens
+        if self.journal is not None:
+            self.journal.append(api_key, model, tokens, timestamp)
         
         # 更新时间序列数据
-        now = datetime.now()
-        minute_ts = self._get_minute_timestamp(now)
-        
-        with self._time_series_lock:
-            if minute_ts not in self.time_buckets:
-                self.time_buckets[minute_ts] = {"calls": 0, "tokens": 0}
-            
-            self.time_buckets[minute_ts]["calls"] += 1
-            self.time_buckets[minute_ts]["tokens"] += tokens
-            self.current_minute = minute_ts
+        self.minute_series.add(int(timestamp // 60), 1, tokens)
         
         # 更新最近调用记录
-        with self._recent_calls_lock:
-            compact_call = {
-                'api_key': api_key,
-                'model': model,
-                'timestamp': now,
-                'tokens': tokens
-            }
-            
-            self.recent_calls.append(compact_call)
-            if len(self.recent_calls) > self.max_recent_calls:
-                self.recent_calls.pop(0)
+        self.recent_calls.append({
+            'api_key': api_key,
+            'model': model,
+            'timestamp': datetime.fromtimestamp(timestamp),
+            'tokens': tokens
+        })
         
         # 记录日志
-        log_message = f"API调用已记录: 秘钥 '{api_key[:8]}', 模型 '{model}', 令牌: {tokens if tokens is not None else 0}"
-        log('info', log_message)
+        log('info', f"API调用已记录: 秘钥 '{api_key[:8]}', 模型 '{model}', 令牌: {tokens}", category='stats')
     
-    async def cleanup(self):
-        """清理超过24小时的时间桶数据"""
-        now = datetime.now()
-        day_ago_ts = self._get_minute_timestamp(now - timedelta(days=1))
+    async def update_stats(self, api_key, model, tokens=0):
+        """更新API调用统计"""
+        record = (api_key, model, tokens or 0, time.time())
+        if not self.enable_background:
+            self._apply(*record)
+            return
         
-        with self._time_series_lock:
-            # 直接删除旧的时间桶
-            for ts in list(self.time_buckets.keys()):
-                if ts < day_ago_ts:
-                    del self.time_buckets[ts]
+        if self._write - self._read >= len(self._buffer):
+            # 缓冲区已满，先在请求路径上同步处理积压的记录
+            self._drain()
+        self._buffer[self._write % len(self._buffer)] = record
+        self._write += 1
+        
+        self._ensure_consumer()
+        self._wakeup.set()
+    
+    async def close(self):
+        """停止消费者任务并处理剩余记录"""
+        if self._consumer is not None and not self._consumer.done():
+            self._consumer.cancel()
+            try:
+                await self._consumer
+            except asyncio.CancelledError:
+                pass
+        self._consumer = None
+        self._drain()
+    
+    async def cleanup(self):
+        """清理超过24小时的时间序列数据（环形缓冲区推进到当前分钟即可）"""
+        self._drain()
+        self.minute_series.advance(self._get_minute(datetime.now()))
         
         self.last_cleanup = time.time()
     
@@ -166,38 +221,48 @@ class ApiStatsManager:
     
     async def get_api_key_usage(self, api_key, model=None):
         """获取API密钥的使用统计"""
-        with self._counters_lock:
-            if model:
-                return self.api_model_counts[api_key][model]
-            else:
-                return self.api_key_counts[api_key]
+        self._drain()
+        if model:
+            return self.api_model_counts[api_key][model]
+        else:
+            return self.api_key_counts[api_key]
+    
+    def record_attempts(self, launched, wasted):
+        """记录一次成功请求发出的上游尝试数，以及其中被取消而浪费的次数"""
+        self.attempt_counts['requests'] += 1
+        self.attempt_counts['attempts'] += launched
+        self.attempt_counts['wasted'] += wasted
+    
+    def get_attempt_stats(self):
+        """获取并发尝试统计"""
+        return {
+            'requests': self.attempt_counts['requests'],
+            'attempts': self.attempt_counts['attempts'],
+            'wasted': self.attempt_counts['wasted'],
+        }
     
     def get_calls_last_24h(self):
         """获取过去24小时的总调用次数"""
-        with self._counters_lock:
-            return sum(self.api_key_counts.values())
+        self._drain()
+        return sum(self.api_key_counts.values())
     
     def get_calls_last_hour(self, now=None):
         """获取过去一小时的总调用次数"""
         if now is None:
             now = datetime.now()
         
-        hour_ago_ts = self._get_minute_timestamp(now - timedelta(hours=1))
-        
-        with self._time_series_lock:
-            return sum(data["calls"] for ts, data in self.time_buckets.items() 
-                      if ts >= hour_ago_ts)
+        self._drain()
+        # 包含当前分钟在内的 61 个分钟槽位
+        return self.minute_series.sum_calls(61, self._get_minute(now))
     
     def get_calls_last_minute(self, now=None):
         """获取过去一分钟的总调用次数"""
         if now is None:
             now = datetime.now()
         
-        minute_ago_ts = self._get_minute_timestamp(now - timedelta(minutes=1))
-        
-        with self._time_series_lock:
-            return sum(data["calls"] for ts, data in self.time_buckets.items() 
-                      if ts >= minute_ago_ts)
+        self._drain()
+        # 当前分钟和上一分钟
+        return self.minute_series.sum_calls(2, self._get_minute(now))
     
     def get_time_series_data(self, minutes=30, now=None):
         """获取过去N分钟的时间序列数据"""
@@ -207,79 +272,100 @@ class ApiStatsManager:
         calls_series = []
         tokens_series = []
         
-        with self._time_series_lock:
-            for i in range(minutes, -1, -1):
-                minute_dt = now - timedelta(minutes=i)
-                minute_ts = self._get_minute_timestamp(minute_dt)
-                
-                bucket = self.time_buckets.get(minute_ts, {"calls": 0, "tokens": 0})
-                
-                calls_series.append({
-                    'time': minute_dt.strftime('%H:%M'),
-                    'value': bucket["calls"]
-                })
-                
-                tokens_series.append({
-                    'time': minute_dt.strftime('%H:%M'),
-                    'value': bucket["tokens"]
-                })
+        self._drain()
+        self.minute_series.advance(self._get_minute(now))
+        for i in range(minutes, -1, -1):
+            minute_dt = now - timedelta(minutes=i)
+            calls, tokens = self.minute_series.get(self._get_minute(minute_dt))
+            
+            calls_series.append({
+                'time': minute_dt.strftime('%H:%M'),
+                'value': calls
+            })
+            
+            tokens_series.append({
+                'time': minute_dt.strftime('%H:%M'),
+                'value': tokens
+            })
         
         return calls_series, tokens_series
     
-    def get_api_key_stats(self, api_keys):
-        """获取API密钥的详细统计信息"""
+    def get_api_key_stats(self, api_keys, usage=None):
+        """
+        获取API密钥的详细统计信息
+
+        Args:
+            api_keys: 密钥列表
+            usage: 可选，返回密钥最近 24 小时调用次数的函数；未提供时使用自上次重置以来的累计次数
+        """
         stats = []
         
-        with self._counters_lock:
-            for api_key in api_keys:
-                api_key_id = api_key[:8]
-                calls_24h = self.api_key_counts[api_key]
-                total_tokens = self.api_key_tokens[api_key]
-                
-                model_stats = {}
-                for model, count in self.api_model_counts[api_key].items():
-                    tokens = self.api_model_tokens[api_key][model]
-                    model_stats[model] = {
-                        'calls': count,
-                        'tokens': tokens
-                    }
-                
-                usage_percent = (calls_24h / settings.API_KEY_DAILY_LIMIT) * 100 if settings.API_KEY_DAILY_LIMIT > 0 else 0
-                
-                stats.append({
-                    'api_key': api_key_id,
-                    'calls_24h': calls_24h,
-                    'total_tokens': total_tokens,
-                    'limit': settings.API_KEY_DAILY_LIMIT,
-                    'usage_percent': round(usage_percent, 2),
-                    'model_stats': model_stats
-                })
+        self._drain()
+        for api_key in api_keys:
+            api_key_id = api_key[:8]
+            calls_24h = usage(api_key) if usage else self.api_key_counts[api_key]
+            total_tokens = self.api_key_tokens[api_key]
+            
+            model_stats = {}
+            for model, count in self.api_model_counts[api_key].items():
+                tokens = self.api_model_tokens[api_key][model]
+                model_stats[model] = {
+                    'calls': count,
+                    'tokens': tokens
+                }
+            
+            usage_percent = (calls_24h / settings.API_KEY_DAILY_LIMIT) * 100 if settings.API_KEY_DAILY_LIMIT > 0 else 0
+            
+            stats.append({
+                'api_key': api_key_id,
+                'calls_24h': calls_24h,
+                'total_tokens': total_tokens,
+                'limit': settings.API_KEY_DAILY_LIMIT,
+                'usage_percent': round(usage_percent, 2),
+                'model_stats': model_stats
+            })
         
         stats.sort(key=lambda x: x['usage_percent'], reverse=True)
         return stats
     
     async def reset(self):
         """重置所有统计数据"""
-        with self._counters_lock:
-            self.api_key_counts.clear()
-            self.model_counts.clear()
-            self.api_model_counts.clear()
-            self.api_key_tokens.clear()
-            self.model_tokens.clear()
-            self.api_model_tokens.clear()
-        
-        with self._time_series_lock:
-            self.time_buckets.clear()
-        
-        with self._recent_calls_lock:
-            self.recent_calls.clear()
+        # 先处理缓冲区中的记录，避免其在重置后才被计入
+        self._drain()
+        self.api_key_counts.clear()
+        self.model_counts.clear()
+        self.api_model_counts.clear()
+        self.api_key_tokens.clear()
+        self.model_tokens.clear()
+        self.api_model_tokens.clear()
+        self.attempt_counts.clear()
+        self.minute_series.clear()
+        self.recent_calls.clear()
+        if self.journal is not None:
+            self.journal.mark_reset()
         
-        self.current_minute = self._get_minute_timestamp(datetime.now())
         self.last_cleanup = time.time()
 
-    def _get_minute_timestamp(self, dt):
-        """将时间戳转换为分钟级别的时间戳（按分钟取整）"""
-        return int(dt.timestamp() // 60 * 60)
+    def export_counters(self):
+        """导出按 (密钥, 模型) 统计的调用次数和token数，用于持久化快照"""
+        self._drain()
+        return [(api_key, model, count, self.api_model_tokens[api_key][model])
+                for api_key, models in self.api_model_counts.items()
+                for model, count in models.items()]
+
+    def restore_counters(self, counters):
+        """从快照或增量日志恢复调用次数和token数（累加到当前计数上）"""
+        for api_key, model, count, tokens in counters:
+            self.api_key_counts[api_key] += count
+            self.model_counts[model] += count
+            self.api_model_counts[api_key][model] += count
+            self.api_key_tokens[api_key] += tokens
+            self.model_tokens[model] += tokens
+            self.api_model_tokens[api_key][model] += tokens
+
+    def _get_minute(self, dt):
+        """将时间转换为分钟序号（Unix 时间戳按分钟取整）"""
+        return int(dt.timestamp() // 60)
 
 # 创建全局单例实例
 api_stats_manager = ApiStatsManager()
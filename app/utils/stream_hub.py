@@ -0,0 +1,196 @@
+import asyncio
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+from app.utils.logging import log
+import app.config.settings as settings
+
+
+class StreamLaggedError(Exception):
+    """订阅者所需的块已被挤出重放缓冲区"""
+
+
+class ReplayBuffer:
+    """
+    有界重放缓冲区。
+
+    只保留最近 max_chunks 个块，base 为缓冲区中第一个块的全局序号，
+    订阅者按全局序号读取，序号小于 base 的块已被丢弃。
+    """
+    __slots__ = ('chunks', 'base')
+
+    def __init__(self, max_chunks: int):
+        self.chunks = deque(maxlen=max_chunks)
+        self.base = 0
+
+    @property
+    def full(self) -> bool:
+        return len(self.chunks) == self.chunks.maxlen
+
+    def append(self, chunk):
+        if self.full:
+            self.base += 1
+        self.chunks.append(chunk)
+
+    @property
+    def end(self) -> int:
+        return self.base + len(self.chunks)
+
+    def get(self, index: int):
+        return self.chunks[index - self.base]
+
+
+class StreamCancelledError(Exception):
+    """上游流在结束前被取消，订阅者收到的内容不完整"""
+
+
+class Broadcast:
+    """
+    一路上游流的有界重放广播。
+
+    后台任务在第一个订阅者开始读取时启动，把上游的块写入有界重放缓冲区；
+    每个订阅者从头重放缓冲区并继续接收实时块。后台任务按最慢的订阅者读取上游：
+    缓冲区已满且最早的块仍有人未读时暂停，已订阅的请求不会因读得慢而丢块。
+    所有订阅者都断开后停止消费上游；上游被取消或出错时，正在读取的订阅者收到异常而不是截断的响应。
+    """
+    __slots__ = ('source', 'buffer', 'finished', 'error', 'changed', 'drained', 'pump',
+                 'cursors', 'next_id', 'on_finish')
+
+    def __init__(self, source: AsyncIterator[Any], max_chunks: int,
+                 on_finish: Optional[Callable[[], None]] = None):
+        self.source = source
+        self.buffer = ReplayBuffer(max_chunks)
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Event()      # 有新块或流结束时置位并替换
+        self.drained = asyncio.Event()      # 订阅者读取或断开时置位并替换
+        self.pump: Optional[asyncio.Task] = None
+        self.cursors: Dict[int, int] = {}   # 订阅者编号 -> 下一个要读取的块序号
+        self.next_id = 0
+        self.on_finish = on_finish          # 上游结束（完成、出错或被取消）时调用
+
+    @property
+    def subscribers(self) -> int:
+        return len(self.cursors)
+
+    @property
+    def joinable(self) -> bool:
+        # 只有缓冲区仍保留第一个块时，新订阅者才能得到完整的响应
+        return self.buffer.base == 0
+
+    def notify(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def notify_drained(self):
+        drained, self.drained = self.drained, asyncio.Event()
+        drained.set()
+
+    def blocked(self) -> bool:
+        """缓冲区已满且最早的块仍有订阅者未读，此时写入会挤掉未读的块"""
+        return (self.buffer.full and
+                min(self.cursors.values(), default=self.buffer.end) <= self.buffer.base)
+
+    async def _pump(self):
+        try:
+            async for chunk in self.source:
+                # 等待最慢的订阅者读走最早的块，再写入新块
+                while self.blocked():
+                    await self.drained.wait()
+                self.buffer.append(chunk)
+                self.notify()
+        except asyncio.CancelledError:
+            self.error = StreamCancelledError("上游流在结束前被取消")
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished = True
+            self.notify()
+            if self.on_finish is not None:
+                self.on_finish()
+
+    async def subscribe(self) -> AsyncIterator[Any]:
+        """从头重放缓冲区，再跟随接收后续块"""
+        # 开始读取时才计入订阅者：响应未被发送（客户端已断开）时不会占用计数
+        subscriber = self.next_id
+        self.next_id += 1
+        self.cursors[subscriber] = 0
+        if self.pump is None:
+            self.pump = asyncio.create_task(self._pump())
+        index = 0
+        try:
+            while True:
+                if index < self.buffer.end:
+                    if index < self.buffer.base:
+                        raise StreamLaggedError(f"订阅者落后 {self.buffer.base - index} 个块")
+                    chunk = self.buffer.get(index)
+                    index += 1
+                    self.cursors[subscriber] = index
+                    self.notify_drained()
+                    yield chunk
+                    continue
+                if self.finished:
+                    break
+                await self.changed.wait()
+            if self.error is not None:
+                raise self.error
+        finally:
+            del self.cursors[subscriber]
+            self.notify_drained()
+            # 所有订阅者都已断开，停止消费上游流
+            if not self.cursors and not self.finished and self.pump is not None:
+                self.pump.cancel()
+
+    async def close(self):
+        """停止消费上游：已开始时取消后台任务，尚未开始时直接关闭上游迭代器"""
+        if self.pump is not None:
+            self.pump.cancel()
+        elif hasattr(self.source, 'aclose'):
+            await self.source.aclose()
+
+
+class StreamHub:
+    """
+    按请求内容共享上游流式连接。
+
+    第一个请求打开上游流并创建 Broadcast，之后相同键的请求重放缓冲区后继续接收实时块，不再单独调用上游。
+    缓冲区已丢弃早期块时，新请求无法得到完整响应，会另开一路上游流。
+    """
+
+    def __init__(self):
+        self.channels: Dict[str, Broadcast] = {}
+        self.upstream_total = 0   # 累计打开的上游流数量
+        self.joined_total = 0     # 累计加入已有上游流的请求数
+
+    def subscribe(self, key: str, source_factory: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """
+        订阅键为 key 的上游流，不存在可加入的频道时调用 source_factory 打开新的上游流。
+
+        key 必须覆盖影响上游结果的全部请求内容；迭代器产出上游的原始块。
+        """
+        channel = self.channels.get(key)
+        if channel is not None and channel.joinable:
+            self.joined_total += 1
+            log('info', f"加入进行中的上游流: {key[:8]}...",
+                extra={'request_type': 'stream'})
+        else:
+            channel = Broadcast(source_factory(), settings.STREAM_REPLAY_MAX_CHUNKS)
+            channel.on_finish = lambda: self._finish(key, channel)
+            self.channels[key] = channel
+            self.upstream_total += 1
+        return channel.subscribe()
+
+    def _finish(self, key: str, channel: Broadcast):
+        if self.channels.get(key) is channel:
+            del self.channels[key]
+
+    def get_stats(self) -> dict:
+        return {
+            "channels": len(self.channels),
+            "subscribers": sum(channel.subscribers for channel in self.channels.values()),
+            "upstream_total": self.upstream_total,
+            "joined_total": self.joined_total,
+        }
+
+
+# 全局单例，真流式模式下共享上游连接
+stream_hub = StreamHub()
@@ -0,0 +1,255 @@
+import asyncio
+import struct
+import time
+import zlib
+from collections import defaultdict
+from typing import List, Optional, Tuple
+from app.utils.logging import log
+import app.config.settings as settings
+
+SNAPSHOT_MAGIC = b"HJUS"
+SNAPSHOT_VERSION = 1
+
+# 增量记录的类型：统计计数（每次 update_stats，含空响应和失败响应），
+# 以及密钥调度器计入24小时用量窗口的成功调用（report_success）
+DELTA_STATS = 0
+DELTA_KEY_USE = 1
+
+# 增量记录：长度(H) + CRC32(I) + 负载；负载为 序号(Q) + 时间戳(d) + 类型(B) + 密钥 + 模型 + token数(q)
+_RECORD_HEADER = struct.Struct('<HI')
+_DELTA_HEAD = struct.Struct('<QdB')
+_STR_LEN = struct.Struct('<H')
+_TOKENS = struct.Struct('<q')
+
+
+def _pack_str(value: str) -> bytes:
+    data = value.encode('utf-8')
+    return _STR_LEN.pack(len(data)) + data
+
+
+def _unpack_str(buf: bytes, offset: int) -> Tuple[str, int]:
+    (length,) = _STR_LEN.unpack_from(buf, offset)
+    offset += _STR_LEN.size
+    return buf[offset:offset + length].decode('utf-8'), offset + length
+
+
+def encode_delta(seq: int, timestamp: float, kind: int, api_key: str, model: str, tokens: int) -> bytes:
+    payload = _DELTA_HEAD.pack(seq, timestamp, kind) + _pack_str(api_key) + _pack_str(model) + _TOKENS.pack(tokens)
+    return _RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_deltas(data: bytes) -> List[tuple]:
+    """
+    解析增量日志，返回 [(seq, timestamp, kind, api_key, model, tokens)]。
+
+    遇到被截断或校验失败的记录（写入过程中崩溃）即停止，之前的记录照常返回。
+    """
+    records = []
+    offset = 0
+    while offset + _RECORD_HEADER.size <= len(data):
+        length, crc = _RECORD_HEADER.unpack_from(data, offset)
+        payload = data[offset + _RECORD_HEADER.size:offset + _RECORD_HEADER.size + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break
+        seq, timestamp, kind = _DELTA_HEAD.unpack_from(payload, 0)
+        api_key, pos = _unpack_str(payload, _DELTA_HEAD.size)
+        model, pos = _unpack_str(payload, pos)
+        (tokens,) = _TOKENS.unpack_from(payload, pos)
+        records.append((seq, timestamp, kind, api_key, model, tokens))
+        offset += _RECORD_HEADER.size + length
+    return records
+
+
+def encode_snapshot(seq: int, counters: List[tuple], key_usage: dict) -> bytes:
+    """
+    编码快照：魔数 + CRC32 + zlib 压缩的正文。
+
+    正文依次为 版本、最后包含的增量序号、创建时间，
+    (密钥, 模型, 调用次数, token数) 列表，以及每个密钥窗口内的 (分钟序号, 计数) 列表。
+    """
+    parts = [struct.pack('<BQdI', SNAPSHOT_VERSION, seq, time.time(), len(counters))]
+    for api_key, model, count, tokens in counters:
+        parts.append(_pack_str(api_key) + _pack_str(model) + struct.pack('<qq', count, tokens))
+    parts.append(struct.pack('<I', len(key_usage)))
+    for api_key, entries in key_usage.items():
+        parts.append(_pack_str(api_key) + struct.pack('<I', len(entries)))
+        parts.append(b"".join(struct.pack('<iI', minute, count) for minute, count in entries))
+    body = zlib.compress(b"".join(parts))
+    return SNAPSHOT_MAGIC + struct.pack('<I', zlib.crc32(body)) + body
+
+
+def decode_snapshot(data: bytes) -> Tuple[int, List[tuple], dict]:
+    """解析快照，返回 (最后包含的增量序号, 计数列表, 密钥用量)；格式或校验错误时抛出 ValueError"""
+    if data[:4] != SNAPSHOT_MAGIC:
+        raise ValueError("快照格式错误")
+    (crc,) = struct.unpack_from('<I', data, 4)
+    body = data[8:]
+    if zlib.crc32(body) != crc:
+        raise ValueError("快照校验失败")
+    buf = zlib.decompress(body)
+    version, seq, _, count = struct.unpack_from('<BQdI', buf, 0)
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f"不支持的快照版本: {version}")
+    offset = struct.calcsize('<BQdI')
+
+    counters = []
+    for _ in range(count):
+        api_key, offset = _unpack_str(buf, offset)
+        model, offset = _unpack_str(buf, offset)
+        calls, tokens = struct.unpack_from('<qq', buf, offset)
+        offset += 16
+        counters.append((api_key, model, calls, tokens))
+
+    key_usage = {}
+    (keys,) = struct.unpack_from('<I', buf, offset)
+    offset += 4
+    for _ in range(keys):
+        api_key, offset = _unpack_str(buf, offset)
+        (entries,) = struct.unpack_from('<I', buf, offset)
+        offset += 4
+        key_usage[api_key] = [struct.unpack_from('<iI', buf, offset + i * 8) for i in range(entries)]
+        offset += entries * 8
+    return seq, counters, key_usage
+
+
+class UsageJournal:
+    """
+    密钥/模型用量的持久化：定期写入紧凑的二进制快照，两次快照之间的调用追加到增量日志。
+
+    统计计数和密钥调度器的用量分别记录：前者来自 ApiStatsManager（包括空响应和失败响应），
+    后者来自 KeyScheduler.record_success，与调度器实际计入24小时窗口的调用一致。
+    每次调用在事件循环中只追加到内存列表；后台任务每 USAGE_FLUSH_INTERVAL 秒把新记录编码后
+    追加到增量日志，每 USAGE_SNAPSHOT_INTERVAL 秒写一次快照并清空增量日志。
+    快照的编码压缩和所有存储读写都通过 asyncio.to_thread 在线程中执行，不阻塞事件循环。
+    启动时加载快照并重放序号大于快照的增量记录，恢复统计计数和密钥的24小时用量窗口。
+    读取失败（如数据库暂时不可用）时不写入任何数据，由后台任务在每次写入前重试恢复，
+    期间的调用留在内存中，恢复成功后再按存储中的序号继续编号写入，不会覆盖已保存的快照。
+    """
+
+    def __init__(self, persistence, stats_manager, key_scheduler):
+        self.persistence = persistence
+        self.stats_manager = stats_manager
+        self.key_scheduler = key_scheduler
+        self.seq = 0
+        self.recovered = False
+        # 尚未写入的记录 (timestamp, kind, api_key, model, tokens)，写入时才分配序号
+        self.pending: List[tuple] = []
+        self.snapshot_due = False
+        self.last_snapshot = time.monotonic()
+        self._io_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def append(self, api_key: str, model: str, tokens: int, timestamp: float):
+        """记录一次调用的统计计数（由 ApiStatsManager 在应用统计时调用）"""
+        self.pending.append((timestamp, DELTA_STATS, api_key, model, tokens))
+
+    def append_key_use(self, api_key: str, timestamp: float):
+        """记录密钥的一次成功调用（由 KeyScheduler 计入用量窗口时调用）"""
+        self.pending.append((timestamp, DELTA_KEY_USE, api_key, "", 0))
+
+    def mark_reset(self):
+        """统计被重置：丢弃未写入的记录，并尽快写入新快照覆盖旧数据"""
+        self.pending.clear()
+        self.snapshot_due = True
+
+    async def recover(self) -> bool:
+        """加载快照并重放增量日志，读取失败时返回 False"""
+        try:
+            snapshot, deltas = await asyncio.to_thread(self.persistence.load_usage)
+        except Exception as e:
+            log('error', f"读取用量快照失败，将在下次写入前重试: {str(e)}")
+            return False
+
+        snapshot_seq = 0
+        if snapshot:
+            try:
+                snapshot_seq, counters, key_usage = decode_snapshot(snapshot)
+                self.stats_manager.restore_counters(counters)
+                self.key_scheduler.restore_usage(key_usage)
+            except Exception as e:
+                log('error', f"用量快照损坏，已忽略: {str(e)}")
+                snapshot_seq = 0
+
+        records = [record for record in decode_deltas(deltas) if record[0] > snapshot_seq]
+        counters = defaultdict(lambda: [0, 0])
+        key_usage = defaultdict(lambda: defaultdict(int))
+        for _, timestamp, kind, api_key, model, tokens in records:
+            if kind == DELTA_KEY_USE:
+                key_usage[api_key][int(timestamp // 60)] += 1
+            else:
+                counters[(api_key, model)][0] += 1
+                counters[(api_key, model)][1] += tokens
+        self.stats_manager.restore_counters(
+            [(api_key, model, calls, tokens) for (api_key, model), (calls, tokens) in counters.items()])
+        self.key_scheduler.restore_usage(
+            {api_key: list(minutes.items()) for api_key, minutes in key_usage.items()})
+
+        self.seq = max([snapshot_seq] + [record[0] for record in records])
+        self.recovered = True
+        if snapshot or records:
+            log('info', f"已恢复用量数据: 快照{'1' if snapshot else '0'}个，增量记录{len(records)}条")
+        return True
+
+    async def flush(self):
+        """把新记录追加到增量日志，到达快照间隔时改为写入快照"""
+        async with self._io_lock:
+            # 未恢复前写入会让序号从 0 重新开始并覆盖已保存的快照
+            if not self.recovered and not await self.recover():
+                return
+            now = time.monotonic()
+            if self.snapshot_due or now - self.last_snapshot >= settings.USAGE_SNAPSHOT_INTERVAL:
+                await self._snapshot()
+                return
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, []
+            data = b"".join(encode_delta(self.seq + i, *record) for i, record in enumerate(batch, 1))
+            try:
+                await asyncio.to_thread(self.persistence.append_usage_deltas, data)
+                self.seq += len(batch)
+            except Exception as e:
+                # 写入失败时放回，下次重试
+                self.pending = batch + self.pending
+                log('error', f"写入用量增量日志失败: {str(e)}")
+
+    async def _snapshot(self):
+        # 在事件循环中一次性取得一致的状态，快照已包含的增量记录不再写入日志。
+        # export_counters 会先应用统计缓冲区中的记录（可能追加新的增量），因此在读取序号之前调用
+        counters = self.stats_manager.export_counters()
+        pending, self.pending = self.pending, []
+        # 快照包含的调用同样占用序号，之后的增量记录序号都大于快照
+        seq = self.seq + len(pending)
+        key_usage = self.key_scheduler.export_usage()
+        try:
+            # 压缩编码在线程中执行，事件循环中只做上面的状态复制
+            data = await asyncio.to_thread(encode_snapshot, seq, counters, key_usage)
+            await asyncio.to_thread(self.persistence.save_usage_snapshot, data)
+            self.seq = seq
+            self.snapshot_due = False
+            self.last_snapshot = time.monotonic()
+        except Exception as e:
+            self.pending = pending + self.pending
+            log('error', f"写入用量快照失败: {str(e)}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(settings.USAGE_FLUSH_INTERVAL)
+            await self.flush()
+
+    def start(self):
+        self.stats_manager.journal = self
+        self.key_scheduler.journal = self
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """停止后台任务并写入最终快照"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.snapshot_due = True
+        await self.flush()
@@ -1,3 +1,4 @@
+import asyncio
 import requests
 import re
 from typing import List, Optional
@@ -115,6 +116,12 @@ async def check_version():
     """
     检查应用程序版本更新
     
+    版本检查使用同步的 requests 访问 GHCR/GitHub，在线程中执行，不阻塞事件循环
+    """
+    return await asyncio.to_thread(_check_version_sync)
+
+def _check_version_sync():
+    """
     从本地和Docker镜像仓库获取版本信息，并比较版本号以确定是否有更新
     """
     try:
@@ -147,6 +147,11 @@ async def get_models_config() -> Dict[str, List[str]]:
                 _model_cache = {"vertex_models": [], "vertex_express_models": []}
     return _model_cache
 
+def cached_model_ids() -> set:
+    """已加载的 Vertex 和 Express 模型名，不触发加载；尚未加载时为空集合"""
+    config = _model_cache or {}
+    return set(config.get("vertex_models", [])) | set(config.get("vertex_express_models", []))
+
 async def get_vertex_models() -> List[str]:
     config = await get_models_config()
     return config.get("vertex_models", [])
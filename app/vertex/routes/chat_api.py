@@ -8,6 +8,7 @@ from typing import List, Dict, Any
 
 from app.utils.logging import vertex_log
 from app.config import settings
+from app.config.snapshot import current_settings
 
 # Google and OpenAI specific imports
 from google.genai import types
@@ -45,6 +46,8 @@ async def chat_completions(fastapi_request: Request, request: OpenAIRequest, api
             # 如果app.state中没有credential_manager，则创建一个新的
             vertex_log('warning', "No credential_manager found in app.state, creating a new one")
             credential_manager_instance = CredentialManager()
+            # 保存到app.state，启动时未启用Vertex的情况下之后的请求可以复用
+            fastapi_request.app.state.credential_manager = credential_manager_instance
         
         OPENAI_DIRECT_SUFFIX = "-openai"
         EXPERIMENTAL_MARKER = "-exp-"
@@ -121,10 +124,9 @@ async def chat_completions(fastapi_request: Request, request: OpenAIRequest, api
 
         client_to_use = None
         
-        # 优先从settings获取配置，如果没有则使用app_config中的配置
-        express_api_keys_list = []
-        if hasattr(settings, 'VERTEX_EXPRESS_API_KEY') and settings.VERTEX_EXPRESS_API_KEY:
-            express_api_keys_list = [key.strip() for key in settings.VERTEX_EXPRESS_API_KEY.split(',') if key.strip()]
+        # 优先从配置快照获取已解析的密钥列表，如果没有则使用app_config中的配置
+        express_api_keys_list = list(current_settings().vertex_express_api_keys)
+        if express_api_keys_list:
             vertex_log('info', f"Using {len(express_api_keys_list)} Express API keys from settings")
         # 如果settings中没有配置，则使用app_config中的配置
         if not express_api_keys_list and app_config.VERTEX_EXPRESS_API_KEY_VAL:
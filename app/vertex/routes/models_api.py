@@ -147,6 +147,8 @@ async def list_models(fastapi_request: Request, api_key: str = Depends(get_api_k
         # 如果app.state中没有credential_manager，则创建一个新的
         vertex_log('warning', "No credential_manager found in app.state, creating a new one")
         credential_manager_instance = CredentialManager()
+        # 保存到app.state，启动时未启用Vertex的情况下之后的请求可以复用
+        fastapi_request.app.state.credential_manager = credential_manager_instance
 
     # 检查是否有SA凭证和Express Key
     has_sa_creds = credential_manager_instance.get_total_credentials() > 0
@@ -0,0 +1,82 @@
+"""
+应用冷启动导入开销基准。
+
+用法:
+    python benchmarks/bench_import_time.py [重复次数]
+
+对每种配置分别在新的子进程中导入 app.main，再导入该配置在启动事件中会用到的后端模块
+（启用 Vertex 时为 Vertex 初始化所需模块），测量:
+    导入耗时: 导入 app.main 的耗时，before 配置还包括旧实现在模块级导入的后端模块（取多次中的最小值）
+    后端加载: 启动事件中加载后端模块的耗时
+    RSS     : 完成以上导入后进程的最大常驻内存
+    重量级SDK: 已加载的 google.genai / google.auth / openai / mysql.connector
+
+配置:
+    before       : 默认配置，按旧实现在导入 app.main 时一并导入 Vertex 路由/凭证/初始化模块和 mysql.connector
+    gemini-file  : ENABLE_VERTEX=false, PERSISTENCE_MODE=file（默认配置）
+    vertex-file  : ENABLE_VERTEX=true,  PERSISTENCE_MODE=file
+"""
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ("google.genai", "google.auth", "openai", "mysql.connector")
+
+# 旧实现中 app.main 及其导入的路由、仪表盘和持久化模块在模块级导入的后端模块
+EAGER_MODULES = ("app.vertex.credentials_manager", "app.vertex.vertex_ai_init",
+                 "app.vertex.routes.chat_api", "app.vertex.routes.models_api", "mysql.connector")
+
+# 配置名 -> (环境变量, 与 app.main 一起导入的模块, 启动事件中加载的后端模块)
+CONFIGS = {
+    "before": ({"ENABLE_VERTEX": "false", "PERSISTENCE_MODE": "file"}, EAGER_MODULES, ()),
+    "gemini-file": ({"ENABLE_VERTEX": "false", "PERSISTENCE_MODE": "file"}, (), ()),
+    "vertex-file": ({"ENABLE_VERTEX": "true", "PERSISTENCE_MODE": "file"}, (),
+                    ("app.vertex.credentials_manager", "app.vertex.vertex_ai_init")),
+}
+
+PROBE = (
+    "import importlib, os, resource, sys, time\n"
+    "start = time.perf_counter()\n"
+    "import app.main\n"
+    "for name in filter(None, os.environ['BENCH_EAGER'].split(',')):\n"
+    "    importlib.import_module(name)\n"
+    "print('IMPORT_MS', (time.perf_counter() - start) * 1000)\n"
+    "start = time.perf_counter()\n"
+    "for name in sys.argv[1:]:\n"
+    "    importlib.import_module(name)\n"
+    "print('BACKEND_MS', (time.perf_counter() - start) * 1000)\n"
+    "print('RSS_KB', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)\n"
+    f"print('HEAVY', ','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n"
+)
+
+
+def run_once(env_overrides: dict, eager: tuple, backends: tuple, workdir: str):
+    env = dict(os.environ, PYTHONPATH=ROOT, ENABLE_STORAGE="false", BENCH_EAGER=",".join(eager), **env_overrides)
+    result = subprocess.run([sys.executable, "-c", PROBE, *backends],
+                            cwd=workdir, env=env, capture_output=True, text=True, check=True)
+    import_ms = float(re.search(r"IMPORT_MS ([\d.]+)", result.stdout).group(1))
+    backend_ms = float(re.search(r"BACKEND_MS ([\d.]+)", result.stdout).group(1))
+    rss_kb = int(re.search(r"RSS_KB (\d+)", result.stdout).group(1))
+    heavy = re.search(r"HEAVY (.*)", result.stdout).group(1).strip()
+    return import_ms, backend_ms, rss_kb, heavy
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    with tempfile.TemporaryDirectory() as workdir:
+        # app.main 在导入时挂载 templates/assets 静态目录
+        os.makedirs(os.path.join(workdir, "templates", "assets"))
+        for name, (overrides, eager, backends) in CONFIGS.items():
+            runs = [run_once(overrides, eager, backends, workdir) for _ in range(repeat)]
+            import_ms = min(run[0] for run in runs)
+            backend_ms = min(run[1] for run in runs)
+            rss_mb = min(run[2] for run in runs) / 1024
+            print(f"{name:12s} 导入耗时: {import_ms:8.1f} ms  后端加载: {backend_ms:7.1f} ms  "
+                  f"RSS: {rss_mb:6.1f} MB  已加载: {runs[-1][3] or '-'}")
+
+
+if __name__ == "__main__":
+    main()
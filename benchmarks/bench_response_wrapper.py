@@ -0,0 +1,81 @@
+"""
+GeminiResponseWrapper 单 chunk CPU 开销微基准。
+
+用法:
+    python benchmarks/bench_response_wrapper.py [录制的 SSE 文件]
+
+未提供文件时生成一段模拟的长 SSE 流（带思考、正文和结尾 usage 的 chunk）。
+对比两种方式:
+    eager: 构造后立即计算全部字段（含 json_dumps 格式化），即旧实现的行为
+    lazy : 只读取流式转换（openAI_from_Gemini）实际用到的字段
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.gemini import GeminiResponseWrapper  # noqa: E402
+
+
+def synthetic_stream(num_chunks: int = 2000) -> list:
+    lines = []
+    for i in range(num_chunks):
+        part = {"text": f"这是第 {i} 段模拟输出，" * 8}
+        if i < num_chunks // 10:
+            part["thought"] = True
+        chunk = {
+            "candidates": [{"content": {"parts": [part], "role": "model"}, "index": 0}],
+            "modelVersion": "gemini-2.5-pro",
+        }
+        if i == num_chunks - 1:
+            chunk["candidates"][0]["finishReason"] = "STOP"
+            chunk["usageMetadata"] = {"promptTokenCount": 1200, "candidatesTokenCount": 8000,
+                                      "totalTokenCount": 9200}
+        lines.append("data: " + json.dumps(chunk, ensure_ascii=False))
+    return lines
+
+
+def load_stream(path: str) -> list:
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.startswith("data: ")]
+
+
+def eager(data):
+    wrapper = GeminiResponseWrapper(data)
+    # 旧实现在 __init__ 中计算全部字段
+    (wrapper.text, wrapper.finish_reason, wrapper.prompt_token_count, wrapper.candidates_token_count,
+     wrapper.total_token_count, wrapper.thoughts, wrapper.function_call, wrapper.json_dumps)
+    return wrapper
+
+
+def lazy(data):
+    wrapper = GeminiResponseWrapper(data)
+    # 流式转换实际读取的字段
+    wrapper.model, wrapper.finish_reason, wrapper.function_call, wrapper.text
+    return wrapper
+
+
+def run(lines: list, build, rounds: int = 5) -> float:
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for line in lines:
+            build(json.loads(line[len("data: "):]))
+        best = min(best, time.perf_counter() - start)
+    return best / len(lines)
+
+
+def main():
+    lines = load_stream(sys.argv[1]) if len(sys.argv) > 1 else synthetic_stream()
+    eager_cost = run(lines, eager)
+    lazy_cost = run(lines, lazy)
+    print(f"chunks: {len(lines)}")
+    print(f"eager: {eager_cost * 1e6:.2f} us/chunk")
+    print(f"lazy : {lazy_cost * 1e6:.2f} us/chunk")
+    print(f"节省: {(1 - lazy_cost / eager_cost) * 100:.1f}%")
+
+
+if __name__ == "__main__":
+    main()
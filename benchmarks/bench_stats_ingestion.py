@@ -0,0 +1,132 @@
+"""
+ApiStatsManager 统计写入开销基准。
+
+用法:
+    python benchmarks/bench_stats_ingestion.py [调用次数]
+
+对比两种写入方式:
+    locked  : 旧实现，请求路径上加锁更新时间桶和最近调用、同步格式化日志，后台线程每 10 ms 轮询队列
+    buffered: 当前的 ApiStatsManager，请求路径只写入环形缓冲区，由事件循环上的任务批量处理
+
+每种方式测量两项指标:
+    请求路径开销: 在事件循环中 await update_stats() 的平均耗时（每 1000 次让出一次事件循环，不含后台批处理）
+    空闲 CPU   : 没有任何请求时，统计管理器在 3 秒内消耗的进程 CPU 时间占比
+"""
+import asyncio
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utils.logging import log, logger  # noqa: E402
+from app.utils.stats import ApiStatsManager  # noqa: E402
+
+
+class LockedStatsManager:
+    """旧实现的写入路径：线程锁 + 轮询队列的后台线程，只保留 update_stats 相关部分"""
+
+    def __init__(self, batch_interval=1.0):
+        self.api_key_counts = Counter()
+        self.model_counts = Counter()
+        self.api_model_counts = defaultdict(Counter)
+        self.api_key_tokens = Counter()
+        self.model_tokens = Counter()
+        self.api_model_tokens = defaultdict(Counter)
+        self.time_buckets = {}
+        self.recent_calls = []
+        self.max_recent_calls = 100
+        self._counters_lock = threading.Lock()
+        self._time_series_lock = threading.Lock()
+        self._recent_calls_lock = threading.Lock()
+        self.batch_interval = batch_interval
+        self._update_queue = queue.Queue()
+        self._stop_event = threading.Event()
+        self._worker_thread = threading.Thread(target=self._worker_loop, daemon=True)
+        self._worker_thread.start()
+
+    def _worker_loop(self):
+        batch = []
+        last_process = time.time()
+        while not self._stop_event.is_set():
+            try:
+                batch.append(self._update_queue.get_nowait())
+            except queue.Empty:
+                pass
+            if batch and time.time() - last_process >= self.batch_interval:
+                with self._counters_lock:
+                    for api_key, model, tokens in batch:
+                        self.api_key_counts[api_key] += 1
+                        self.model_counts[model] += 1
+                        self.api_model_counts[api_key][model] += 1
+                        self.api_key_tokens[api_key] += tokens
+                        self.model_tokens[model] += tokens
+                        self.api_model_tokens[api_key][model] += tokens
+                batch = []
+                last_process = time.time()
+            time.sleep(0.01)
+
+    async def update_stats(self, api_key, model, tokens=0):
+        self._update_queue.put((api_key, model, tokens))
+        now = datetime.now()
+        minute_ts = int(now.timestamp() // 60 * 60)
+        with self._time_series_lock:
+            if minute_ts not in self.time_buckets:
+                self.time_buckets[minute_ts] = {"calls": 0, "tokens": 0}
+            self.time_buckets[minute_ts]["calls"] += 1
+            self.time_buckets[minute_ts]["tokens"] += tokens
+        with self._recent_calls_lock:
+            self.recent_calls.append({'api_key': api_key, 'model': model, 'timestamp': now, 'tokens': tokens})
+            if len(self.recent_calls) > self.max_recent_calls:
+                self.recent_calls.pop(0)
+        log('info', f"API调用已记录: 秘钥 '{api_key[:8]}', 模型 '{model}', 令牌: {tokens if tokens is not None else 0}")
+
+    async def close(self):
+        self._stop_event.set()
+        self._worker_thread.join()
+
+
+async def request_path(manager, calls: int, batch: int = 1000) -> float:
+    keys = [f"AIzaSy{i:034d}" for i in range(32)]
+    models = ["gemini-2.5-pro", "gemini-2.5-flash"]
+    elapsed = 0.0
+    for offset in range(0, calls, batch):
+        start = time.perf_counter()
+        for i in range(offset, min(calls, offset + batch)):
+            await manager.update_stats(keys[i % len(keys)], models[i % len(models)], 1000)
+        elapsed += time.perf_counter() - start
+        # 每批之间让出事件循环，后台批处理的耗时不计入请求路径
+        await asyncio.sleep(manager.batch_interval * 2)
+    return elapsed / calls
+
+
+async def idle_cpu(manager, seconds: float = 3.0) -> float:
+    # 先让后台处理完已有的更新
+    await asyncio.sleep(1.5)
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    await asyncio.sleep(seconds)
+    return (time.process_time() - cpu) / (time.perf_counter() - wall)
+
+
+async def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    # 屏蔽日志输出，只测量统计本身的开销
+    logger.setLevel(logging.CRITICAL)
+
+    print(f"calls: {calls}")
+    for name, factory in (("locked", LockedStatsManager), ("buffered", ApiStatsManager)):
+        manager = factory(batch_interval=0.1)
+        cost = await request_path(manager, calls)
+        idle = await idle_cpu(manager)
+        await manager.close()
+        print(f"{name:8s} 请求路径开销: {cost * 1e6:6.2f} us/call  空闲 CPU: {idle * 100:.2f}%")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -39,6 +39,8 @@ export const useDashboardStore = defineStore('dashboard', () => {
 
   const apiKeyStats = ref([])
   const logs = ref([])
+  const lastLogSeq = ref(0)
+  const MAX_CLIENT_LOGS = 500
   const isRefreshing = ref(false)
   const isConfigLoaded = ref(false)
   
@@ -79,6 +81,7 @@ export const useDashboardStore = defineStore('dashboard', () => {
       }
       const data = await response.json()
       updateDashboardData(data)
+      await fetchLogs()
     } catch (error) {
       console.error('获取数据失败:', error)
     } finally {
@@ -86,6 +89,27 @@ export const useDashboardStore = defineStore('dashboard', () => {
     }
   }
 
+  // 增量获取日志：只请求序号大于 lastLogSeq 的新日志
+  async function fetchLogs() {
+    const response = await fetch(`/api/logs?after=${lastLogSeq.value}`)
+    if (!response.ok) {
+      throw new Error(`HTTP error! status: ${response.status}`)
+    }
+    const data = await response.json()
+    // 服务端序号回退（服务已重启或切换了日志来源）时清空本地日志
+    if (data.last_seq < lastLogSeq.value) {
+      logs.value = []
+    }
+    if (data.logs.length > 0) {
+      logs.value = logs.value.concat(data.logs).slice(-MAX_CLIENT_LOGS)
+    }
+    lastLogSeq.value = data.last_seq
+    // 新日志超过一次返回的上限时接着获取剩余部分
+    if (data.has_more) {
+      await fetchLogs()
+    }
+  }
+
   // 更新仪表盘数据
   function updateDashboardData(data) {
     // 更新状态数据
@@ -165,11 +189,6 @@ export const useDashboardStore = defineStore('dashboard', () => {
       }
     }
 
-    // 更新日志
-    if (data.logs) {
-      logs.value = data.logs
-    }
-
     isConfigLoaded.value = true
   }
   
@@ -234,6 +253,7 @@ export const useDashboardStore = defineStore('dashboard', () => {
     isRefreshing,
     timeSeriesData,  // 导出时间序列数据
     fetchDashboardData,
+    fetchLogs,
     selectedModel,
     availableModels,
     setSelectedModel,
@@ -3,6 +3,7 @@ import asyncio
 from unittest.mock import Mock, patch, MagicMock
 from app.utils.api_key import APIKeyManager
 from app.utils.error_handling import handle_gemini_error, handle_api_error
+import app.config.settings as settings
 import httpx
 import requests
 from fastapi import HTTPException
@@ -24,7 +25,7 @@ class TestAPIKeyManager:
         manager.api_keys = ["AIzaSyAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA", 
                            "AIzaSyBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBB",
                            "AIzaSyCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCC"]
-        manager._reset_key_stack()
+        manager.refresh_keys()
         return manager
 
     @pytest.mark.asyncio
@@ -44,55 +45,51 @@ class TestAPIKeyManager:
         # 验证持久化方法被调用
         api_key_manager.persistence.save_settings.assert_called_once()
         
-        # 验证密钥栈已重置
-        # 由于密钥栈是随机排序的，我们验证栈中的密钥数量是否正确
-        assert len(api_key_manager.key_stack) == len(api_key_manager.api_keys)
+        # 验证调度器中的密钥与可用密钥一致
+        assert len(api_key_manager.key_scheduler) == len(api_key_manager.api_keys)
 
     @pytest.mark.asyncio
-    async def test_handle_temporary_failure(self, api_key_manager):
-        """测试handle_temporary_failure方法能正确暂时禁用API Key"""
-        # 获取一个API密钥用于测试
-        initial_key_count = len(api_key_manager.api_keys)
-        initial_temp_failed_count = len(api_key_manager.temp_failed_keys)
+    async def test_handle_temporary_failure(self, api_key_manager, monkeypatch):
+        """测试handle_temporary_failure方法让API Key进入冷却，且连续失败时冷却时间指数增长"""
+        monkeypatch.setattr(settings, "KEY_COOLDOWN_BASE", 10)
+        monkeypatch.setattr(settings, "KEY_COOLDOWN_MAX", 1000)
         test_key = api_key_manager.api_keys[0]
-        
+
         # 调用handle_temporary_failure方法
         await api_key_manager.handle_temporary_failure(test_key)
-        
-        # 验证API密钥已从可用密钥中移除
-        assert test_key not in api_key_manager.api_keys
-        assert len(api_key_manager.api_keys) == initial_key_count - 1
-        
-        # 验证API密钥已添加到临时失败密钥集合中
-        assert test_key in api_key_manager.temp_failed_keys
-        assert len(api_key_manager.temp_failed_keys) == initial_temp_failed_count + 1
-        
-        # 验证密钥栈已重置
-        assert len(api_key_manager.key_stack) == len(api_key_manager.api_keys)
 
-    @pytest.mark.asyncio
-    async def test_reactivate_temp_failed_keys(self, api_key_manager):
-        """测试reactivate_temp_failed_keys方法能正确重新激活临时禁用的API Key"""
-        # 先添加一个临时失败的密钥
-        test_key = "AIzaSyDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDD"
-        api_key_manager.temp_failed_keys.add(test_key)
-        
-        # 记录初始状态
-        initial_api_key_count = len(api_key_manager.api_keys)
-        initial_temp_failed_count = len(api_key_manager.temp_failed_keys)
-        
-        # 调用重新激活方法
-        await api_key_manager._reactivate_temp_failed_keys_async()
-        
-        # 验证临时失败密钥已被移除
-        assert len(api_key_manager.temp_failed_keys) == 0
-        
-        # 验证API密钥已重新添加到可用密钥中
+        # 验证API密钥仍在密钥列表中，但不会被调度
         assert test_key in api_key_manager.api_keys
-        assert len(api_key_manager.api_keys) == initial_api_key_count + 1
-        
-        # 验证密钥栈已重置
-        assert len(api_key_manager.key_stack) == len(api_key_manager.api_keys)
+        keys = await api_key_manager.checkout_keys(3)
+        assert test_key not in keys
+        assert len(keys) == 2
+
+        # 验证冷却状态，首次冷却时间在 [BASE/2, BASE] 之间
+        cooldowns = api_key_manager.get_cooldowns()
+        assert [item['api_key'] for item in cooldowns] == [test_key[:8]]
+        assert 5 <= cooldowns[0]['remaining'] <= 10
+
+        # 再次失败，冷却时间翻倍
+        delay = api_key_manager.key_scheduler.record_failure(test_key, cooldown=True)
+        assert 10 <= delay <= 20
+
+    @pytest.mark.asyncio
+    async def test_cooldown_expires(self, api_key_manager, monkeypatch):
+        """测试冷却到期后API Key自动恢复调度，成功后退避次数清零"""
+        monkeypatch.setattr(settings, "KEY_COOLDOWN_BASE", 0.01)
+        test_key = api_key_manager.api_keys[0]
+        await api_key_manager.handle_temporary_failure(test_key)
+
+        await asyncio.sleep(0.02)
+
+        # 冷却到期后重新出现在调度结果中
+        keys = await api_key_manager.checkout_keys(3)
+        assert test_key in keys
+        assert api_key_manager.get_cooldowns() == []
+
+        api_key_manager.report_success(test_key)
+        delay = api_key_manager.key_scheduler.record_failure(test_key, cooldown=True)
+        assert delay <= 0.01
 
     @pytest.mark.asyncio
     async def test_get_available_key(self, api_key_manager):
@@ -106,26 +103,59 @@ class TestAPIKeyManager:
                       "AIzaSyBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBB",
                       "AIzaSyCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCC"]
         
-        # 验证密钥栈中的密钥数量减少
-        assert len(api_key_manager.key_stack) == 2
+    @pytest.mark.asyncio
+    async def test_checkout_keys_distinct(self, api_key_manager):
+        """测试checkout_keys一次返回互不相同的密钥，且依次轮换"""
+        keys = await api_key_manager.checkout_keys(3)
+        assert sorted(keys) == sorted(api_key_manager.api_keys)
+
+        # 请求数量超过密钥数量时只返回全部密钥
+        keys = await api_key_manager.checkout_keys(5)
+        assert len(keys) == 3
+
+        # 用量相同的密钥轮流被取出
+        first = await api_key_manager.get_available_key()
+        second = await api_key_manager.get_available_key()
+        assert first != second
+
+        # 排除的密钥（本批次已在使用的）不被返回
+        keys = await api_key_manager.checkout_keys(3, exclude={first})
+        assert first not in keys and len(keys) == 2
 
     @pytest.mark.asyncio
-    async def test_get_available_key_empty_stack(self, api_key_manager):
-        """测试当密钥栈为空时，get_available_key方法能正确重新生成密钥栈"""
-        # 清空密钥栈
-        api_key_manager.key_stack = []
-        
-        # 获取一个API密钥
-        key = await api_key_manager.get_available_key()
-        
-        # 验证返回的密钥不为None且在初始密钥列表中
-        assert key is not None
-        assert key in ["AIzaSyAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA", 
-                      "AIzaSyBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBB",
-                      "AIzaSyCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCC"]
-        
-        # 验证密钥栈已被重新生成
-        assert len(api_key_manager.key_stack) == 2
+    async def test_checkout_keys_daily_limit(self, api_key_manager, monkeypatch):
+        """测试达到每日限额的密钥不再被优先调度，全部达到限额时返回用量最少的密钥"""
+        monkeypatch.setattr(settings, "API_KEY_DAILY_LIMIT", 2)
+        exhausted, light, heavy = api_key_manager.api_keys
+        for _ in range(2):
+            api_key_manager.report_success(exhausted)
+
+        keys = await api_key_manager.checkout_keys(3)
+        assert exhausted not in keys
+        assert len(keys) == 2
+
+        api_key_manager.report_success(light)
+        for _ in range(3):
+            api_key_manager.report_success(heavy)
+        api_key_manager.report_success(light)
+
+        # 所有密钥都已达到限额，只返回用量最少的一个
+        keys = await api_key_manager.checkout_keys(3)
+        assert keys in ([exhausted], [light])
+
+        # 每日重置后所有密钥重新可用
+        api_key_manager.reset_usage()
+        keys = await api_key_manager.checkout_keys(3)
+        assert len(keys) == 3
+
+    @pytest.mark.asyncio
+    async def test_error_rate_lowers_priority(self, api_key_manager):
+        """测试近期出错的密钥排在健康密钥之后"""
+        failing = api_key_manager.api_keys[0]
+        api_key_manager.report_failure(failing)
+
+        keys = await api_key_manager.checkout_keys(3)
+        assert keys[-1] == failing
 
 
 class TestErrorHandling:
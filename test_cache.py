@@ -0,0 +1,113 @@
+import pytest
+import time
+from app.utils.cache import ResponseCacheManager, estimate_retained_size, generate_cache_key, generate_payload_key
+from app.models.schemas import ChatCompletionRequest
+from app.services.gemini import GeminiResponseWrapper
+
+
+class TestResponseCacheManager:
+    """测试ResponseCacheManager的索引式LRU+TTL实现"""
+
+    @pytest.fixture
+    def cache_manager(self):
+        """创建一个小容量的缓存管理器用于测试"""
+        return ResponseCacheManager(expiry_time=60, max_entries=3)
+
+    @pytest.mark.asyncio
+    async def test_multiple_items_per_key(self, cache_manager):
+        """测试同一个键可以存储多个缓存项，并按存入顺序取出"""
+        await cache_manager.store("key", "first")
+        await cache_manager.store("key", "second")
+
+        # get 不删除缓存项
+        assert await cache_manager.get("key") == ("first", True)
+        assert cache_manager.cur_cache_num == 2
+
+        assert await cache_manager.get_and_remove("key") == ("first", True)
+        assert await cache_manager.get_and_remove("key") == ("second", True)
+        assert await cache_manager.get_and_remove("key") == (None, False)
+        assert "key" not in cache_manager.cache
+        assert cache_manager.cur_cache_num == 0
+
+    @pytest.mark.asyncio
+    async def test_capacity_eviction_is_lru(self, cache_manager):
+        """测试超出容量时淘汰最久未使用的缓存项"""
+        await cache_manager.store("a", "A")
+        await cache_manager.store("b", "B")
+        await cache_manager.store("c", "C")
+
+        # 访问 a，使 b 成为最久未使用的项
+        await cache_manager.get("a")
+        await cache_manager.store("d", "D")
+
+        assert cache_manager.cur_cache_num == 3
+        assert await cache_manager.get("b") == (None, False)
+        assert await cache_manager.get("a") == ("A", True)
+
+    @pytest.mark.asyncio
+    async def test_expired_items(self, cache_manager, monkeypatch):
+        """测试过期缓存项不会被返回，并能被 clean_expired 清理"""
+        await cache_manager.store("key", "old")
+        now = time.time()
+        monkeypatch.setattr(time, "time", lambda: now + 120)
+        await cache_manager.store("key", "new")
+
+        # 过期项被跳过并移除
+        assert await cache_manager.get("key") == ("new", True)
+        await cache_manager.store("other", "value")
+        await cache_manager.clean_expired()
+        assert cache_manager.cur_cache_num == 2
+
+        assert await cache_manager.get_and_remove("key") == ("new", True)
+        assert cache_manager.cur_cache_num == 1
+
+    @pytest.mark.asyncio
+    async def test_byte_budget_eviction(self):
+        """测试启用 max_bytes 后按字节预算淘汰并统计淘汰字节数"""
+        payload = "x" * 1000
+        manager = ResponseCacheManager(expiry_time=60, max_entries=100, max_bytes=3000)
+
+        await manager.store("a", {"text": payload})
+        await manager.store("b", {"text": payload})
+        assert manager.cur_cache_num == 2
+        assert manager.evicted_bytes == 0
+
+        await manager.store("c", {"text": payload})
+        assert manager.cur_cache_num == 2
+        assert manager.cur_cache_bytes <= 3000
+        assert manager.evicted_bytes > 1000
+        assert await manager.get("a") == (None, False)
+
+        await manager.get_and_remove("b")
+        await manager.get_and_remove("c")
+        assert manager.cur_cache_bytes == 0
+
+    @pytest.mark.asyncio
+    async def test_size_includes_lazy_fields(self, cache_manager):
+        """测试惰性字段在测量大小前已计算，读取缓存的响应后占用不再增长"""
+        response = GeminiResponseWrapper({
+            "candidates": [{"content": {"parts": [{"text": "x" * 1000}]}, "finishReason": "STOP"}],
+            "usageMetadata": {"promptTokenCount": 1, "candidatesTokenCount": 2, "totalTokenCount": 3},
+        })
+        await cache_manager.store("key", response)
+        size = cache_manager.cur_cache_bytes
+
+        cached, _ = await cache_manager.get("key")
+        assert cached.text == "x" * 1000 and cached.total_token_count == 3
+        assert estimate_retained_size(cached) == size
+
+
+class TestCacheKeys:
+    """测试请求键的计算"""
+
+    def test_payload_key_covers_all_parameters(self):
+        """测试缓存键只包含模型和消息，完整请求键还区分采样参数和工具"""
+        messages = [{"role": "user", "content": "你好"}]
+        base = ChatCompletionRequest(model="gemini-2.5-pro", messages=messages, stream=True)
+        warmer = ChatCompletionRequest(model="gemini-2.5-pro", messages=messages, stream=True, temperature=1.5)
+        with_tools = ChatCompletionRequest(model="gemini-2.5-pro", messages=messages, stream=True,
+                                           tools=[{"type": "function", "function": {"name": "f"}}])
+
+        assert generate_cache_key(base) == generate_cache_key(warmer) == generate_cache_key(with_tools)
+        assert len({generate_payload_key(r) for r in (base, warmer, with_tools)}) == 3
+        assert generate_payload_key(base) == generate_payload_key(base.model_copy())
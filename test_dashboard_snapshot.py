@@ -0,0 +1,84 @@
+import asyncio
+import json
+import pytest
+from app.utils.dashboard_snapshot import DashboardSnapshot
+
+
+class TestDashboardSnapshot:
+    """测试仪表盘快照的版本、ETag 和增量推送"""
+
+    @pytest.mark.asyncio
+    async def test_version_and_etag_follow_changes(self):
+        """测试只有分区内容变化时版本和 ETag 才变化，current_time 不参与比较"""
+        state = {'calls': 1, 'current_time': '10:00:00'}
+
+        async def builder():
+            return dict(state)
+
+        snapshot = DashboardSnapshot(builder, interval=60)
+        await snapshot.current()
+        first_etag = snapshot.etag
+        assert snapshot.version == 1
+        assert json.loads(snapshot.body) == state
+
+        state['current_time'] = '10:00:02'
+        await snapshot.refresh()
+        assert snapshot.version == 1 and snapshot.etag == first_etag
+
+        state['calls'] = 2
+        snapshot.invalidate()
+        await snapshot.current()
+        assert snapshot.version == 2 and snapshot.etag != first_etag
+
+    @pytest.mark.asyncio
+    async def test_stream_pushes_changed_sections(self):
+        """测试 SSE 订阅者先收到完整快照，之后只收到变化的分区"""
+        state = {'calls': 1, 'keys': ['a'], 'current_time': '10:00:00'}
+
+        async def builder():
+            return dict(state)
+
+        snapshot = DashboardSnapshot(builder, interval=60)
+        stream = snapshot.stream()
+        first = await stream.__anext__()
+        assert first.startswith("event: snapshot")
+
+        state['calls'] = 5
+        await snapshot.refresh()
+        update = await stream.__anext__()
+        assert update.startswith("event: update")
+        payload = json.loads(update.split("data: ", 1)[1])
+        assert payload['version'] == 2
+        assert set(payload['sections']) == {'calls', 'current_time'}
+
+        await stream.aclose()
+        assert not snapshot.subscribers
+
+
+    @pytest.mark.asyncio
+    async def test_background_refresh_only_while_watched(self):
+        """测试没有订阅者和轮询时后台任务不构建快照"""
+        builds = 0
+
+        async def builder():
+            nonlocal builds
+            builds += 1
+            return {'calls': builds}
+
+        snapshot = DashboardSnapshot(builder, interval=0.02)
+        snapshot.start()
+        await asyncio.sleep(0.1)
+        assert builds == 0
+
+        # 轮询时按需构建，轮询停止一个刷新间隔后后台任务不再构建
+        await snapshot.current()
+        assert builds == 1
+        await asyncio.sleep(0.1)
+        idle_builds = builds
+        await asyncio.sleep(0.1)
+        assert builds == idle_builds
+        await snapshot.close()
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
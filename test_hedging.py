@@ -0,0 +1,65 @@
+import pytest
+import asyncio
+import app.config.settings as settings
+from app.utils.hedging import HedgedAttempts, LatencyTracker
+from app.utils.stats import api_stats_manager
+
+
+class TestHedging:
+    """测试对冲请求"""
+
+    def test_latency_percentile(self):
+        """测试样本足够时按分位数计算对冲延迟，样本不足时使用默认值"""
+        tracker = LatencyTracker(min_samples=10)
+        assert tracker.hedge_delay("model") == settings.HEDGE_DEFAULT_DELAY
+
+        for i in range(1, 101):
+            tracker.record("model", float(i))
+        assert tracker.percentile("model", 0.95) == 95.0
+        assert tracker.hedge_delay("model") == 95.0
+
+    @pytest.mark.asyncio
+    async def test_hedge_after_delay_and_cancel_loser(self, monkeypatch):
+        """测试对冲模式下第一个请求超时后才追加请求，成功后取消其余请求并记录浪费次数"""
+        monkeypatch.setattr(settings, "HEDGE_ENABLED", True)
+        monkeypatch.setattr(settings, "HEDGE_DEFAULT_DELAY", 0.05)
+        cancelled = []
+
+        async def launch(api_key):
+            try:
+                await asyncio.sleep(10 if api_key == "slow" else 0.01)
+                return "success"
+            except asyncio.CancelledError:
+                cancelled.append(api_key)
+                raise
+
+        pool = ["slow", "fast", "unused"]
+        checked_out = []
+
+        async def checkout(n, exclude=()):
+            keys = [key for key in pool if key not in exclude][:n]
+            checked_out.extend(keys)
+            return keys
+
+        before = api_stats_manager.get_attempt_stats()
+        attempts = HedgedAttempts(checkout, 3, launch, "hedge-test-model")
+        assert await attempts.start()
+        assert attempts.launched == 1 and checked_out == ["slow"]
+
+        done = await attempts.wait()
+        assert [api_key for api_key, _ in done] == ["fast"]
+        assert attempts.launched == 2
+
+        wasted = attempts.settle(done[0][1])
+        await asyncio.sleep(0)
+        assert wasted == 1
+        assert cancelled == ["slow"]
+        # 未发出的对冲不取出密钥
+        assert checked_out == ["slow", "fast"] and not attempts
+        after = api_stats_manager.get_attempt_stats()
+        assert after['attempts'] - before['attempts'] == 2
+        assert after['wasted'] - before['wasted'] == 1
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
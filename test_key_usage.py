@@ -0,0 +1,65 @@
+import pytest
+from app.utils.key_usage import KeyUsageWindow
+
+
+class TestKeyUsageWindow:
+    """测试按密钥统计最近24小时调用次数的滑动窗口"""
+
+    def test_calls_expire_after_window(self):
+        """测试调用次数在滑出窗口后自动减少，而不是等待每日重置"""
+        window = KeyUsageWindow(minutes=60)
+        start = window.head * 60
+        window.add_key("key-a")
+        window.add_key("key-b")
+
+        window.record("key-a", now=start)
+        window.record("key-a", now=start + 30 * 60)
+        window.record("key-b", now=start + 30 * 60)
+        assert window.count("key-a") == 2
+
+        # 第一次调用所在分钟在 60 分钟后滑出窗口
+        assert window.seconds_until_free("key-a", now=start + 30 * 60) == pytest.approx(30 * 60)
+        assert window.advance(now=start + 60 * 60) == ["key-a"]
+        assert window.count("key-a") == 1
+        assert window.count("key-b") == 1
+
+        # 窗口整体滑过后全部清零
+        window.advance(now=start + 200 * 60)
+        assert window.count("key-a") == window.count("key-b") == 0
+
+    def test_removed_row_is_reused(self):
+        """测试移除密钥后其行被清零并复用"""
+        window = KeyUsageWindow(minutes=10)
+        window.add_key("key-a")
+        window.record("key-a")
+        window.remove_key("key-a")
+        window.add_key("key-b")
+
+        assert len(window.totals) == 1
+        assert window.count("key-b") == 0
+        assert window.count("key-a") == 0
+
+    def test_next_release_tracks_oldest_minute(self):
+        """测试最早恢复额度的时间取自每行最早的非零分钟，已移出调度的密钥不参与"""
+        window = KeyUsageWindow(minutes=60)
+        start = window.head * 60
+        for key in ("key-a", "key-b", "parked"):
+            window.add_key(key)
+        window.record("parked", now=start)
+        window.record("key-a", now=start + 10 * 60)
+        window.add_count("key-b", window.head - 5, 2)
+        window.add_count("key-a", window.head - 1, 1)
+
+        assert window.export()["key-a"] == [(window.head - 1, 1), (window.head, 1)]
+        now = start + 10 * 60
+        assert window.next_release_in({"key-a", "key-b"}, now=now) == pytest.approx(55 * 60)
+        assert window.next_release_in({"key-a", "key-b", "parked"}, now=now) == pytest.approx(50 * 60)
+
+        # 空闲超过整个窗口后整体清零
+        assert sorted(window.advance(now=start + 500 * 60)) == ["key-a", "key-b", "parked"]
+        assert window.export() == {}
+        assert window.next_release_in({"key-a"}) == 0.0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
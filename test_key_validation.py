@@ -0,0 +1,105 @@
+import asyncio
+import httpx
+import pytest
+from app.config import settings
+from app.utils.api_key import APIKeyManager, test_api_key as check_api_key
+from app.utils.key_validation import KeyValidator
+
+VALID = ["AIzaSy" + chr(ord("A") + i) * 33 for i in range(6)]
+INVALID = ["AIzaSy" + chr(ord("a") + i) * 33 for i in range(4)]
+
+
+class TestKeyValidator:
+    """测试并发密钥校验引擎"""
+
+    @pytest.mark.asyncio
+    async def test_bounded_concurrency_and_incremental_apply(self):
+        """测试并发数受限，结果逐个应用到密钥管理器"""
+        running = 0
+        peak = 0
+
+        async def check(key):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            return key in VALID
+
+        manager = APIKeyManager()
+        manager.api_keys = [INVALID[0]]
+        manager.refresh_keys()
+        validator = KeyValidator(check)
+
+        valid, invalid = await validator.run(VALID + INVALID, on_result=manager.apply_validation,
+                                             concurrency=3, qps=0)
+
+        assert peak == 3
+        assert sorted(valid) == sorted(VALID) and sorted(invalid) == sorted(INVALID)
+        assert sorted(manager.api_keys) == sorted(VALID)
+        assert INVALID[0] not in manager.key_scheduler
+        assert validator.progress["completed"] == 10 and validator.progress["is_completed"]
+
+    @pytest.mark.asyncio
+    async def test_unknown_results_keep_key_state(self, monkeypatch):
+        """测试限流、网络错误和超时无法判断密钥是否有效，密钥保持原状态"""
+        monkeypatch.setattr(settings, "KEY_CHECK_TIMEOUT", 0.05)
+
+        async def check(key):
+            if key == VALID[0]:
+                return None
+            if key == VALID[1]:
+                raise ConnectionError("network down")
+            if key == VALID[2]:
+                await asyncio.sleep(1)
+            return key in VALID
+
+        manager = APIKeyManager()
+        manager.api_keys = VALID[:3]
+        manager.refresh_keys()
+        validator = KeyValidator(check)
+
+        valid, invalid = await validator.run(VALID[:3] + INVALID[:1], on_result=manager.apply_validation, qps=0)
+
+        assert valid == [] and invalid == INVALID[:1]
+        assert sorted(manager.api_keys) == sorted(VALID[:3])
+        assert validator.progress["unknown"] == 3
+
+    @pytest.mark.asyncio
+    async def test_only_rejected_keys_are_invalid(self):
+        """测试只有 400 密钥无效、401、403 才判定为无效"""
+        responses = {
+            "ok": httpx.Response(200, json={"models": []}),
+            "bad": httpx.Response(400, json={"error": {"status": "INVALID_ARGUMENT", "details": [{"reason": "API_KEY_INVALID"}]}}),
+            "forbidden": httpx.Response(403),
+            "other_400": httpx.Response(400, json={"error": {"message": "Request contains an invalid argument."}}),
+            "limited": httpx.Response(429),
+            "server_error": httpx.Response(503),
+        }
+        client = httpx.AsyncClient(transport=httpx.MockTransport(
+            lambda request: responses[request.url.params["key"]]))
+        async with client:
+            results = {key: await check_api_key(key, client) for key in responses}
+
+        assert results == {"ok": True, "bad": False, "forbidden": False,
+                           "other_400": None, "limited": None, "server_error": None}
+
+    @pytest.mark.asyncio
+    async def test_cancel_keeps_completed_results(self):
+        """测试取消后停止检测，已完成的结果保留"""
+        async def check(key):
+            await asyncio.sleep(0.05)
+            return True
+
+        validator = KeyValidator(check)
+        task = asyncio.create_task(validator.run(VALID, concurrency=2, qps=0))
+        await asyncio.sleep(0.07)
+        assert validator.cancel()
+        valid, _ = await task
+
+        assert len(valid) == 2
+        assert validator.progress["cancelled"] and not validator.is_running
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
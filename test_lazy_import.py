@@ -0,0 +1,23 @@
+import sys
+import pytest
+from app.utils.lazy_import import is_loaded, lazy_import
+
+
+class TestLazyImport:
+    """测试重量级后端模块的延迟导入"""
+
+    def test_module_loaded_on_first_attribute_access(self):
+        """测试创建代理时不导入模块，第一次访问属性时才导入"""
+        name = "xml.dom.minidom"
+        sys.modules.pop(name, None)
+
+        module = lazy_import(name)
+        assert not is_loaded(name)
+
+        document = module.parseString("<a/>")
+        assert is_loaded(name)
+        assert document.documentElement.tagName == "a"
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,123 @@
+import pytest
+from app.utils.logging import LogSampler, LogStore, log, log_manager, log_pipeline, set_log_level
+
+
+class TestLogPipeline:
+    """测试非阻塞日志管道"""
+
+    def test_records_are_formatted_in_background(self):
+        """测试日志由后台线程格式化并写入前端日志缓存"""
+        log('info', "后台格式化测试", extra={'key': 'AIzaSyAA', 'model': 'gemini-2.5-pro'}, status_code=200)
+        log_pipeline.flush()
+
+        entry = log_manager.get_recent_logs(1)[0]
+        assert entry['message'] == "后台格式化测试"
+        assert entry['key'] == 'AIzaSyAA'
+        assert entry['status_code'] == 200
+        assert "[INFO] [AIzaSyAA]" in entry['formatted']
+
+    def test_below_level_is_dropped(self):
+        """测试低于配置级别的日志直接丢弃"""
+        set_log_level("WARNING")
+        try:
+            log('info', "不应出现的日志")
+            log('warning', "应出现的警告")
+            log_pipeline.flush()
+        finally:
+            set_log_level("DEBUG")
+
+        messages = [entry['message'] for entry in log_manager.get_recent_logs(2)]
+        assert "不应出现的日志" not in messages
+        assert messages[-1] == "应出现的警告"
+
+    def test_formatter_error_goes_to_stderr(self, capsys):
+        """测试格式化函数出错时原始消息写入标准错误，不会被静默丢弃"""
+        def broken(level, message, extra=None, created=None):
+            raise ValueError("bad format")
+
+        log_pipeline.submit((0.0, 20, 'INFO', "格式化失败的日志", None, broken))
+        log_pipeline.flush()
+
+        err = capsys.readouterr().err
+        assert "ValueError: bad format" in err and "格式化失败的日志" in err
+
+
+class TestLogSampler:
+    """测试高频日志的采样与聚合"""
+
+    def test_sampling_and_summary(self):
+        """测试按类别采样率输出，被省略的日志汇总为一条，警告始终输出"""
+        sampler = LogSampler()
+        sampler.configure("stats:0.1,auth:0", interval=10)
+
+        admitted = [sampler.admit(20, f"API调用已记录 {i}", 'stats') for i in range(100)]
+        assert sum(admitted) == 10 and admitted[0]
+        assert not sampler.admit(20, "[DEBUG] 密码认证成功", 'auth')
+        assert sampler.admit(40, "[DEBUG] 密码认证失败", 'auth')
+        assert sampler.admit(20, "未分类的日志", None)
+
+        assert sampler.summaries() == []
+        lines = sampler.summaries(force=True)
+        assert len(lines) == 2
+        assert "[stats]" in lines[0] and "x100" in lines[0] and "已省略 90 条" in lines[0]
+        assert "API调用已记录 99" in lines[0]
+        assert sampler.timeout() is None
+
+    def test_repeated_untagged_messages_are_collapsed(self):
+        """测试未分类的重复日志按消息模板聚合，超过重复上限的部分汇总为一条"""
+        sampler = LogSampler()
+        sampler.configure("", interval=10, repeat_limit=3)
+
+        admitted = [sampler.admit(20, f"请求第 {i} 次重试", None) for i in range(10)]
+        assert admitted == [True] * 3 + [False] * 7
+        assert sampler.admit(20, "另一条日志", None)
+
+        lines = sampler.summaries(force=True)
+        assert len(lines) == 1
+        assert "x10" in lines[0] and "已省略 7 条" in lines[0] and "请求第 9 次重试" in lines[0]
+        assert sampler.admit(20, "请求第 10 次重试", None)
+
+
+class TestLogStore:
+    """测试带序号和二级索引的日志存储"""
+
+    def test_incremental_filtered_query(self):
+        """测试按序号增量获取日志并按级别/模型过滤，超出容量的日志被淘汰"""
+        store = LogStore(max_logs=5)
+        for i in range(8):
+            store.add_log({'level': 'ERROR' if i % 2 else 'INFO', 'key': 'AIzaSyAA',
+                           'model': 'gemini-2.5-pro' if i < 6 else 'gemini-2.5-flash', 'message': str(i)})
+
+        logs, last_seq, has_more = store.query(0)
+        assert last_seq == 8 and not has_more
+        assert [entry['seq'] for entry in logs] == [4, 5, 6, 7, 8]
+
+        logs, _, _ = store.query(5, level='ERROR')
+        assert [entry['message'] for entry in logs] == ['5', '7']
+
+        logs, _, _ = store.query(0, level='ERROR', model='gemini-2.5-pro')
+        assert [entry['seq'] for entry in logs] == [4, 6]
+        assert store.query(8)[0] == []
+
+    def test_query_over_limit_has_no_gap(self):
+        """测试超过 limit 时返回最旧的日志，按返回的序号继续查询可以取得全部日志"""
+        store = LogStore(max_logs=10)
+        for i in range(7):
+            store.add_log({'level': 'ERROR' if i % 2 else 'INFO', 'message': str(i)})
+
+        seen, after = [], 0
+        while True:
+            logs, after, has_more = store.query(after, limit=2)
+            seen.extend(entry['seq'] for entry in logs)
+            if not has_more:
+                break
+        assert seen == list(range(1, 8)) and after == 7
+
+        logs, after, has_more = store.query(0, limit=2, level='ERROR')
+        assert [entry['seq'] for entry in logs] == [2, 4] and after == 4 and has_more
+        logs, after, has_more = store.query(after, limit=2, level='ERROR')
+        assert [entry['seq'] for entry in logs] == [6] and after == 7 and not has_more
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
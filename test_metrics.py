@@ -0,0 +1,60 @@
+import pytest
+from fastapi.responses import StreamingResponse
+import httpx
+from app.utils.metrics import (Counter, Histogram, MetricsRegistry, track_response, inflight_streams, request_duration,
+                               key_label, model_label, upstream_error_status)
+
+
+class TestMetrics:
+    """测试进程内指标的记录与Prometheus文本输出"""
+
+    def test_render_counter_and_histogram(self):
+        """测试计数器与直方图按标签输出，直方图桶为累计值"""
+        registry = MetricsRegistry()
+        requests = registry.register(Counter("test_requests_total", "请求数", ("model",)))
+        latency = registry.register(Histogram("test_latency_seconds", "耗时", ("model",), buckets=(1, 5)))
+
+        requests.labels("gemini-2.5-pro").inc()
+        requests.labels("gemini-2.5-pro").inc(2)
+        for value in (0.5, 3, 10):
+            latency.labels("gemini-2.5-pro").observe(value)
+
+        text = registry.render()
+        assert 'test_requests_total{model="gemini-2.5-pro"} 3' in text
+        assert 'test_latency_seconds_bucket{model="gemini-2.5-pro",le="1"} 1' in text
+        assert 'test_latency_seconds_bucket{model="gemini-2.5-pro",le="5"} 2' in text
+        assert 'test_latency_seconds_bucket{model="gemini-2.5-pro",le="+Inf"} 3' in text
+        assert 'test_latency_seconds_count{model="gemini-2.5-pro"} 3' in text
+
+    @pytest.mark.asyncio
+    async def test_track_streaming_response(self):
+        """测试流式响应在发送期间计入进行中的流，结束后记录耗时"""
+        async def body():
+            yield "data: 1\n\n"
+
+        response = track_response(StreamingResponse(body()), "test", "stream", "m", 0.0)
+        inflight = inflight_streams.labels("test")
+        duration = request_duration.labels("test", "stream", "m")
+
+        chunks = []
+        async for chunk in response.body_iterator:
+            chunks.append(chunk)
+            assert inflight.value == 1
+
+        assert chunks == ["data: 1\n\n"]
+        assert inflight.value == 0
+        assert sum(duration.counts) == 1
+
+    def test_bounded_labels(self):
+        """测试未知模型记为 other，上游超时和连接错误分别记为 timeout 和 error，密钥标签按哈希区分"""
+        assert model_label("gemini-2.5-pro", ["gemini-2.5-pro"]) == "gemini-2.5-pro"
+        assert model_label("anything-a-client-sends", ["gemini-2.5-pro"]) == "other"
+        assert upstream_error_status(httpx.ReadTimeout("timed out")) == "timeout"
+        assert upstream_error_status(httpx.ConnectError("refused")) == "error"
+        # 相同前缀的不同密钥得到不同的标签，同一密钥的标签保持不变
+        first, second = "AIzaSy" + "A" * 33, "AIzaSy" + "B" * 33
+        assert key_label(first) != key_label(second) and key_label(first) == key_label("AIzaSy" + "A" * 33)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
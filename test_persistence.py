@@ -0,0 +1,130 @@
+import json
+import sqlite3
+import time
+import pytest
+from app.config import settings
+from app.config.persistence import (PERSISTED_SETTINGS, ConnectionPool, FilePersistence, MySQLPersistence,
+                                    PersistenceUnavailable, SettingsWriter, collect_settings)
+
+
+class SQLitePersistence(MySQLPersistence):
+    """用 SQLite 代替 MySQL 的持久化对象"""
+    placeholder = "?"
+    delta_id_column = "INTEGER PRIMARY KEY AUTOINCREMENT"
+    db_error = sqlite3.Error
+
+    def __init__(self, path):
+        self.path = path
+        super().__init__()
+
+    def _new_connection(self):
+        return sqlite3.connect(self.path, check_same_thread=False)
+
+    def rows(self):
+        with sqlite3.connect(self.path) as conn:
+            return dict(conn.execute("SELECT `key`, `value` FROM settings").fetchall())
+
+
+class TestSettingsWriter:
+    """测试设置的防抖合并写入"""
+
+    def test_coalesce_changes_within_debounce_window(self):
+        """测试防抖窗口内的多次修改只写入一次，且写入的是最新配置"""
+        writes = []
+        writer = SettingsWriter(writes.append, debounce=0.05)
+        original = settings.INVALID_API_KEYS
+        try:
+            for i in range(50):
+                settings.INVALID_API_KEYS = f"key{i}"
+                writer.mark_dirty()
+            time.sleep(0.3)
+        finally:
+            settings.INVALID_API_KEYS = original
+
+        assert len(writes) == 1
+        assert writes[0]["INVALID_API_KEYS"] == "key49"
+        assert not writer.flush()
+
+    def test_failed_write_is_retried(self):
+        """测试写入失败时修改保持未保存，等待重试间隔后再次写入"""
+        writes = []
+
+        def write(data):
+            writes.append(data)
+            if len(writes) == 1:
+                raise PersistenceUnavailable("refused")
+
+        writer = SettingsWriter(write, debounce=0.01, retry_delay=lambda: 0.05)
+        writer.mark_dirty()
+        time.sleep(0.3)
+
+        assert len(writes) == 2
+        assert not writer.pending
+
+    def test_file_write_is_atomic_and_uses_registry(self, tmp_path, monkeypatch):
+        """测试文件写入通过临时文件替换，只包含登记的配置项"""
+        monkeypatch.setattr(settings, "STORAGE_DIR", str(tmp_path))
+        monkeypatch.setattr(settings, "ENABLE_STORAGE", True)
+        persistence = FilePersistence()
+        persistence.settings_writer.debounce = 60
+
+        persistence.save_settings()
+        assert not persistence.settings_file.exists()
+        assert persistence.flush_settings()
+
+        saved = json.loads(persistence.settings_file.read_text(encoding="utf-8"))
+        assert set(saved) <= set(PERSISTED_SETTINGS)
+        assert "PASSWORD" not in saved
+        assert [p.name for p in tmp_path.iterdir()] == ["settings.json"]
+
+
+class TestMySQLPersistence:
+    """用 SQLite 测试连接池化的 MySQL 持久化"""
+
+    def test_only_changed_settings_are_written(self, tmp_path, monkeypatch):
+        """测试保存时只写入有变化的配置项，重启后可以加载"""
+        persistence = SQLitePersistence(str(tmp_path / "settings.db"))
+        persistence.write_settings(collect_settings())
+        assert persistence.rows()["MAX_RETRY_NUM"] == str(settings.MAX_RETRY_NUM)
+
+        with sqlite3.connect(persistence.path) as conn:
+            conn.execute("DELETE FROM settings")
+        monkeypatch.setattr(settings, "MAX_RETRY_NUM", settings.MAX_RETRY_NUM + 1)
+        persistence.write_settings(collect_settings())
+        assert persistence.rows() == {"MAX_RETRY_NUM": str(settings.MAX_RETRY_NUM)}
+
+        expected = settings.MAX_RETRY_NUM
+        monkeypatch.setattr(settings, "MAX_RETRY_NUM", 1)
+        restarted = SQLitePersistence(persistence.path)
+        assert restarted.load_settings()
+        assert settings.MAX_RETRY_NUM == expected
+
+    def test_usage_snapshot_and_deltas(self, tmp_path):
+        """测试用量快照和增量日志的读写"""
+        persistence = SQLitePersistence(str(tmp_path / "settings.db"))
+        assert persistence.load_usage() == (None, b"")
+        persistence.append_usage_deltas(b"a")
+        persistence.save_usage_snapshot(b"snapshot")
+        persistence.append_usage_deltas(b"b")
+        persistence.append_usage_deltas(b"c")
+        assert persistence.load_usage() == (b"snapshot", b"bc")
+
+    def test_pool_fails_fast_during_backoff(self):
+        """测试建立连接失败后进入退避期，期间不再尝试连接"""
+        attempts = []
+
+        def connect():
+            attempts.append(1)
+            raise ConnectionRefusedError("refused")
+
+        pool = ConnectionPool(connect, size=2)
+        for _ in range(3):
+            with pytest.raises(PersistenceUnavailable):
+                with pool.connection():
+                    pass
+        assert len(attempts) == 1
+        assert pool.retry_in() > 0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,106 @@
+import pytest
+from unittest.mock import patch
+from app.utils.rate_limiting import LocalRateLimiter, RedisRateLimiter, MINUTE_WINDOW, MINUTE_BUCKETS
+
+
+class TestLocalRateLimiter:
+    """测试进程内滑动窗口限流器"""
+
+    @pytest.mark.asyncio
+    async def test_sliding_window(self):
+        """测试窗口内计数累加，超出窗口的请求不再计入"""
+        limiter = LocalRateLimiter()
+        with patch('app.utils.rate_limiting.time.time', return_value=1000.0):
+            for _ in range(3):
+                count = await limiter.hit("ip:1.2.3.4", MINUTE_WINDOW, MINUTE_BUCKETS)
+        assert count == 3
+
+        with patch('app.utils.rate_limiting.time.time', return_value=1030.0):
+            assert await limiter.hit("ip:1.2.3.4", MINUTE_WINDOW, MINUTE_BUCKETS) == 4
+
+        with patch('app.utils.rate_limiting.time.time', return_value=1065.0):
+            # 1000 秒时的 3 次请求已滑出窗口
+            assert await limiter.hit("ip:1.2.3.4", MINUTE_WINDOW, MINUTE_BUCKETS) == 2
+
+    @pytest.mark.asyncio
+    async def test_evict_idle(self):
+        """测试空闲计数器被清理"""
+        limiter = LocalRateLimiter(shards=1)
+        with patch('app.utils.rate_limiting.time.time', return_value=1000.0):
+            await limiter.hit("ip:idle", MINUTE_WINDOW, MINUTE_BUCKETS)
+        with patch('app.utils.rate_limiting.time.time', return_value=2000.0):
+            await limiter.hit("ip:active", MINUTE_WINDOW, MINUTE_BUCKETS)
+            assert await limiter.evict_idle(max_idle=MINUTE_WINDOW) == 1
+        assert len(limiter) == 1
+
+
+class StubPipeline:
+    """模拟 redis.asyncio 的 pipeline，down 为 True 时 execute 抛出连接错误"""
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def incr(self, key):
+        self.commands.append(("incr", key))
+
+    def expire(self, key, seconds):
+        self.commands.append(("expire", key))
+
+    def mget(self, keys):
+        self.commands.append(("mget", keys))
+
+    async def execute(self):
+        if self.client.down:
+            raise ConnectionError("redis unavailable")
+        results = []
+        for command, arg in self.commands:
+            if command == "incr":
+                self.client.data[arg] = self.client.data.get(arg, 0) + 1
+                results.append(self.client.data[arg])
+            elif command == "expire":
+                results.append(True)
+            else:
+                results.append([self.client.data.get(key) for key in arg])
+        return results
+
+
+class StubRedis:
+    def __init__(self):
+        self.data = {}
+        self.down = False
+
+    def pipeline(self, transaction=True):
+        return StubPipeline(self)
+
+
+class TestRedisRateLimiter:
+    """用模拟客户端测试 Redis 限流器"""
+
+    @pytest.mark.asyncio
+    async def test_counts_in_redis_and_falls_back_when_unavailable(self):
+        """测试计数写入 Redis，连接出错时回退到进程内计数，重试间隔后恢复使用 Redis"""
+        client = StubRedis()
+        limiter = RedisRateLimiter("redis://stub", client=client)
+        with patch('app.utils.rate_limiting.time.time', return_value=1000.0):
+            assert await limiter.hit("ip:1.2.3.4", MINUTE_WINDOW, MINUTE_BUCKETS) == 1
+            assert await limiter.hit("ip:1.2.3.4", MINUTE_WINDOW, MINUTE_BUCKETS) == 2
+
+            client.down = True
+            assert await limiter.hit("ip:1.2.3.4", MINUTE_WINDOW, MINUTE_BUCKETS) == 1
+            client.down = False
+            # 重试间隔内不再访问 Redis
+            assert await limiter.hit("ip:1.2.3.4", MINUTE_WINDOW, MINUTE_BUCKETS) == 2
+
+        with patch('app.utils.rate_limiting.time.time', return_value=1000.0 + limiter.retry_interval):
+            assert await limiter.hit("ip:1.2.3.4", MINUTE_WINDOW, MINUTE_BUCKETS) == 3
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,30 @@
+import pytest
+from app.utils.readiness import Readiness
+
+
+class TestReadiness:
+    """测试启动就绪状态"""
+
+    def test_ready_when_required_components_ok(self):
+        """测试必需组件全部就绪后才标记为就绪，非必需组件失败不影响"""
+        readiness = Readiness()
+        readiness.set('version', 'timeout')
+        readiness.set('api_key')
+        assert not readiness.is_ready
+
+        readiness.set('models')
+        status = readiness.status()
+        assert readiness.is_ready and status['ready']
+        assert status['components'] == {'version': 'timeout', 'api_key': 'ok', 'models': 'ok'}
+
+    def test_require_vertex_only(self):
+        """测试未配置密钥时改为等待 Vertex 初始化"""
+        readiness = Readiness()
+        readiness.set('vertex')
+        assert not readiness.is_ready
+        readiness.require('vertex')
+        assert readiness.is_ready
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
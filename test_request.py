@@ -0,0 +1,118 @@
+import pytest
+import asyncio
+from fastapi.responses import StreamingResponse
+from app.utils.request import FlightCancelledError, RequestCoalescer
+
+
+async def consume(response: StreamingResponse) -> list:
+    """读取 StreamingResponse 的全部块"""
+    return [chunk async for chunk in response.body_iterator]
+
+
+class TestRequestCoalescer:
+    """测试RequestCoalescer的请求合并功能"""
+
+    @pytest.mark.asyncio
+    async def test_non_stream_requests_share_one_call(self):
+        """测试相同的非流式并发请求只调用一次上游，且所有请求得到相同结果"""
+        coalescer = RequestCoalescer()
+        calls = 0
+        release = asyncio.Event()
+
+        async def factory():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return {"text": "hello"}
+
+        tasks = [asyncio.create_task(coalescer.run("key", factory)) for _ in range(5)]
+        await asyncio.sleep(0)
+        assert coalescer.get_stats()["waiters"] == 4
+
+        release.set()
+        results = await asyncio.gather(*tasks)
+
+        assert calls == 1
+        assert all(result == {"text": "hello"} for result in results)
+        assert coalescer.coalesced_total == 4
+        assert coalescer.flights == {}
+
+    @pytest.mark.asyncio
+    async def test_stream_broadcast(self):
+        """测试流式响应被广播给所有请求，后加入的请求从头重放"""
+        coalescer = RequestCoalescer()
+        calls = 0
+        gate = asyncio.Event()
+
+        async def generator():
+            yield "data: 1\n\n"
+            await gate.wait()
+            yield "data: 2\n\n"
+
+        async def factory():
+            nonlocal calls
+            calls += 1
+            return StreamingResponse(generator(), media_type="text/event-stream")
+
+        leader = await coalescer.run("key", factory)
+        await asyncio.sleep(0)
+        follower = await coalescer.run("key", factory)
+
+        gate.set()
+        leader_chunks, follower_chunks = await asyncio.gather(consume(leader), consume(follower))
+
+        assert calls == 1
+        assert leader_chunks == follower_chunks == ["data: 1\n\n", "data: 2\n\n"]
+        assert follower.media_type == "text/event-stream"
+        assert coalescer.flights == {}
+
+    @pytest.mark.asyncio
+    async def test_stream_cancelled(self):
+        """测试未被读取的流式响应不计入订阅者，上游被取消后正在读取的请求收到异常而不是截断的响应"""
+        coalescer = RequestCoalescer()
+        gate = asyncio.Event()
+
+        async def generator():
+            yield "data: 1\n\n"
+            await gate.wait()
+            yield "data: 2\n\n"
+
+        async def factory():
+            return StreamingResponse(generator(), media_type="text/event-stream")
+
+        leader = await coalescer.run("key", factory)
+        follower = await coalescer.run("key", factory)
+        flight = coalescer.flights["key"]
+        assert flight.subscribers == 0 and flight.broadcast.pump is None
+
+        iterator = leader.body_iterator
+        assert await iterator.__anext__() == "data: 1\n\n"
+        assert flight.subscribers == 1
+
+        flight.broadcast.pump.cancel()
+        with pytest.raises(FlightCancelledError):
+            await iterator.__anext__()
+        assert coalescer.flights == {}
+        await follower.body_iterator.aclose()
+
+    @pytest.mark.asyncio
+    async def test_error_propagates_to_followers(self):
+        """测试领头请求失败时跟随者收到相同的异常"""
+        coalescer = RequestCoalescer()
+        release = asyncio.Event()
+
+        async def factory():
+            await release.wait()
+            raise ValueError("upstream failed")
+
+        tasks = [asyncio.create_task(coalescer.run("key", factory)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        assert all(isinstance(result, ValueError) for result in results)
+        assert coalescer.flights == {}
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
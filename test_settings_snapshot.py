@@ -0,0 +1,65 @@
+import pytest
+from app.config import settings
+from app.config.safety import SAFETY_SETTINGS, SAFETY_SETTINGS_G2
+from app.config.snapshot import SettingsSnapshot, current_settings, publish_settings
+
+
+class TestSettingsSnapshot:
+    """测试不可变配置快照"""
+
+    def test_snapshot_is_frozen_and_swapped_on_publish(self, monkeypatch):
+        """测试快照只读，修改配置并发布后旧快照保持不变"""
+        before = current_settings()
+        with pytest.raises(AttributeError):
+            before.MAX_RETRY_NUM = 1
+        with pytest.raises(TypeError):
+            before.search["search_mode"] = True
+
+        monkeypatch.setattr(settings, "MAX_RETRY_NUM", before.MAX_RETRY_NUM + 1)
+        after = publish_settings()
+        assert current_settings() is after
+        assert after.version == before.version + 1
+        assert after.MAX_RETRY_NUM == before.MAX_RETRY_NUM + 1
+        monkeypatch.undo()
+        publish_settings()
+
+    def test_derived_values(self):
+        """测试模型过滤、User-Agent 白名单和各模型的安全设置"""
+        snapshot = SettingsSnapshot({
+            "WHITELIST_MODELS": set(),
+            "BLOCKED_MODELS": {"gemini-1.0-pro"},
+            "WHITELIST_USER_AGENT": {"SillyTavern"},
+        })
+        assert snapshot.filter_models(["gemini-1.0-pro", "gemini-2.5-pro"]) == ["gemini-2.5-pro"]
+        assert snapshot.whitelist_user_agent == {"sillytavern"}
+        assert snapshot.safety_settings("gemini-2.5-pro") is SAFETY_SETTINGS_G2
+        assert snapshot.safety_settings("gemini-2.0-flash") is SAFETY_SETTINGS
+
+        whitelisted = SettingsSnapshot({"WHITELIST_MODELS": {"gemini-1.0-pro"}, "BLOCKED_MODELS": {"gemini-1.0-pro"}})
+        assert whitelisted.filter_models(["gemini-1.0-pro", "gemini-2.5-pro"]) == ["gemini-1.0-pro"]
+
+    def test_precomputed_keys_and_safety(self):
+        """测试密钥列表和可用模型的安全设置在创建快照时计算并且只读"""
+        snapshot = SettingsSnapshot({
+            "GEMINI_API_KEYS": "key-a, key-b,,key-a",
+            "INVALID_API_KEYS": "key-b",
+            "VERTEX_EXPRESS_API_KEY": "",
+        }, models=["gemini-2.5-pro", "gemini-2.0-flash"])
+        assert snapshot.api_keys == ("key-a", "key-b")
+        assert snapshot.invalid_api_keys == {"key-b"}
+        assert snapshot.vertex_express_api_keys == ()
+        assert snapshot.model_safety["gemini-2.5-pro"] is SAFETY_SETTINGS_G2
+        assert snapshot.model_safety["gemini-2.0-flash"] is SAFETY_SETTINGS
+        with pytest.raises(TypeError):
+            snapshot.model_safety["gemini-2.5-flash"] = SAFETY_SETTINGS
+
+        previous = current_settings().model_safety
+        try:
+            assert "gemini-test" in publish_settings(["gemini-test"]).model_safety
+            assert "gemini-test" in publish_settings().model_safety
+        finally:
+            publish_settings(previous)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
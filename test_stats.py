@@ -0,0 +1,56 @@
+import pytest
+import asyncio
+from app.utils.stats import ApiStatsManager, MinuteSeries
+
+
+class TestApiStatsManager:
+    """测试ApiStatsManager的异步批量统计"""
+
+    @pytest.mark.asyncio
+    async def test_batched_ingestion(self):
+        """测试调用记录先写入缓冲区，由消费者任务批量应用"""
+        manager = ApiStatsManager(batch_interval=0.05)
+        for _ in range(3):
+            await manager.update_stats("key-a", "gemini-2.5-pro", 10)
+
+        assert manager.api_key_counts["key-a"] == 0
+        await asyncio.sleep(0.1)
+        assert manager.api_key_counts["key-a"] == 3
+        assert manager.api_model_tokens["key-a"]["gemini-2.5-pro"] == 30
+        await manager.close()
+
+    @pytest.mark.asyncio
+    async def test_reads_include_pending_records(self):
+        """测试读取统计时包含尚未被消费者处理的记录，缓冲区满时同步处理"""
+        manager = ApiStatsManager(batch_interval=60, buffer_size=4)
+        for _ in range(10):
+            await manager.update_stats("key-a", "gemini-2.5-flash", 1)
+
+        assert manager.get_calls_last_minute() == 10
+        assert await manager.get_api_key_usage("key-a") == 10
+        await manager.close()
+
+
+class TestMinuteSeries:
+    """测试按分钟统计的环形缓冲区"""
+
+    def test_window_sum_wraps_and_expires(self):
+        """测试窗口求和跨越环形边界，超出保留范围的数据被清零"""
+        series = MinuteSeries(size=10)
+        for minute in range(5, 15):
+            series.add(minute, 1, 100)
+
+        # 窗口 (9, 14] 跨越下标 9 -> 0 的边界
+        assert series.sum_calls(5, 14) == 5
+        assert series.sum_tokens(2, 14) == 200
+        assert series.get(5) == (1, 100)
+
+        # 前进 3 分钟后最早的 3 分钟被覆盖
+        series.add(17, 2, 0)
+        assert series.get(5) == (0, 0)
+        assert series.sum_calls(10, 17) == 9
+        assert series.sum_calls(100, 17) == 9
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,72 @@
+import pytest
+import asyncio
+import app.config.settings as settings
+from app.utils.stream_hub import StreamHub
+
+
+class TestStreamHub:
+    """测试StreamHub共享上游流的功能"""
+
+    @pytest.mark.asyncio
+    async def test_late_joiner_replays_buffer(self):
+        """测试后加入的订阅者先重放已有块，再接收实时块，上游只打开一次"""
+        hub = StreamHub()
+        opened = 0
+        gate = asyncio.Event()
+
+        async def source():
+            nonlocal opened
+            opened += 1
+            yield 1
+            yield 2
+            await gate.wait()
+            yield 3
+
+        first = hub.subscribe("key", source)
+        assert await first.__anext__() == 1
+
+        second = hub.subscribe("key", source)
+        gate.set()
+        first_rest = [chunk async for chunk in first]
+        second_all = [chunk async for chunk in second]
+
+        assert opened == 1
+        assert first_rest == [2, 3]
+        assert second_all == [1, 2, 3]
+        assert hub.joined_total == 1
+        assert hub.channels == {}
+
+    @pytest.mark.asyncio
+    async def test_bounded_buffer(self, monkeypatch):
+        """测试上游按最慢的订阅者暂停，不丢块；缓冲区丢弃早期块后新请求另开上游流"""
+        monkeypatch.setattr(settings, "STREAM_REPLAY_MAX_CHUNKS", 2)
+        hub = StreamHub()
+
+        async def source():
+            for i in range(4):
+                yield i
+
+        slow = hub.subscribe("key", source)
+        assert await slow.__anext__() == 0
+        for _ in range(5):
+            await asyncio.sleep(0)
+        # 缓冲区已满且块 1 尚未读取，上游等待订阅者
+        channel = hub.channels["key"]
+        assert (channel.buffer.base, channel.buffer.end) == (1, 3)
+
+        assert await slow.__anext__() == 1
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+        async def short_source():
+            yield "a"
+            yield "b"
+
+        other = hub.subscribe("key", short_source)
+        assert hub.upstream_total == 2
+        assert [chunk async for chunk in other] == ["a", "b"]
+        assert [chunk async for chunk in slow] == [2, 3]
+        assert hub.channels == {}
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,101 @@
+import pytest
+from app.utils.key_scheduler import KeyScheduler
+from app.utils.stats import ApiStatsManager
+from app.utils.usage_journal import UsageJournal, decode_deltas, encode_delta
+
+KEY = "AIzaSyAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+
+
+class MemoryPersistence:
+    """在内存中保存快照和增量日志的持久化对象"""
+
+    def __init__(self):
+        self.snapshot = None
+        self.deltas = b""
+
+    def save_usage_snapshot(self, data):
+        self.snapshot = data
+        self.deltas = b""
+
+    def append_usage_deltas(self, data):
+        self.deltas += data
+
+    def load_usage(self):
+        return self.snapshot, self.deltas
+
+
+def create_journal(persistence):
+    stats = ApiStatsManager(enable_background=False)
+    scheduler = KeyScheduler()
+    scheduler.set_keys([KEY])
+    journal = UsageJournal(persistence, stats, scheduler)
+    stats.journal = journal
+    scheduler.journal = journal
+    return journal
+
+
+class TestUsageJournal:
+    """测试用量快照与增量日志的写入和恢复"""
+
+    @pytest.mark.asyncio
+    async def test_recover_from_snapshot_and_deltas(self):
+        """测试重启后从快照和之后的增量日志恢复计数与密钥用量"""
+        persistence = MemoryPersistence()
+        journal = create_journal(persistence)
+        for _ in range(3):
+            journal.key_scheduler.record_success(KEY)
+            await journal.stats_manager.update_stats(KEY, "gemini-2.5-pro", 10)
+        journal.snapshot_due = True
+        await journal.flush()
+
+        journal.key_scheduler.record_success(KEY)
+        await journal.stats_manager.update_stats(KEY, "gemini-2.5-pro", 10)
+        # 空响应计入统计，但调度器不计入密钥用量
+        await journal.stats_manager.update_stats(KEY, "gemini-2.5-pro", 0)
+        await journal.flush()
+        assert len(decode_deltas(persistence.deltas)) == 3
+
+        restarted = create_journal(persistence)
+        await restarted.recover()
+
+        assert restarted.stats_manager.api_model_counts[KEY]["gemini-2.5-pro"] == 5
+        assert restarted.stats_manager.api_key_tokens[KEY] == 40
+        assert restarted.key_scheduler.get_usage(KEY) == journal.key_scheduler.get_usage(KEY) == 4
+        assert restarted.seq == 9
+
+    @pytest.mark.asyncio
+    async def test_no_writes_until_recovered(self):
+        """测试启动时读取失败不写入数据，恢复成功后序号接着存储中的序号"""
+        persistence = MemoryPersistence()
+        journal = create_journal(persistence)
+        for _ in range(2):
+            await journal.stats_manager.update_stats(KEY, "gemini-2.5-pro", 10)
+        journal.snapshot_due = True
+        await journal.flush()
+
+        load_usage = persistence.load_usage
+        persistence.load_usage = lambda: (_ for _ in ()).throw(ConnectionError("db down"))
+        restarted = create_journal(persistence)
+        assert not await restarted.recover()
+        restarted.stats_manager.journal = restarted
+        await restarted.stats_manager.update_stats(KEY, "gemini-2.5-pro", 10)
+        restarted.snapshot_due = True
+        await restarted.flush()
+        assert persistence.deltas == b"" and len(restarted.pending) == 1
+
+        persistence.load_usage = load_usage
+        restarted.snapshot_due = False
+        await restarted.flush()
+        assert [record[0] for record in decode_deltas(persistence.deltas)] == [3]
+        assert restarted.stats_manager.api_model_counts[KEY]["gemini-2.5-pro"] == 3
+
+    def test_truncated_delta_log(self):
+        """测试增量日志末尾的不完整记录被忽略"""
+        data = encode_delta(1, 0.0, 0, KEY, "m", 1) + encode_delta(2, 0.0, 0, KEY, "m", 2)
+        records = decode_deltas(data[:-3])
+
+        assert [record[0] for record in records] == [1]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])